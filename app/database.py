@@ -1,14 +1,91 @@
-"""This module defines the database connection and session management."""
+"""This module defines the database connection and session management.
 
-from sqlalchemy import create_engine
+The API and the workers share one SQLite file. It is opened in WAL mode so
+readers never block the writer, with ``synchronous=NORMAL`` so commits do
+not wait for an fsync (WAL stays consistent; a power loss can only drop
+the last few commits), and a busy timeout so contending writers wait
+instead of failing with "database is locked".
+"""
+
+import os
+from typing import Iterator
+
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./jobs.db")
 
-DATABASE_URL = "sqlite:///./jobs.db"
+# Milliseconds a connection waits for a lock before giving up.
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "10000"))
+# OFF, NORMAL or FULL; NORMAL is durable enough in WAL mode.
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+# Page cache per connection, in KiB.
+SQLITE_CACHE_KIB = int(os.getenv("SQLITE_CACHE_KIB", str(64 * 1024)))
+# Bytes of the database file memory-mapped per connection.
+SQLITE_MMAP_BYTES = int(os.getenv("SQLITE_MMAP_BYTES", str(256 * 1024 * 1024)))
 
 engine = create_engine(
-    DATABASE_URL, connect_args={"check_same_thread": False}
+    DATABASE_URL,
+    connect_args={
+        "check_same_thread": False,
+        "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000,
+    },
 )
+
+
+@event.listens_for(engine, "connect")
+def _configure_sqlite(dbapi_connection, connection_record):  # pylint: disable=unused-argument
+    """Applies the pragmas every connection needs."""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KIB}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_BYTES}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+    finally:
+        cursor.close()
+
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
+
+
+def get_db() -> Iterator[Session]:
+    """Yields a database session for a request and closes it afterwards."""
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def init_db() -> None:
+    """Creates missing tables and adds columns and indexes added since.
+
+    ``create_all`` only creates tables that do not exist yet, so columns
+    added to a model later are appended to the existing table here. Rows
+    that predate a column with a callable default are backfilled with it.
+    """
+    Base.metadata.create_all(bind=engine)
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(
+                    text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+                )
+                if column.default is not None and column.default.is_callable:
+                    conn.execute(
+                        text(f"UPDATE {table.name} SET {column.name} = :value"),
+                        {"value": column.default.arg(None)},
+                    )
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
@@ -1,6 +1,8 @@
 """The main entrypoint for the LaTech FastAPI application."""
 
+import asyncio
 import os
+import threading
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -8,15 +10,19 @@ load_dotenv()
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.routers import (
-    uploads, preprocess, convert, compile as compile_routes, status
+    uploads, preprocess, convert, compile as compile_routes, status, batches, pipeline,
+    metrics as metrics_routes,
 )
 
 
 
-from app.database import engine, Base
-from app.models import job
+from app.database import init_db
+# Imported so their tables are registered before init_db runs.
+from app.models import batch, blob, job, job_event, task  # pylint: disable=unused-import
+from app.services.events import event_bus
+from app.services.latex_compile import warm_formats
 
-job.Base.metadata.create_all(bind=engine)
+init_db()
 
 app = FastAPI(title="LaTech FastAPI App")
 
@@ -30,7 +36,9 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
+app.add_middleware(metrics_routes.MetricsMiddleware)
 
 
 @app.get("/api/health")
@@ -39,11 +47,26 @@ def health() -> dict:
     return {"status": "ok"}
 
 
+@app.on_event("startup")
+def warm_latex_formats() -> None:
+    """Builds the common pdflatex formats without delaying startup."""
+    threading.Thread(target=warm_formats, daemon=True).start()
+
+
+@app.on_event("startup")
+async def start_event_relay() -> None:
+    """Starts relaying job status events to streaming clients."""
+    asyncio.get_event_loop().create_task(event_bus.relay())
+
+
 app.include_router(uploads.router)
 app.include_router(preprocess.router)
 app.include_router(convert.router)
 app.include_router(compile_routes.router)
 app.include_router(status.router)
+app.include_router(batches.router)
+app.include_router(pipeline.router)
+app.include_router(metrics_routes.router)
 
 
 
@@ -0,0 +1,16 @@
+"""This module defines the SQLAlchemy model for a batch of jobs."""
+
+from sqlalchemy import Column, Integer, String
+
+from app.database import Base
+
+
+class Batch(Base):
+    """The SQLAlchemy model for a batch of jobs uploaded together."""
+
+    __tablename__ = "batches"
+
+    batch_id = Column(String, primary_key=True, index=True)
+    name = Column(String, nullable=True)
+    status = Column(String, index=True)
+    job_count = Column(Integer, default=0)
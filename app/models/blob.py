@@ -0,0 +1,20 @@
+"""This module defines the SQLAlchemy model for a stored upload blob."""
+
+from sqlalchemy import Column, Integer, String
+
+from app.database import Base
+
+
+class Blob(Base):
+    """The SQLAlchemy model for an uploaded file shared by jobs.
+
+    Uploads are stored once per content hash; ``ref_count`` is the number
+    of jobs that reference the file.
+    """
+
+    __tablename__ = "blobs"
+
+    upload_id = Column(String, primary_key=True, index=True)
+    sha256 = Column(String, index=True)
+    size = Column(Integer)
+    ref_count = Column(Integer, default=0)
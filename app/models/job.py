@@ -1,6 +1,8 @@
 """This module defines the SQLAlchemy model for a Job."""
 
-from sqlalchemy import Column, String
+import time
+
+from sqlalchemy import Column, Float, Index, Integer, String, Text
 
 from app.database import Base
 
@@ -13,8 +15,38 @@ class Job(Base):
     job_id = Column(String, primary_key=True, index=True)
     name = Column(String, nullable=True)
     status = Column(String, index=True)
+    progress = Column(Integer, nullable=True)
     upload_id = Column(String, nullable=True)
+    upload_hash = Column(String, nullable=True, index=True)
+    image_width = Column(Integer, nullable=True)
+    image_height = Column(Integer, nullable=True)
     processed_id = Column(String, nullable=True)
+    preprocess_options = Column(Text, nullable=True)
     latex_id = Column(String, nullable=True)
     pdf_id = Column(String, nullable=True)
     error_message = Column(String, nullable=True)
+    batch_id = Column(String, nullable=True, index=True)
+    # Unix timestamps in seconds.
+    created_at = Column(Float, default=time.time)
+    updated_at = Column(Float, default=time.time, onupdate=time.time)
+
+    __table_args__ = (
+        Index("ix_jobs_upload_options", "upload_id", "preprocess_options"),
+        # Keyset pagination over all jobs and within a status.
+        Index("ix_jobs_created", "created_at", "job_id"),
+        Index("ix_jobs_status_created", "status", "created_at", "job_id"),
+        Index("ix_jobs_name_created", "name", "created_at"),
+    )
+
+
+# How far along the pipeline a job in each status is, in percent.
+STATUS_PROGRESS = {
+    "uploaded": 0,
+    "preprocessing": 10,
+    "ready to convert": 33,
+    "converting": 50,
+    "ready to compile": 67,
+    "compiling": 80,
+    "complete": 100,
+    "failed": 100,
+}
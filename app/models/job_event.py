@@ -0,0 +1,53 @@
+"""This module defines the SQLAlchemy model for a job status event.
+
+Every flush that changes a job's status, progress or error appends an
+event row, so status changes made by worker processes reach the web
+process without each client polling the jobs table.
+"""
+
+import time
+
+from sqlalchemy import Column, Float, Integer, String, event
+from sqlalchemy.orm import attributes
+
+from app.database import Base, SessionLocal
+from app.models.job import STATUS_PROGRESS, Job
+
+
+class JobEvent(Base):
+    """The SQLAlchemy model for a change of a job's status."""
+
+    __tablename__ = "job_events"
+
+    event_id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(String, index=True)
+    state = Column(String)
+    progress = Column(Integer)
+    error = Column(String, nullable=True)
+    created_at = Column(Float, index=True)
+
+
+@event.listens_for(SessionLocal, "before_flush")
+def _record_job_events(session, flush_context, instances):  # pylint: disable=unused-argument
+    """Appends an event for every new or changed job in the flush."""
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Job):
+            continue
+        status_changed = attributes.get_history(obj, "status").has_changes()
+        if status_changed and not attributes.get_history(obj, "progress").has_changes():
+            obj.progress = STATUS_PROGRESS.get(obj.status, obj.progress or 0)
+        if not (
+            status_changed
+            or attributes.get_history(obj, "progress").has_changes()
+            or attributes.get_history(obj, "error_message").has_changes()
+        ):
+            continue
+        session.add(
+            JobEvent(
+                job_id=obj.job_id,
+                state=obj.status,
+                progress=obj.progress,
+                error=obj.error_message,
+                created_at=time.time(),
+            )
+        )
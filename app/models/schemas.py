@@ -3,8 +3,9 @@
 These schemas are used for request and response validation.
 """
 
-from typing import Optional
-from pydantic import BaseModel
+import json
+from typing import Dict, List, Optional
+from pydantic import BaseModel, validator
 
 
 class PreprocessResize(BaseModel):
@@ -14,22 +15,49 @@ class PreprocessResize(BaseModel):
     height: int
 
 
+# Denoising tiers, cheapest first; see app.services.image_preprocess.
+DENOISE_METHODS = ("median", "bilateral", "nlm_fast", "nlm")
+
+
 class PreprocessOptions(BaseModel):
-    """Defines the options for preprocessing an image."""
+    """Defines the options for preprocessing an image.
+
+    With ``auto`` set, grayscale, denoising and thresholding are chosen from
+    statistics of the image; only ``resize`` is taken from the request.
+    """
 
     grayscale: bool = True
     denoise: bool = False
+    denoise_strength: int = 10
+    denoise_method: str = "nlm"
     threshold: Optional[int] = None
     resize: Optional[PreprocessResize] = None
     adaptive_threshold: bool = False
+    auto: bool = False
+
+    @validator("denoise_method")
+    def _check_denoise_method(cls, value):  # pylint: disable=no-self-argument
+        if value not in DENOISE_METHODS:
+            raise ValueError(f"denoise_method must be one of {', '.join(DENOISE_METHODS)}")
+        return value
 
 
 
 
 
+class PipelineRequest(BaseModel):
+    """Defines the request for running the whole pipeline on a job."""
+
+    options: PreprocessOptions = PreprocessOptions()
+    persist_intermediates: bool = False
+    bypass_cache: bool = False
+    segment: bool = False
+
+
 class StatusResponse(BaseModel):
     """The response model for a status request."""
 
+    job_id: Optional[str] = None
     state: str
     progress: int
     error: Optional[str] = None
@@ -41,15 +69,28 @@ class Job(BaseModel):
     job_id: str
     name: Optional[str] = None
     status: str
+    progress: Optional[int] = None
     upload_id: Optional[str] = None
+    upload_hash: Optional[str] = None
+    image_width: Optional[int] = None
+    image_height: Optional[int] = None
     processed_id: Optional[str] = None
+    preprocess_options: Optional[PreprocessOptions] = None
     latex_id: Optional[str] = None
     pdf_id: Optional[str] = None
     error_message: Optional[str] = None
+    batch_id: Optional[str] = None
+    created_at: Optional[float] = None
+    updated_at: Optional[float] = None
 
     class Config:
         orm_mode = True
 
+    @validator("preprocess_options", pre=True)
+    def _parse_options(cls, value):  # pylint: disable=no-self-argument
+        # Jobs store the options they were preprocessed with as JSON.
+        return json.loads(value) if isinstance(value, str) else value
+
 
 class JobCreate(BaseModel):
     """Defines the request for creating a job."""
@@ -62,3 +103,23 @@ class JobResponse(BaseModel):
     """The response model for a job creation request."""
 
     job_id: str
+
+
+class BatchResponse(BaseModel):
+    """The response model for a batch creation request."""
+
+    batch_id: str
+    job_ids: List[str]
+
+
+class BatchStatus(BaseModel):
+    """The aggregate progress of a batch of jobs."""
+
+    batch_id: str
+    status: str
+    total: int
+    completed: int
+    failed: int
+    progress: int
+    counts: Dict[str, int]
+    jobs: List[Job]
@@ -1,37 +1,41 @@
-"""This module defines the storage paths for the application."""
+"""This module defines the storage paths for the application.
 
+Job artifacts are read and written through ``app.services.artifact_store``;
+the directories here are where the local backend keeps them, along with
+the caches and scratch space that always live on the local disk.
+"""
+
+import os
 from pathlib import Path
 
 
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
-DATA_DIR = BASE_DIR / "data"
+DATA_DIR = Path(os.getenv("DATA_DIR", str(BASE_DIR / "data")))
 UPLOADS_DIR = DATA_DIR / "uploads"
 PROCESSED_DIR = DATA_DIR / "processed"
 LATEX_DIR = DATA_DIR / "latex"
 PDF_DIR = DATA_DIR / "pdf"
+FORMAT_DIR = DATA_DIR / "formats"
+CACHE_DIR = DATA_DIR / "cache"
+BUILD_DIR = DATA_DIR / "build"
+# Partial uploads and files on their way into the artifact store.
+STAGING_DIR = DATA_DIR / "staging"
 
 
 def ensure_dirs() -> None:
     """Ensures that all the data directories exist."""
-    for d in (DATA_DIR, UPLOADS_DIR, PROCESSED_DIR, LATEX_DIR, PDF_DIR):
+    for d in (
+        DATA_DIR, UPLOADS_DIR, PROCESSED_DIR, LATEX_DIR, PDF_DIR, FORMAT_DIR, CACHE_DIR,
+        BUILD_DIR, STAGING_DIR,
+    ):
         d.mkdir(parents=True, exist_ok=True)
 
 
-def path_for_upload(upload_id: str) -> Path:
-    """Returns the path to an uploaded file."""
-    return UPLOADS_DIR / f"{upload_id}"
-
-
-def path_for_processed(processed_id: str) -> Path:
-    """Returns the path to a processed file."""
-    return PROCESSED_DIR / f"{processed_id}.png"
-
-
-def path_for_latex(latex_id: str) -> Path:
-    """Returns the path to a LaTeX file."""
-    return LATEX_DIR / f"{latex_id}.tex"
+def upload_id_for(sha256: str, fmt: str) -> str:
+    """Returns the content-addressed upload_id of an image."""
+    return f"{sha256}.{fmt}"
 
 
-def path_for_pdf(pdf_id: str) -> Path:
-    """Returns the path to a PDF file."""
-    return PDF_DIR / f"{pdf_id}.pdf"
+def path_for_build(build_key: str) -> Path:
+    """Returns the directory holding the LaTeX aux state of a job."""
+    return BUILD_DIR / build_key
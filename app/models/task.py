@@ -0,0 +1,29 @@
+"""This module defines the SQLAlchemy model for a queued pipeline task."""
+
+from sqlalchemy import Column, Float, Index, Integer, String, Text
+
+from app.database import Base
+
+
+class Task(Base):
+    """The SQLAlchemy model for one pipeline stage queued for a worker.
+
+    Times are Unix timestamps in seconds.
+    """
+
+    __tablename__ = "tasks"
+
+    task_id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(String, index=True)
+    stage = Column(String)
+    payload = Column(Text, nullable=True)
+    status = Column(String)
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer)
+    available_at = Column(Float)
+    lease_expires_at = Column(Float, nullable=True)
+    worker_id = Column(String, nullable=True)
+    last_error = Column(String, nullable=True)
+    created_at = Column(Float)
+
+    __table_args__ = (Index("ix_tasks_claim", "stage", "status", "available_at"),)
@@ -0,0 +1,140 @@
+"""This module defines the API endpoints for processing batches of images."""
+
+import json
+import uuid
+from typing import List
+from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile
+from pydantic import ValidationError
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from app.database import get_db
+from app.models import batch as batch_model
+from app.models import job as job_model
+from app.models.schemas import BatchResponse, BatchStatus, PreprocessOptions
+from app.models import storage
+from app.routers.uploads import store_upload
+from app.services import task_queue
+from app.services.artifact_store import release_upload
+
+
+router = APIRouter(prefix="/api", tags=["batches"])
+
+
+@router.post("/batches", response_model=BatchResponse)
+async def create_batch(
+    files: List[UploadFile] = File(...),
+    options: str = Form("{}"),
+    name: str = Form(None),
+    db: Session = Depends(get_db),
+) -> BatchResponse:
+    """Uploads many images as one batch and runs the pipeline on each.
+
+    Every image is queued for preprocessing, followed by conversion and
+    compilation, so the images move through the stages concurrently up to
+    the workers' per-stage limits.
+
+    Args:
+        files: The image files to upload.
+        options: The preprocessing options for every image, as JSON.
+        name: An optional name for the batch.
+        db: The database session.
+
+    Returns:
+        A BatchResponse containing the batch_id and the child job_ids.
+    """
+    storage.ensure_dirs()
+    try:
+        preprocess_options = PreprocessOptions(**json.loads(options))
+    except (ValueError, TypeError, ValidationError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid options: {e}")
+
+    uploads = []
+    try:
+        for file in files:
+            uploads.append((file.filename, await store_upload(file, db)))
+
+        # Create the batch, its jobs and their tasks in a single transaction.
+        batch_id = str(uuid.uuid4())
+        db.add(
+            batch_model.Batch(
+                batch_id=batch_id, name=name, status="running", job_count=len(uploads)
+            )
+        )
+        job_ids = []
+        for filename, upload in uploads:
+            job_id = str(uuid.uuid4())
+            db.add(
+                job_model.Job(
+                    job_id=job_id,
+                    status="uploaded",
+                    upload_id=upload.upload_id,
+                    upload_hash=upload.sha256,
+                    image_width=upload.width,
+                    image_height=upload.height,
+                    name=filename,
+                    batch_id=batch_id,
+                )
+            )
+            task_queue.enqueue(
+                db,
+                job_id,
+                "preprocess",
+                {"options": preprocess_options.dict(), "then": ["convert", "compile"]},
+                commit=False,
+            )
+            job_ids.append(job_id)
+        db.commit()
+    except Exception:
+        # Drop the references taken so far; nothing refers to them now.
+        db.rollback()
+        for _, upload in uploads:
+            await run_in_threadpool(release_upload, db, upload.upload_id)
+        raise
+    return BatchResponse(batch_id=batch_id, job_ids=job_ids)
+
+
+@router.get("/batches/{batch_id}", response_model=BatchStatus)
+def get_batch(batch_id: str, db: Session = Depends(get_db)) -> BatchStatus:
+    """Gets the aggregate progress of a batch.
+
+    Args:
+        batch_id: The ID of the batch.
+        db: The database session.
+
+    Returns:
+        A BatchStatus with per-status counts and the child jobs.
+    """
+    batch = (
+        db.query(batch_model.Batch).filter(batch_model.Batch.batch_id == batch_id).first()
+    )
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch not found")
+
+    counts = dict(
+        db.query(job_model.Job.status, func.count())
+        .filter(job_model.Job.batch_id == batch_id)
+        .group_by(job_model.Job.status)
+        .all()
+    )
+    total = sum(counts.values())
+    progress = sum(
+        job_model.STATUS_PROGRESS.get(status, 0) * count
+        for status, count in counts.items()
+    )
+    jobs = db.query(job_model.Job).filter(job_model.Job.batch_id == batch_id).all()
+    finished = counts.get("complete", 0) + counts.get("failed", 0)
+    if batch.status == "running" and finished == total:
+        batch.status = "complete"
+        db.commit()
+    return BatchStatus(
+        batch_id=batch_id,
+        status=batch.status,
+        total=total,
+        completed=counts.get("complete", 0),
+        failed=counts.get("failed", 0),
+        progress=progress // total if total else 0,
+        counts=counts,
+        jobs=jobs,
+    )
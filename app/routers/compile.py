@@ -1,26 +1,59 @@
 """This module defines the API endpoints for compiling LaTeX to PDF."""
 
 import uuid
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
-from fastapi.responses import FileResponse, PlainTextResponse
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import PlainTextResponse
 from sqlalchemy.orm import Session
 
-from app.database import SessionLocal
+from app.database import SessionLocal, get_db
 from app.models import job as job_model
 from app.models.schemas import JobResponse
 from app.models import storage
-from app.services.latex_compile import compile_latex_to_pdf
+from app.services import task_queue
+from app.services.artifact_store import file_response, store
+from app.services.job_status import status_writer
+from app.services.task_queue import RetryableError
+from app.services.latex_compile import (
+    compile_latex_to_pdf,
+    pdf_cache,
+    source_key,
+    wrap_fragment,
+)
 
 
 router = APIRouter(prefix="/api", tags=["compile"])
 
 
-def get_db():
-    db = SessionLocal()
+def build_pdf(latex_id: str, build_key: Optional[str] = None) -> str:
+    """Compiles a stored LaTeX source, reusing a cached PDF when possible.
+
+    Args:
+        latex_id: The latex_id of the source.
+        build_key: The job ID, whose aux files are reused between compiles.
+
+    Returns:
+        The pdf_id of the compiled PDF.
+    """
+    pdf_id = str(uuid.uuid4())
+    storage.STAGING_DIR.mkdir(parents=True, exist_ok=True)
+    staged = storage.STAGING_DIR / f"{pdf_id}.pdf"
     try:
-        yield db
+        with store.local_path("latex", latex_id) as latex_path:
+            source = latex_path.read_text(encoding="utf-8")
+            # Identical sources compile to identical PDFs; reuse a cached one.
+            key = source_key(source)
+            if not pdf_cache.link(key, staged):
+                compile_latex_to_pdf(latex_path, staged, build_key)
+                pdf_cache.put_file(key, staged)
+        # Fragments are saved back wrapped in a document, through the store.
+        wrapped = wrap_fragment(source)
+        if wrapped != source:
+            store.write_text("latex", latex_id, wrapped)
+        store.put_file("pdf", pdf_id, staged, move=True)
     finally:
-        db.close()
+        staged.unlink(missing_ok=True)
+    return pdf_id
 
 
 def run_compilation(job_id: str):
@@ -35,35 +68,36 @@ def run_compilation(job_id: str):
         db.close()
         return
 
-    job.status = "compiling"
-    db.commit()
+    previous_status = job.status
+    status_writer.update(job_id, status="compiling")
 
     try:
-        latex_path = storage.path_for_latex(job.latex_id)
-        if not latex_path.exists():
+        if not job.latex_id or not store.exists("latex", job.latex_id):
             raise FileNotFoundError("LaTeX source file not found.")
-        pdf_id = str(uuid.uuid4())
-        pdf_path = storage.path_for_pdf(pdf_id)
-        compile_latex_to_pdf(latex_path, pdf_path)
-        job.pdf_id = pdf_id
+        job.pdf_id = build_pdf(job.latex_id, job_id)
         job.status = "complete"
+    except RetryableError as e:
+        # Leave the job as it was; the task queue retries the stage.
+        job.status = previous_status
+        job.error_message = str(e)
+        raise
     except Exception as e:
         job.status = "failed"
         job.error_message = str(e)
     finally:
+        status_writer.settle(job)
         db.commit()
         db.close()
 
 
 @router.post("/compile/{job_id}", response_model=JobResponse)
 def compile_latex(
-    job_id: str, background_tasks: BackgroundTasks, db: Session = Depends(get_db)
+    job_id: str, db: Session = Depends(get_db)
 ) -> JobResponse:
     """Compiles LaTeX source code to a PDF file.
 
     Args:
         job_id: The ID of the job.
-        background_tasks: The background tasks manager.
         db: The database session.
 
     Returns:
@@ -73,7 +107,7 @@ def compile_latex(
     job = db.query(job_model.Job).filter(job_model.Job.job_id == job_id).first()
     if not job:
         raise HTTPException(status_code=404, detail="jobId not found")
-    background_tasks.add_task(run_compilation, job_id)
+    task_queue.enqueue(db, job_id, "compile")
     return JobResponse(job_id=job_id)
 
 
@@ -92,11 +126,12 @@ def get_latex(job_id: str, db: Session = Depends(get_db)):
     if not job:
         raise HTTPException(status_code=404, detail="jobId not found")
 
-    latex_id = job.latex_id
-    latex_path = storage.path_for_latex(latex_id)
-    if not latex_path.exists():
+    if not job.latex_id:
+        raise HTTPException(status_code=404, detail="latexId not found")
+    try:
+        return PlainTextResponse(store.read_text("latex", job.latex_id))
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="latexId not found")
-    return PlainTextResponse(latex_path.read_text(encoding="utf-8"))
 
 
 @router.get("/pdf/{job_id}")
@@ -114,8 +149,9 @@ def get_pdf(job_id: str, db: Session = Depends(get_db)):
     if not job:
         raise HTTPException(status_code=404, detail="jobId not found")
 
-    pdf_id = job.pdf_id
-    pdf_path = storage.path_for_pdf(pdf_id)
-    if not pdf_path.exists():
+    if not job.pdf_id:
+        raise HTTPException(status_code=404, detail="pdfId not found")
+    try:
+        return file_response("pdf", job.pdf_id, media_type="application/pdf")
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="pdfId not found")
-    return FileResponse(pdf_path, media_type="application/pdf")
@@ -1,33 +1,33 @@
 """This module defines the API endpoints for converting images to LaTeX."""
 
 import uuid
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 
-from app.database import SessionLocal
+from app.database import SessionLocal, get_db
 from app.models import job as job_model
 from app.models.schemas import JobResponse
 from pydantic import BaseModel
 from app.models import storage
+from app.services import task_queue
+from app.services.artifact_store import store
+from app.services.job_status import status_writer
+from app.services.task_queue import RetryableError
+from app.services.image_preprocess import decode_image
 from app.services.ocr_to_latex import convert_image_to_latex
+from app.services.segmentation import convert_segmented
 
 
 router = APIRouter(prefix="/api", tags=["convert"])
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-
-def run_conversion(job_id: str):
+def run_conversion(job_id: str, use_cache: bool = True, segment: bool = False):
     """Runs the image to LaTeX conversion.
 
     Args:
         job_id: The ID of the job.
+        use_cache: Whether a cached conversion of the same image may be reused.
+        segment: Whether to convert the page block by block.
     """
     db = SessionLocal()
     job = db.query(job_model.Job).filter(job_model.Job.job_id == job_id).first()
@@ -35,36 +35,48 @@ def run_conversion(job_id: str):
         db.close()
         return
 
-    job.status = "converting"
-    db.commit()
+    previous_status = job.status
+    status_writer.update(job_id, status="converting")
 
     try:
-        src = storage.path_for_processed(job.processed_id)
-        if not src.exists():
+        if not job.processed_id or not store.exists("processed", job.processed_id):
             raise FileNotFoundError("Processed image not found.")
         latex_id = str(uuid.uuid4())
-        latex = convert_image_to_latex(src)
-        latex_path = storage.path_for_latex(latex_id)
-        latex_path.write_text(latex, encoding="utf-8")
+        with store.local_path("processed", job.processed_id) as src:
+            latex = convert_segmented(decode_image(src), use_cache) if segment else None
+            if latex is None:
+                latex = convert_image_to_latex(src, use_cache=use_cache)
+        store.write_text("latex", latex_id, latex)
         job.latex_id = latex_id
         job.status = "ready to compile"
+    except RetryableError as e:
+        # Leave the job as it was; the task queue retries the stage.
+        job.status = previous_status
+        job.error_message = str(e)
+        raise
     except Exception as e:
         job.status = "failed"
         job.error_message = str(e)
     finally:
+        status_writer.settle(job)
         db.commit()
         db.close()
 
 
 @router.post("/convert/{job_id}", response_model=JobResponse)
 def convert_to_latex(
-    job_id: str, background_tasks: BackgroundTasks, db: Session = Depends(get_db)
+    job_id: str,
+    bypass_cache: bool = False,
+    segment: bool = False,
+    db: Session = Depends(get_db),
 ) -> JobResponse:
     """Converts a processed image to LaTeX.
 
     Args:
         job_id: The ID of the job.
-        background_tasks: The background tasks manager.
+        bypass_cache: Whether to ignore cached conversions and call the model.
+        segment: Whether to split the page into blocks, convert them
+            concurrently and stitch the results.
         db: The database session.
 
     Returns:
@@ -74,7 +86,9 @@ def convert_to_latex(
     job = db.query(job_model.Job).filter(job_model.Job.job_id == job_id).first()
     if not job:
         raise HTTPException(status_code=404, detail="jobId not found")
-    background_tasks.add_task(run_conversion, job_id)
+    task_queue.enqueue(
+        db, job_id, "convert", {"use_cache": not bypass_cache, "segment": segment}
+    )
     return JobResponse(job_id=job_id)
 
 
@@ -99,11 +113,12 @@ def get_latex(job_id: str, db: Session = Depends(get_db)):
     if not job.latex_id:
         raise HTTPException(status_code=404, detail="LaTeX not generated yet")
 
-    path = storage.path_for_latex(job.latex_id)
-    if not path.exists():
+    try:
+        latex = store.read_text("latex", job.latex_id)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="LaTeX file not found")
 
-    return PlainTextResponse(path.read_text(encoding="utf-8"))
+    return PlainTextResponse(latex)
 
 
 class LatexUpdate(BaseModel):
@@ -131,8 +146,7 @@ def update_latex(
     if not job.latex_id:
         raise HTTPException(status_code=404, detail="LaTeX not generated yet")
 
-    path = storage.path_for_latex(job.latex_id)
-    path.write_text(body.content, encoding="utf-8")
+    store.write_text("latex", job.latex_id, body.content)
 
     return {"status": "ok"}
 
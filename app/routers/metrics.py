@@ -0,0 +1,83 @@
+"""This module defines the metrics endpoint and the HTTP request instrumentation."""
+
+import time
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from app.database import SessionLocal
+from app.services import metrics, task_queue
+
+
+router = APIRouter(prefix="/api", tags=["metrics"])
+
+HTTP_SECONDS = metrics.registry.histogram(
+    "latech_http_request_duration_seconds",
+    "Time to the response headers of HTTP requests, by route template.",
+    ["method", "route", "status"],
+)
+HTTP_IN_FLIGHT = metrics.registry.gauge(
+    "latech_http_requests_in_flight", "HTTP requests being handled."
+)
+
+
+def _queue_depth():
+    db = SessionLocal()
+    try:
+        depth = task_queue.queue_depth(db)
+    finally:
+        db.close()
+    return {
+        (stage, status): count
+        for stage, statuses in depth.items()
+        for status, count in statuses.items()
+    }
+
+
+metrics.registry.register(
+    metrics.CallbackMetric(
+        "latech_task_queue_depth",
+        "Queued and running tasks per stage, across all workers.",
+        ["stage", "status"],
+        _queue_depth,
+    )
+)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording the latency of every HTTP request.
+
+    Requests are labelled with the matched route template rather than the
+    raw path, so job IDs do not create a label set each.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                HTTP_SECONDS.observe(
+                    time.perf_counter() - start,
+                    method=scope["method"],
+                    route=getattr(scope.get("route"), "path", "unmatched"),
+                    status=status["code"],
+                )
+            await send(message)
+
+        with HTTP_IN_FLIGHT.track():
+            await self.app(scope, receive, send_wrapper)
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def get_metrics() -> PlainTextResponse:
+    """Returns the process metrics in the Prometheus text format."""
+    return PlainTextResponse(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,159 @@
+"""This module defines the API endpoints for running the whole pipeline at once."""
+
+import json
+import uuid
+import cv2
+import numpy as np
+from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile
+from pydantic import ValidationError
+from sqlalchemy.orm import Session
+
+from app.database import SessionLocal, get_db
+from app.models import job as job_model
+from app.models.schemas import JobResponse, PipelineRequest, PreprocessOptions
+from app.models import storage
+from app.routers.compile import build_pdf
+from app.routers.preprocess import options_key_for, preprocess_upload
+from app.routers.uploads import store_upload
+from app.services import task_queue
+from app.services.artifact_store import store
+from app.services.job_status import status_writer
+from app.services.task_queue import RetryableError
+from app.services.image_preprocess import encode_processed
+from app.services.ocr_to_latex import convert_image_bytes_to_latex
+from app.services.segmentation import convert_segmented
+
+
+router = APIRouter(prefix="/api", tags=["pipeline"])
+
+
+def run_pipeline(job_id: str, request: PipelineRequest):
+    """Runs preprocessing, conversion and compilation in one pass.
+
+    The preprocessed image is encoded in memory and handed straight to the
+    OCR request; it is only written to disk when the request asks for
+    intermediate artifacts.
+
+    Args:
+        job_id: The ID of the job.
+        request: The pipeline options.
+    """
+    db = SessionLocal()
+    job = db.query(job_model.Job).filter(job_model.Job.job_id == job_id).first()
+    if not job:
+        db.close()
+        return
+
+    previous_status = job.status
+    status_writer.update(job_id, status="preprocessing")
+
+    try:
+        options, processed_id, image = preprocess_upload(db, job, request.options)
+        if processed_id is not None:
+            encoded, mime_type = store.read_bytes("processed", processed_id), None
+        else:
+            encoded, mime_type = encode_processed(image, options)
+            if request.persist_intermediates:
+                processed_id = str(uuid.uuid4())
+                store.write_bytes("processed", processed_id, encoded)
+        job.processed_id = processed_id
+        job.preprocess_options = options_key_for(options)
+        status_writer.update(job_id, status="converting")
+
+        latex = None
+        if request.segment:
+            page = cv2.imdecode(np.frombuffer(encoded, np.uint8), cv2.IMREAD_UNCHANGED)
+            latex = convert_segmented(page, use_cache=not request.bypass_cache)
+        if latex is None:
+            latex = convert_image_bytes_to_latex(
+                encoded, mime_type, use_cache=not request.bypass_cache
+            )
+        latex_id = str(uuid.uuid4())
+        store.write_text("latex", latex_id, latex)
+        job.latex_id = latex_id
+        status_writer.update(job_id, status="compiling")
+
+        job.pdf_id = build_pdf(latex_id, job_id)
+        job.status = "complete"
+    except RetryableError as e:
+        # Leave the job as it was; the task queue retries the pipeline.
+        job.status = previous_status
+        job.error_message = str(e)
+        raise
+    except Exception as e:
+        job.status = "failed"
+        job.error_message = str(e)
+    finally:
+        status_writer.settle(job)
+        db.commit()
+        db.close()
+
+
+@router.post("/pipeline/{job_id}", response_model=JobResponse)
+def run_job_pipeline(
+    job_id: str, body: PipelineRequest, db: Session = Depends(get_db)
+) -> JobResponse:
+    """Runs the whole pipeline for an uploaded image.
+
+    Args:
+        job_id: The ID of the job.
+        body: The pipeline options.
+        db: The database session.
+
+    Returns:
+        A JobResponse containing the job_id of the job.
+    """
+    storage.ensure_dirs()
+    job = db.query(job_model.Job).filter(job_model.Job.job_id == job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="jobId not found")
+    task_queue.enqueue(db, job_id, "pipeline", {"request": body.dict()})
+    return JobResponse(job_id=job_id)
+
+
+@router.post("/pipeline", response_model=JobResponse)
+async def upload_and_run_pipeline(
+    file: UploadFile = File(...),
+    options: str = Form("{}"),
+    persist_intermediates: bool = Form(False),
+    segment: bool = Form(False),
+    db: Session = Depends(get_db),
+) -> JobResponse:
+    """Uploads an image and runs the whole pipeline on it.
+
+    Args:
+        file: The image file to upload.
+        options: The preprocessing options, as JSON.
+        persist_intermediates: Whether to keep the preprocessed image on disk.
+        segment: Whether to convert the page block by block.
+        db: The database session.
+
+    Returns:
+        A JobResponse containing the job_id of the new job.
+    """
+    storage.ensure_dirs()
+    try:
+        request = PipelineRequest(
+            options=PreprocessOptions(**json.loads(options)),
+            persist_intermediates=persist_intermediates,
+            segment=segment,
+        )
+    except (ValueError, TypeError, ValidationError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid options: {e}")
+
+    upload = await store_upload(file, db)
+    job_id = str(uuid.uuid4())
+    db.add(
+        job_model.Job(
+            job_id=job_id,
+            status="uploaded",
+            upload_id=upload.upload_id,
+            upload_hash=upload.sha256,
+            image_width=upload.width,
+            image_height=upload.height,
+            name=file.filename,
+        )
+    )
+    task_queue.enqueue(db, job_id, "pipeline", {"request": request.dict()}, commit=False)
+    db.commit()
+    return JobResponse(job_id=job_id)
@@ -1,25 +1,111 @@
 """This module defines the API endpoints for preprocessing images."""
 
+import json
 import uuid
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
+from typing import Optional, Tuple
+import cv2
+import numpy as np
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.orm import Session
 
-from app.database import SessionLocal
+from app.database import SessionLocal, get_db
 from app.models import job as job_model
 from app.models.schemas import PreprocessOptions, JobResponse
 from app.models import storage
-from app.services.image_preprocess import apply_preprocessing
+from app.services import task_queue
+from app.services.artifact_store import store
+from app.services.job_status import status_writer
+from app.services.task_queue import RetryableError
+from app.services.image_info import ImageTooLargeError
+from app.services.image_preprocess import (
+    apply_preprocessing,
+    choose_options,
+    decode_image,
+    encode_processed,
+)
+from app.services.preview_cache import preview_cache
 
 
 router = APIRouter(prefix="/api", tags=["preprocess"])
 
+# Preview encodings: file extension, media type and encoder parameters.
+# The lossy formats are much faster to encode than PNG at display sizes.
+PREVIEW_FORMATS = {
+    "jpeg": (".jpg", "image/jpeg", [cv2.IMWRITE_JPEG_QUALITY, 85]),
+    "webp": (".webp", "image/webp", [cv2.IMWRITE_WEBP_QUALITY, 80]),
+    "png": (".png", "image/png", [cv2.IMWRITE_PNG_COMPRESSION, 1]),
+}
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+
+def options_key_for(options: PreprocessOptions) -> str:
+    """Returns the canonical form of preprocessing options stored on a job."""
+    return json.dumps(options.dict(), sort_keys=True)
+
+
+def reusable_processed_id(
+    db: Session, job: job_model.Job, options_key: str
+) -> Optional[str]:
+    """Finds a processed image of the same upload made with the same options.
+
+    Args:
+        db: The database session.
+        job: The job to preprocess.
+        options_key: The canonical preprocessing options.
+
+    Returns:
+        The processed_id of another job's matching image, or None.
+    """
+    donor = (
+        db.query(job_model.Job.processed_id)
+        .filter(
+            job_model.Job.upload_id == job.upload_id,
+            job_model.Job.preprocess_options == options_key,
+            job_model.Job.processed_id.isnot(None),
+            job_model.Job.job_id != job.job_id,
+        )
+        .first()
+    )
+    if donor and store.exists("processed", donor.processed_id):
+        return donor.processed_id
+    return None
+
+
+def preprocess_upload(
+    db: Session, job: job_model.Job, options: PreprocessOptions
+) -> Tuple[PreprocessOptions, Optional[str], Optional[np.ndarray]]:
+    """Resolves the options for a job and reuses or makes its processed image.
+
+    Auto options are resolved before looking for a reusable image, so jobs
+    record, and share images by, the options that were actually applied.
+
+    Args:
+        db: The database session.
+        job: The job to preprocess.
+        options: The requested preprocessing options.
+
+    Returns:
+        The resolved options and either the processed_id of a reusable
+        image or the newly preprocessed image.
+
+    Raises:
+        FileNotFoundError: If the upload is missing.
+    """
+    image = None
+    if options.auto:
+        if not store.exists("upload", job.upload_id):
+            raise FileNotFoundError("Uploaded image not found.")
+        with store.local_path("upload", job.upload_id) as src:
+            image = decode_image(src)
+        options = choose_options(image, options)
+    processed_id = reusable_processed_id(db, job, options_key_for(options))
+    if processed_id is not None:
+        return options, processed_id, None
+    if image is None:
+        if not store.exists("upload", job.upload_id):
+            raise FileNotFoundError("Uploaded image not found.")
+        with store.local_path("upload", job.upload_id) as src:
+            image = decode_image(src)
+    return options, None, apply_preprocessing(image, options)
 
 
 def run_preprocessing(job_id: str, options: PreprocessOptions):
@@ -35,22 +121,29 @@ def run_preprocessing(job_id: str, options: PreprocessOptions):
         db.close()
         return
 
-    job.status = "preprocessing"
-    db.commit()
+    previous_status = job.status
+    status_writer.update(job_id, status="preprocessing")
 
     try:
-        src = storage.path_for_upload(job.upload_id)
-        if not src.exists():
+        if not store.exists("upload", job.upload_id):
             raise FileNotFoundError("Uploaded image not found.")
-        processed_id = str(uuid.uuid4())
-        dst = storage.path_for_processed(processed_id)
-        apply_preprocessing(src, options, dst)
+        options, processed_id, image = preprocess_upload(db, job, options)
+        if processed_id is None:
+            processed_id = str(uuid.uuid4())
+            store.write_bytes("processed", processed_id, encode_processed(image, options)[0])
         job.processed_id = processed_id
+        job.preprocess_options = options_key_for(options)
         job.status = "ready to convert"
+    except RetryableError as e:
+        # Leave the job as it was; the task queue retries the stage.
+        job.status = previous_status
+        job.error_message = str(e)
+        raise
     except Exception as e:
         job.status = "failed"
         job.error_message = str(e)
     finally:
+        status_writer.settle(job)
         db.commit()
         db.close()
 
@@ -59,7 +152,6 @@ def run_preprocessing(job_id: str, options: PreprocessOptions):
 def preprocess_image(
     job_id: str,
     body: PreprocessOptions,
-    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
 ) -> JobResponse:
     """Applies preprocessing to an uploaded image.
@@ -67,7 +159,6 @@ def preprocess_image(
     Args:
         job_id: The ID of the job.
         body: The request body, containing the preprocessing options.
-        background_tasks: The background tasks manager.
         db: The database session.
 
     Returns:
@@ -77,7 +168,7 @@ def preprocess_image(
     job = db.query(job_model.Job).filter(job_model.Job.job_id == job_id).first()
     if not job:
         raise HTTPException(status_code=404, detail="jobId not found")
-    background_tasks.add_task(run_preprocessing, job_id, body)
+    task_queue.enqueue(db, job_id, "preprocess", {"options": body.dict()})
     return JobResponse(job_id=job_id)
 
 
@@ -85,40 +176,57 @@ def preprocess_image(
 def preview_image(
     job_id: str,
     body: PreprocessOptions,
+    max_width: int = 1024,
+    max_height: int = 1024,
+    fmt: str = Query("jpeg", alias="format"),
     db: Session = Depends(get_db),
 ):
     """Generates a preview of the preprocessed image.
 
+    The upload is decoded at reduced resolution and the result is scaled
+    to fit within ``max_width`` x ``max_height``.
+
     Args:
         job_id: The ID of the job.
         body: The preprocessing options.
+        max_width: The maximum width of the preview in pixels.
+        max_height: The maximum height of the preview in pixels.
+        fmt: The preview encoding, one of "jpeg", "webp" or "png".
         db: The database session.
 
     Returns:
         A StreamingResponse containing the preprocessed image.
     """
-    import cv2
     import io
     from fastapi.responses import StreamingResponse
 
+    if fmt not in PREVIEW_FORMATS:
+        raise HTTPException(status_code=400, detail="Unsupported preview format")
+    if max_width <= 0 or max_height <= 0:
+        raise HTTPException(status_code=400, detail="Invalid preview size")
+
     storage.ensure_dirs()
     job = db.query(job_model.Job).filter(job_model.Job.job_id == job_id).first()
     if not job:
         raise HTTPException(status_code=404, detail="jobId not found")
 
-    src = storage.path_for_upload(job.upload_id)
-    if not src.exists():
+    if not store.exists("upload", job.upload_id):
         raise HTTPException(status_code=404, detail="Uploaded image not found")
 
-    # Apply preprocessing in memory
+    # Apply preprocessing in memory, reusing cached stages of earlier previews
     try:
-        processed_image = apply_preprocessing(src, body, dst_path=None)
+        with store.local_path("upload", job.upload_id) as src:
+            processed_image = preview_cache.render(
+                job_id, src, body, viewport=(max_width, max_height)
+            )
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-    # Encode image to PNG
-    success, encoded_image = cv2.imencode(".png", processed_image)
+    ext, media_type, params = PREVIEW_FORMATS[fmt]
+    success, encoded_image = cv2.imencode(ext, processed_image, params)
     if not success:
         raise HTTPException(status_code=500, detail="Failed to encode image")
 
-    return StreamingResponse(io.BytesIO(encoded_image.tobytes()), media_type="image/png")
+    return StreamingResponse(io.BytesIO(encoded_image.tobytes()), media_type=media_type)
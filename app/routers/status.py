@@ -1,23 +1,32 @@
 """This module defines the API endpoints for checking the status of a job."""
 
-from typing import List
-from fastapi import APIRouter, Depends, HTTPException
+import asyncio
+import base64
+import json
+from typing import List, Optional, Tuple
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
-from app.database import SessionLocal
+from app.database import SessionLocal, get_db
 from app.models import job as job_model
-from app.models.schemas import Job
+from app.models.schemas import Job, StatusResponse
+from app.services import lifecycle
+from app.services.events import event_bus
 
 
 router = APIRouter(prefix="/api", tags=["status"])
 
+# Seconds between keep-alive comments on idle status streams.
+STREAM_KEEPALIVE_SECONDS = 15.0
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# Page sizes for the job listing.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# The columns returned by the job listing, selected without building ORM objects.
+_JOB_COLUMNS = [getattr(job_model.Job, field) for field in Job.__fields__]
 
 
 @router.get("/status/{job_id}", response_model=Job)
@@ -37,22 +46,146 @@ def get_status(job_id: str, db: Session = Depends(get_db)) -> Job:
     return job
 
 
+def _current_status(job_id: str) -> Optional[StatusResponse]:
+    db = SessionLocal()
+    try:
+        job = db.query(job_model.Job).filter(job_model.Job.job_id == job_id).first()
+        if not job:
+            return None
+        return StatusResponse(
+            job_id=job_id,
+            state=job.status,
+            progress=job.progress or job_model.STATUS_PROGRESS.get(job.status, 0),
+            error=job.error_message,
+        )
+    finally:
+        db.close()
+
+
+@router.get("/status/{job_id}/events")
+async def stream_status(job_id: str, request: Request):
+    """Streams the status of a job as Server-Sent Events.
+
+    The current status is sent first, followed by every stage transition,
+    progress update and error until the client disconnects.
+
+    Args:
+        job_id: The ID of the job to follow.
+        request: The incoming request, used to detect disconnects.
+
+    Returns:
+        A text/event-stream StreamingResponse of StatusResponse objects.
+    """
+    # The query runs in the threadpool so it does not block the event loop.
+    current = await run_in_threadpool(_current_status, job_id)
+    if current is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    queue = event_bus.subscribe(job_id)
+
+    async def events():
+        try:
+            yield f"event: status\ndata: {current.json()}\n\n"
+            while not await request.is_disconnected():
+                try:
+                    status = await asyncio.wait_for(queue.get(), STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: status\ndata: {status.json()}\n\n"
+        finally:
+            event_bus.unsubscribe(job_id, queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _encode_cursor(created_at: Optional[float], job_id: str) -> str:
+    raw = json.dumps([created_at or 0.0, job_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> Tuple[float, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, job_id = json.loads(raw)
+        return float(created_at), str(job_id)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from e
+
+
 @router.get("/jobs", response_model=List[Job])
-def get_jobs(db: Session = Depends(get_db)) -> List[Job]:
-    """Gets all jobs.
+def get_jobs(
+    response: Response,
+    status: Optional[str] = None,
+    name_prefix: Optional[str] = None,
+    created_after: Optional[float] = None,
+    created_before: Optional[float] = None,
+    order: str = Query("desc", regex="^(asc|desc)$"),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+) -> List[Job]:
+    """Gets a page of jobs, ordered by creation time.
+
+    When more jobs match, the ``X-Next-Cursor`` response header holds the
+    cursor of the next page.
 
     Args:
+        response: The response, used to set the next-page cursor.
+        status: Only return jobs with this status.
+        name_prefix: Only return jobs whose name starts with this prefix.
+        created_after: Only return jobs created at or after this Unix time.
+        created_before: Only return jobs created before this Unix time.
+        order: "desc" for newest first, "asc" for oldest first.
+        limit: The maximum number of jobs to return.
+        cursor: The ``X-Next-Cursor`` of the previous page.
         db: The database session.
 
     Returns:
-        A list of all jobs.
+        A list of jobs.
     """
-    return db.query(job_model.Job).all()
+    jobs = job_model.Job
+    query = db.query(*_JOB_COLUMNS)
+    if status is not None:
+        query = query.filter(jobs.status == status)
+    if name_prefix:
+        # A range instead of LIKE, so the name index can be used.
+        query = query.filter(jobs.name >= name_prefix, jobs.name < name_prefix + "\uffff")
+    if created_after is not None:
+        query = query.filter(jobs.created_at >= created_after)
+    if created_before is not None:
+        query = query.filter(jobs.created_at < created_before)
+    if cursor:
+        created_at, job_id = _decode_cursor(cursor)
+        if order == "desc":
+            query = query.filter(
+                (jobs.created_at < created_at)
+                | ((jobs.created_at == created_at) & (jobs.job_id < job_id))
+            )
+        else:
+            query = query.filter(
+                (jobs.created_at > created_at)
+                | ((jobs.created_at == created_at) & (jobs.job_id > job_id))
+            )
+    if order == "desc":
+        query = query.order_by(jobs.created_at.desc(), jobs.job_id.desc())
+    else:
+        query = query.order_by(jobs.created_at.asc(), jobs.job_id.asc())
+
+    rows = query.limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = _encode_cursor(rows[-1].created_at, rows[-1].job_id)
+    return [row._asdict() for row in rows]
 
 
 @router.delete("/jobs/{job_id}")
 def delete_job(job_id: str, db: Session = Depends(get_db)):
-    """Deletes a job.
+    """Deletes a job and its stored artifacts.
 
     Args:
         job_id: The ID of the job to delete.
@@ -64,6 +197,5 @@ def delete_job(job_id: str, db: Session = Depends(get_db)):
     job = db.query(job_model.Job).filter(job_model.Job.job_id == job_id).first()
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
-    db.delete(job)
-    db.commit()
+    lifecycle.delete_job(db, job)
     return {"message": "Job deleted successfully"}
@@ -1,24 +1,95 @@
 """This module defines the API endpoints for uploading images."""
 
+import hashlib
+import os
 import uuid
+from typing import NamedTuple
 from fastapi import APIRouter, UploadFile, File, Depends, HTTPException
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 
-from app.database import SessionLocal
+from app.database import get_db
 from app.models import job as job_model
 from app.models.schemas import JobResponse
 from app.models import storage
+from app.services.artifact_store import file_response, retain_upload
+from app.services.image_info import (
+    SNIFF_BYTES, ImageTooLargeError, check_image_size, sniff_image_size
+)
 
 
 router = APIRouter(prefix="/api", tags=["uploads"])
 
+# Uploads are streamed to disk in chunks of this size.
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+# Uploads larger than this are rejected.
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
 
-def get_db():
-    db = SessionLocal()
+
+class StoredUpload(NamedTuple):
+    """An uploaded image written to the artifact store."""
+
+    upload_id: str
+    sha256: str
+    size: int
+    width: int
+    height: int
+
+
+async def store_upload(file: UploadFile, db: Session) -> StoredUpload:
+    """Validates an uploaded image and streams it to the artifact store.
+
+    The file is read in fixed-size chunks into a temporary file that is
+    renamed into place once complete, so memory use does not grow with the
+    upload size. The content hash and the image dimensions are computed
+    while streaming. Uploads are stored by content hash, so identical
+    images share one reference-counted file.
+
+    Args:
+        file: The uploaded image file.
+        db: The database session.
+
+    Returns:
+        The stored upload.
+    """
+    if not file.content_type or not file.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="Only image uploads are supported")
+
+    partial = storage.STAGING_DIR / f".{uuid.uuid4()}.part"
+    digest = hashlib.sha256()
+    size = 0
+    header = b""
+    info = None
     try:
-        yield db
+        with open(partial, "wb") as out:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail="Upload is too large")
+                digest.update(chunk)
+                if info is None and len(header) < SNIFF_BYTES:
+                    header += chunk[: SNIFF_BYTES - len(header)]
+                    info = sniff_image_size(header)
+                await run_in_threadpool(out.write, chunk)
+
+        # Trust the file's header, not the client's content type.
+        if info is None:
+            raise HTTPException(status_code=415, detail="Unsupported image format")
+        # Refuse decompression bombs before they reach the pipeline.
+        try:
+            check_image_size(info[1], info[2])
+        except ImageTooLargeError as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        sha256 = digest.hexdigest()
+        upload_id = storage.upload_id_for(sha256, info[0])
+        # Storing may mean an upload to a remote backend; keep it off the loop.
+        await run_in_threadpool(retain_upload, db, upload_id, sha256, partial)
     finally:
-        db.close()
+        partial.unlink(missing_ok=True)
+    return StoredUpload(upload_id, sha256, size, info[1], info[2])
 
 
 @router.post("/uploads", response_model=JobResponse)
@@ -35,14 +106,16 @@ async def upload_image(
         A JobResponse containing the job_id of the new job.
     """
     storage.ensure_dirs()
-    if not file.content_type or not file.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="Only image uploads are supported")
-    upload_id = f"{uuid.uuid4()}_{file.filename}"
-    dest = storage.path_for_upload(upload_id)
-    dest.write_bytes(await file.read())
+    upload = await store_upload(file, db)
     job_id = str(uuid.uuid4())
     job = job_model.Job(
-        job_id=job_id, status="uploaded", upload_id=upload_id, name=file.filename
+        job_id=job_id,
+        status="uploaded",
+        upload_id=upload.upload_id,
+        upload_hash=upload.sha256,
+        image_width=upload.width,
+        image_height=upload.height,
+        name=file.filename,
     )
     db.add(job)
     db.commit()
@@ -59,17 +132,14 @@ def get_uploaded_image(job_id: str, db: Session = Depends(get_db)):
         db: The database session.
 
     Returns:
-        A FileResponse containing the uploaded image.
+        A response streaming the uploaded image.
     """
-    from fastapi.responses import FileResponse
-
     storage.ensure_dirs()
     job = db.query(job_model.Job).filter(job_model.Job.job_id == job_id).first()
     if not job:
         raise HTTPException(status_code=404, detail="jobId not found")
 
-    path = storage.path_for_upload(job.upload_id)
-    if not path.exists():
+    try:
+        return file_response("upload", job.upload_id)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Image not found")
-
-    return FileResponse(path)
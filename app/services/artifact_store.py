@@ -0,0 +1,505 @@
+"""This module stores job artifacts behind a pluggable backend.
+
+Artifacts are addressed by kind ("upload", "processed", "latex", "pdf")
+and key. ``STORAGE_BACKEND`` selects where they live:
+
+* ``local`` keeps them under ``DATA_DIR``, sharded into subdirectories by
+  a hash prefix of the key so no directory grows past a few thousand
+  entries. Writes go to a temporary file that is renamed into place.
+  Artifacts written before sharding are still found in the flat layout.
+* ``s3`` keeps them in an S3-compatible bucket (``S3_ENDPOINT_URL``
+  points at MinIO or another stand-in). Reads and writes stream, and
+  immutable artifacts needed as local files are kept in a bounded
+  read-through cache.
+
+Services that need a filesystem path, like OpenCV and pdflatex, use
+``local_path``; file endpoints use ``file_response``, which serves local
+files directly and streams remote ones.
+"""
+
+import hashlib
+import mimetypes
+import os
+import shutil
+import tempfile
+import uuid
+from contextlib import closing, contextmanager
+from pathlib import Path
+from typing import Any, BinaryIO, ContextManager, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from fastapi.responses import FileResponse, StreamingResponse
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from starlette.responses import Response
+
+from app.models import storage
+from app.models.blob import Blob
+from app.services.cache import DiskCache
+
+
+# "local" or "s3".
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+# Levels of two-hex-digit shard directories below each artifact directory.
+# Changing it strands artifacts written with the previous depth.
+STORAGE_SHARD_DEPTH = int(os.getenv("STORAGE_SHARD_DEPTH", "2"))
+# Bucket, key prefix and endpoint of the S3 backend. Credentials come from
+# the usual AWS environment variables or config files.
+S3_BUCKET = os.getenv("S3_BUCKET", "")
+S3_PREFIX = os.getenv("S3_PREFIX", "")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+# Size bound of the local cache of remote artifacts in bytes.
+REMOTE_CACHE_MAX_BYTES = int(os.getenv("REMOTE_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# Per kind: the directory (or key prefix) and the file suffix.
+KINDS: Dict[str, Tuple[str, str]] = {
+    "upload": ("uploads", ""),
+    "processed": ("processed", ""),
+    "latex": ("latex", ".tex"),
+    "pdf": ("pdf", ".pdf"),
+}
+# Suffixes artifacts were stored with before, still found by reads.
+# Processed images may now be PNG or WebP, so they no longer carry one.
+_LEGACY_SUFFIXES = {"processed": ".png"}
+# Kinds whose content never changes once written, so copies can be cached.
+IMMUTABLE_KINDS = {"upload", "processed", "pdf"}
+
+_CHUNK_BYTES = 1024 * 1024
+
+
+class StoredObject(NamedTuple):
+    """A stored file found by ``ArtifactStore.scan``."""
+
+    name: str
+    key: Optional[str]
+    modified: float
+    size: int
+
+
+def _shards(key: str, depth: int) -> List[str]:
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return [digest[2 * level: 2 * level + 2] for level in range(depth)]
+
+
+def _key_of(kind: str, filename: str) -> Optional[str]:
+    """Returns the key a file name stores, or None for a foreign file."""
+    suffix = KINDS[kind][1]
+    legacy = _LEGACY_SUFFIXES.get(kind, suffix)
+    if filename.startswith("."):
+        return None
+    if legacy and filename.endswith(legacy):
+        return filename[: -len(legacy)]
+    if filename.endswith(suffix):
+        return filename[: len(filename) - len(suffix)]
+    return None
+
+
+class ArtifactStore:
+    """The interface of an artifact backend.
+
+    Reads raise FileNotFoundError for missing artifacts.
+    """
+
+    local = False
+
+    def open(self, kind: str, key: str) -> BinaryIO:
+        """Opens an artifact for streaming reads."""
+        raise NotImplementedError
+
+    def writer(self, kind: str, key: str) -> ContextManager[BinaryIO]:
+        """Returns a context yielding a file that replaces the artifact on success."""
+        raise NotImplementedError
+
+    def put_file(self, kind: str, key: str, src: Path, move: bool = False) -> None:
+        """Stores a local file as an artifact, consuming it if ``move``."""
+        raise NotImplementedError
+
+    def exists(self, kind: str, key: str) -> bool:
+        """Returns whether an artifact exists."""
+        raise NotImplementedError
+
+    def delete(self, kind: str, key: str) -> int:
+        """Deletes an artifact if present and returns the bytes freed."""
+        raise NotImplementedError
+
+    def local_file(self, kind: str, key: str) -> Optional[Path]:
+        """Returns the artifact's path if it is a file on this host."""
+        return None
+
+    def local_path(self, kind: str, key: str) -> ContextManager[Path]:
+        """Returns a context yielding a local file with the artifact's content.
+
+        The file must be treated as read-only and may be gone once the
+        block exits.
+        """
+        raise NotImplementedError
+
+    def scan(self, kind: str) -> Iterator[StoredObject]:
+        """Yields every stored file of a kind, including foreign ones."""
+        raise NotImplementedError
+
+    def remove(self, kind: str, name: str) -> None:
+        """Removes a file found by ``scan``."""
+        raise NotImplementedError
+
+    def read_bytes(self, kind: str, key: str) -> bytes:
+        """Returns the content of an artifact."""
+        with closing(self.open(kind, key)) as stream:
+            return stream.read()
+
+    def read_text(self, kind: str, key: str) -> str:
+        """Returns the content of a text artifact."""
+        return self.read_bytes(kind, key).decode("utf-8")
+
+    def write_bytes(self, kind: str, key: str, data: bytes) -> None:
+        """Replaces an artifact with ``data``."""
+        with self.writer(kind, key) as out:
+            out.write(data)
+
+    def write_text(self, kind: str, key: str, text: str) -> None:
+        """Replaces a text artifact with ``text``."""
+        self.write_bytes(kind, key, text.encode("utf-8"))
+
+    def iter_bytes(self, kind: str, key: str) -> Iterator[bytes]:
+        """Yields the content of an artifact in chunks."""
+        return _iter_stream(self.open(kind, key))
+
+    def usage(self) -> int:
+        """Returns the bytes held by all artifacts."""
+        return sum(obj.size for kind in KINDS for obj in self.scan(kind))
+
+
+def _iter_stream(stream: BinaryIO) -> Iterator[bytes]:
+    try:
+        while True:
+            chunk = stream.read(_CHUNK_BYTES)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        stream.close()
+
+
+class LocalArtifactStore(ArtifactStore):
+    """Stores artifacts on the local disk in hash-sharded directories."""
+
+    local = True
+
+    def __init__(self, root: Path, shard_depth: int = STORAGE_SHARD_DEPTH) -> None:
+        self.root = root
+        self.shard_depth = shard_depth
+
+    def path_for(self, kind: str, key: str) -> Path:
+        """Returns the sharded path of an artifact."""
+        directory, suffix = KINDS[kind]
+        return self.root.joinpath(directory, *_shards(key, self.shard_depth), key + suffix)
+
+    def _candidates(self, kind: str, key: str) -> List[Path]:
+        """Returns the current path of an artifact, then its legacy ones."""
+        directory, suffix = KINDS[kind]
+        legacy = _LEGACY_SUFFIXES.get(kind, suffix)
+        path = self.path_for(kind, key)
+        paths = [path]
+        if legacy != suffix:
+            paths.append(path.with_name(key + legacy))
+        paths.append(self.root / directory / f"{key}{legacy}")
+        return paths
+
+    def _find(self, kind: str, key: str) -> Optional[Path]:
+        for path in self._candidates(kind, key):
+            if path.is_file():
+                return path
+        return None
+
+    def open(self, kind: str, key: str) -> BinaryIO:
+        path = self._find(kind, key)
+        if path is None:
+            raise FileNotFoundError(f"{kind} {key} not found")
+        return open(path, "rb")
+
+    @contextmanager
+    def writer(self, kind: str, key: str) -> Iterator[BinaryIO]:
+        path = self.path_for(kind, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        staged = path.parent / f".{uuid.uuid4().hex}.part"
+        try:
+            with open(staged, "wb") as out:
+                yield out
+            self._commit(kind, key, staged)
+        finally:
+            staged.unlink(missing_ok=True)
+
+    def put_file(self, kind: str, key: str, src: Path, move: bool = False) -> None:
+        path = self.path_for(kind, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        staged = path.parent / f".{uuid.uuid4().hex}.part"
+        try:
+            if move:
+                try:
+                    os.replace(src, staged)
+                except OSError:
+                    shutil.copyfile(src, staged)
+                    src.unlink()
+            else:
+                try:
+                    os.link(src, staged)
+                except OSError:
+                    shutil.copyfile(src, staged)
+            self._commit(kind, key, staged)
+        finally:
+            staged.unlink(missing_ok=True)
+
+    def _commit(self, kind: str, key: str, staged: Path) -> None:
+        os.replace(staged, self.path_for(kind, key))
+        # A legacy copy would shadow nothing but waste space.
+        for path in self._candidates(kind, key)[1:]:
+            path.unlink(missing_ok=True)
+
+    def exists(self, kind: str, key: str) -> bool:
+        return self._find(kind, key) is not None
+
+    def delete(self, kind: str, key: str) -> int:
+        freed = 0
+        for path in self._candidates(kind, key):
+            try:
+                stat = path.stat()
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            # A file still linked elsewhere, e.g. into the PDF cache, frees nothing.
+            if stat.st_nlink == 1:
+                freed += stat.st_size
+        return freed
+
+    def local_file(self, kind: str, key: str) -> Optional[Path]:
+        return self._find(kind, key)
+
+    @contextmanager
+    def local_path(self, kind: str, key: str) -> Iterator[Path]:
+        path = self._find(kind, key)
+        if path is None:
+            raise FileNotFoundError(f"{kind} {key} not found")
+        yield path
+
+    def scan(self, kind: str) -> Iterator[StoredObject]:
+        base = self.root / KINDS[kind][0]
+        for directory, _, filenames in os.walk(base):
+            for filename in filenames:
+                path = Path(directory) / filename
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                yield StoredObject(
+                    str(path.relative_to(base)), _key_of(kind, filename), stat.st_mtime,
+                    stat.st_size,
+                )
+
+    def remove(self, kind: str, name: str) -> None:
+        (self.root / KINDS[kind][0] / name).unlink(missing_ok=True)
+
+
+class S3ArtifactStore(ArtifactStore):
+    """Stores artifacts in an S3-compatible bucket.
+
+    Requires ``boto3``.
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        endpoint_url: Optional[str] = None,
+        shard_depth: int = STORAGE_SHARD_DEPTH,
+        cache: Optional[DiskCache] = None,
+        client: Any = None,
+    ) -> None:
+        if client is None:
+            try:
+                import boto3
+            except ImportError as e:
+                raise RuntimeError("The s3 storage backend requires boto3") from e
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.shard_depth = shard_depth
+        self.cache = cache
+
+    def object_key(self, kind: str, key: str) -> str:
+        """Returns the object key of an artifact."""
+        directory, suffix = KINDS[kind]
+        shards = "".join(f"{shard}/" for shard in _shards(key, self.shard_depth))
+        return f"{self.prefix}{directory}/{shards}{key}{suffix}"
+
+    @staticmethod
+    def _missing(error: Exception) -> bool:
+        code = getattr(error, "response", {}).get("Error", {}).get("Code")
+        return code in ("404", "NoSuchKey", "NotFound")
+
+    def _candidates(self, kind: str, key: str) -> List[str]:
+        """Returns the current object key of an artifact, then its legacy one."""
+        object_key = self.object_key(kind, key)
+        legacy = _LEGACY_SUFFIXES.get(kind)
+        return [object_key, object_key + legacy] if legacy else [object_key]
+
+    def _head(self, kind: str, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        for object_key in self._candidates(kind, key):
+            try:
+                return object_key, self.client.head_object(Bucket=self.bucket, Key=object_key)
+            except Exception as e:  # pylint: disable=broad-except
+                if not self._missing(e):
+                    raise
+        return None
+
+    def open(self, kind: str, key: str) -> BinaryIO:
+        for object_key in self._candidates(kind, key):
+            try:
+                return self.client.get_object(Bucket=self.bucket, Key=object_key)["Body"]
+            except Exception as e:  # pylint: disable=broad-except
+                if not self._missing(e):
+                    raise
+        raise FileNotFoundError(f"{kind} {key} not found")
+
+    @contextmanager
+    def writer(self, kind: str, key: str) -> Iterator[BinaryIO]:
+        # Small artifacts stay in memory; large ones spill to disk and are
+        # sent as a multipart upload. S3 makes the object visible atomically.
+        with tempfile.SpooledTemporaryFile(max_size=8 * _CHUNK_BYTES) as out:
+            yield out
+            out.seek(0)
+            self.client.upload_fileobj(out, self.bucket, self.object_key(kind, key))
+
+    def put_file(self, kind: str, key: str, src: Path, move: bool = False) -> None:
+        self.client.upload_file(str(src), self.bucket, self.object_key(kind, key))
+        if move:
+            src.unlink(missing_ok=True)
+
+    def exists(self, kind: str, key: str) -> bool:
+        return self._head(kind, key) is not None
+
+    def delete(self, kind: str, key: str) -> int:
+        found = self._head(kind, key)
+        if found is None:
+            return 0
+        object_key, head = found
+        self.client.delete_object(Bucket=self.bucket, Key=object_key)
+        return int(head.get("ContentLength", 0))
+
+    @contextmanager
+    def local_path(self, kind: str, key: str) -> Iterator[Path]:
+        cache_key = DiskCache.key_for(kind, key)
+        if self.cache is not None and kind in IMMUTABLE_KINDS:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                yield cached
+                return
+        storage.STAGING_DIR.mkdir(parents=True, exist_ok=True)
+        staged = storage.STAGING_DIR / f".{uuid.uuid4().hex}{KINDS[kind][1]}"
+        try:
+            with closing(self.open(kind, key)) as stream, open(staged, "wb") as out:
+                shutil.copyfileobj(stream, out, _CHUNK_BYTES)
+            if self.cache is not None and kind in IMMUTABLE_KINDS:
+                self.cache.put_file(cache_key, staged)
+            yield staged
+        finally:
+            staged.unlink(missing_ok=True)
+
+    def scan(self, kind: str) -> Iterator[StoredObject]:
+        base = f"{self.prefix}{KINDS[kind][0]}/"
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=base):
+            for obj in page.get("Contents", []):
+                filename = obj["Key"].rsplit("/", 1)[-1]
+                yield StoredObject(
+                    obj["Key"], _key_of(kind, filename), obj["LastModified"].timestamp(),
+                    int(obj["Size"]),
+                )
+
+    def remove(self, kind: str, name: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=name)
+
+
+def store_from_env() -> ArtifactStore:
+    """Creates the backend selected by ``STORAGE_BACKEND``."""
+    if STORAGE_BACKEND == "local":
+        return LocalArtifactStore(storage.DATA_DIR)
+    if STORAGE_BACKEND == "s3":
+        if not S3_BUCKET:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires S3_BUCKET")
+        cache = DiskCache(
+            storage.CACHE_DIR / "remote", ".blob", max_bytes=REMOTE_CACHE_MAX_BYTES,
+            name="remote",
+        )
+        return S3ArtifactStore(S3_BUCKET, S3_PREFIX, S3_ENDPOINT_URL, cache=cache)
+    raise RuntimeError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}")
+
+
+store = store_from_env()
+
+
+def file_response(kind: str, key: str, media_type: Optional[str] = None) -> Response:
+    """Serves an artifact from whichever backend holds it.
+
+    Raises:
+        FileNotFoundError: If the artifact does not exist.
+    """
+    media_type = media_type or mimetypes.guess_type(key)[0] or "application/octet-stream"
+    path = store.local_file(kind, key)
+    if path is not None:
+        return FileResponse(path, media_type=media_type)
+    return StreamingResponse(store.iter_bytes(kind, key), media_type=media_type)
+
+
+def retain_upload(db: Session, upload_id: str, sha256: str, staged: Path) -> None:
+    """Stores an upload blob and adds a reference to it.
+
+    Identical uploads share one stored file; a second copy is only written
+    if the first has gone missing. The file is stored inside the same write
+    transaction that bumps the reference count, so it cannot race with
+    ``release_upload`` deleting the last reference.
+
+    Args:
+        db: The database session. The change is committed.
+        upload_id: The content-addressed upload_id.
+        sha256: The content hash of the upload.
+        staged: A fully written temporary file with the upload's content.
+    """
+    size = staged.stat().st_size
+    db.execute(
+        insert(Blob)
+        .values(upload_id=upload_id, sha256=sha256, size=size, ref_count=1)
+        .on_conflict_do_update(
+            index_elements=[Blob.upload_id], set_={"ref_count": Blob.ref_count + 1}
+        )
+    )
+    ref_count = db.query(Blob.ref_count).filter(Blob.upload_id == upload_id).scalar()
+    if ref_count == 1 or not store.exists("upload", upload_id):
+        store.put_file("upload", upload_id, staged, move=True)
+    db.commit()
+
+
+def release_upload(db: Session, upload_id: str) -> int:
+    """Drops a reference to an upload blob and deletes it when unused.
+
+    Args:
+        db: The database session. The change is committed.
+        upload_id: The upload_id of the blob.
+
+    Returns:
+        The number of bytes freed.
+    """
+    # The update takes the write lock, serializing this with retain_upload.
+    db.query(Blob).filter(Blob.upload_id == upload_id).update(
+        {Blob.ref_count: Blob.ref_count - 1}, synchronize_session=False
+    )
+    blob = db.query(Blob).filter(Blob.upload_id == upload_id).first()
+    if blob is not None and blob.ref_count > 0:
+        db.commit()
+        return 0
+    # The last reference, or an upload stored before blobs were shared.
+    if blob is not None:
+        db.delete(blob)
+        db.flush()
+    freed = store.delete("upload", upload_id)
+    db.commit()
+    return freed
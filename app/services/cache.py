@@ -0,0 +1,199 @@
+"""This module provides a content-addressed file cache with LRU eviction."""
+
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+from app.services import metrics
+
+
+class DiskCache:
+    """A size-bounded cache of files stored in a single directory.
+
+    Entries are files named ``<key><suffix>``. Recency is kept in the file's
+    access time, so the LRU order survives restarts, and the modification
+    time records when the entry was stored, which is what ``ttl_seconds``
+    is measured against. Caches given a ``name`` export their stats as
+    metrics.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        suffix: str,
+        max_bytes: Optional[int] = None,
+        max_entries: Optional[int] = None,
+        ttl_seconds: Optional[float] = None,
+        name: Optional[str] = None,
+    ) -> None:
+        self.directory = directory
+        self.suffix = suffix
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._index: Optional["OrderedDict[str, int]"] = None
+        self._bytes = 0
+        if name:
+            metrics.register_cache(name, self.stats)
+
+    @staticmethod
+    def key_for(*parts: Union[str, bytes]) -> str:
+        """Returns the cache key for a sequence of strings or byte strings."""
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode("utf-8")
+            digest.update(len(part).to_bytes(8, "big"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def path_for(self, key: str) -> Path:
+        """Returns the path of the file backing a cache entry."""
+        return self.directory / f"{key}{self.suffix}"
+
+    def get(self, key: str) -> Optional[Path]:
+        """Looks up an entry and marks it as recently used.
+
+        Args:
+            key: The cache key.
+
+        Returns:
+            The path of the cached file, or None on a miss.
+        """
+        path = self.path_for(key)
+        with self._lock:
+            index = self._load_index()
+            if key in index:
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    stat = None
+                if stat is not None and not self._expired(stat.st_mtime):
+                    index.move_to_end(key)
+                    os.utime(path, (time.time(), stat.st_mtime))
+                    self.hits += 1
+                    return path
+                self._discard(key)
+            self.misses += 1
+            return None
+
+    def get_text(self, key: str) -> Optional[str]:
+        """Returns the text of a cached entry, or None on a miss."""
+        path = self.get(key)
+        if path is None:
+            return None
+        try:
+            return path.read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return None
+
+    def link(self, key: str, dest: Path) -> bool:
+        """Materializes a cached entry at ``dest``.
+
+        A hard link is used when possible so a hit costs no copy; entries
+        evicted later leave ``dest`` intact.
+
+        Args:
+            key: The cache key.
+            dest: The path to create.
+
+        Returns:
+            True on a hit, False on a miss.
+        """
+        path = self.get(key)
+        if path is None:
+            return False
+        try:
+            _link_or_copy(path, dest)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put_file(self, key: str, src: Path) -> None:
+        """Stores a copy of ``src`` under ``key``."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        staged = self.directory / f".{uuid.uuid4().hex}.tmp"
+        _link_or_copy(src, staged)
+        self._commit(key, staged)
+
+    def put_text(self, key: str, text: str) -> None:
+        """Stores ``text`` under ``key``."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        staged = self.directory / f".{uuid.uuid4().hex}.tmp"
+        staged.write_text(text, encoding="utf-8")
+        self._commit(key, staged)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the hit and miss counters and the current cache size."""
+        with self._lock:
+            index = self._load_index()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(index),
+                "bytes": self._bytes,
+            }
+
+    def _commit(self, key: str, staged: Path) -> None:
+        """Atomically moves a staged file into place and enforces the bounds."""
+        size = staged.stat().st_size
+        with self._lock:
+            index = self._load_index()
+            os.replace(staged, self.path_for(key))
+            self._bytes -= index.pop(key, 0)
+            index[key] = size
+            self._bytes += size
+            self._evict()
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - stored_at > self.ttl_seconds
+
+    def _evict(self) -> None:
+        """Drops least recently used entries until the cache is within bounds."""
+        index = self._index
+        while index and (
+            (self.max_bytes is not None and self._bytes > self.max_bytes)
+            or (self.max_entries is not None and len(index) > self.max_entries)
+        ):
+            self._discard(next(iter(index)))
+
+    def _discard(self, key: str) -> None:
+        self._bytes -= self._index.pop(key, 0)
+        self.path_for(key).unlink(missing_ok=True)
+
+    def _load_index(self) -> "OrderedDict[str, int]":
+        """Builds the in-memory LRU index from the directory on first use."""
+        if self._index is not None:
+            return self._index
+        entries = []
+        if self.directory.exists():
+            for path in self.directory.glob(f"*{self.suffix}"):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                key = path.name[: -len(self.suffix)] if self.suffix else path.name
+                entries.append((stat.st_atime, key, stat.st_size))
+        entries.sort()
+        self._index = OrderedDict((key, size) for _, key, size in entries)
+        self._bytes = sum(size for _, _, size in entries)
+        self._evict()
+        return self._index
+
+
+def _link_or_copy(src: Path, dest: Path) -> None:
+    """Hard-links ``src`` to ``dest``, copying across filesystems."""
+    dest.unlink(missing_ok=True)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
@@ -0,0 +1,114 @@
+"""This module fans job status events out to streaming clients.
+
+Stage runners record status changes as rows in ``job_events`` (see
+``app.models.job_event``). A single relay task in the web process tails
+that table and publishes each event to the in-process subscribers of the
+job, so any number of open status streams cost one query per interval.
+"""
+
+import asyncio
+import os
+import time
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import func
+from starlette.concurrency import run_in_threadpool
+
+from app.database import SessionLocal
+from app.models.job_event import JobEvent
+from app.models.schemas import StatusResponse
+
+
+# How often the relay checks for new events, in seconds.
+EVENT_POLL_SECONDS = float(os.getenv("EVENT_POLL_SECONDS", "0.25"))
+# How long events are kept before the relay deletes them, in seconds.
+EVENT_RETENTION_SECONDS = float(os.getenv("EVENT_RETENTION_SECONDS", "600"))
+# Events buffered per subscriber before the oldest are dropped.
+_QUEUE_SIZE = 100
+
+
+class JobEventBus:
+    """An in-process publish/subscribe hub for job status events."""
+
+    def __init__(self) -> None:
+        self._subscribers: Dict[str, Set["asyncio.Queue[StatusResponse]"]] = {}
+        self._last_event_id: Optional[int] = None
+        self._last_purge = 0.0
+
+    def subscribe(self, job_id: str) -> "asyncio.Queue[StatusResponse]":
+        """Returns a queue that receives the status events of a job."""
+        queue: "asyncio.Queue[StatusResponse]" = asyncio.Queue(_QUEUE_SIZE)
+        self._subscribers.setdefault(job_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, job_id: str, queue: "asyncio.Queue[StatusResponse]") -> None:
+        """Stops delivering events of a job to a queue."""
+        queues = self._subscribers.get(job_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[job_id]
+
+    def publish(self, status: StatusResponse) -> None:
+        """Delivers an event to every subscriber of its job."""
+        for queue in self._subscribers.get(status.job_id, ()):
+            if queue.full():
+                # A slow client only needs the latest state.
+                queue.get_nowait()
+            queue.put_nowait(status)
+
+    async def relay(self) -> None:
+        """Tails the job_events table forever, publishing new events."""
+        while True:
+            try:
+                for status in await run_in_threadpool(self._fetch):
+                    self.publish(status)
+            except Exception:  # pylint: disable=broad-except
+                # A locked or unavailable database only delays delivery.
+                pass
+            await asyncio.sleep(EVENT_POLL_SECONDS)
+
+    def _fetch(self) -> List[StatusResponse]:
+        db = SessionLocal()
+        try:
+            now = time.time()
+            if now - self._last_purge > EVENT_RETENTION_SECONDS / 10:
+                self._last_purge = now
+                db.query(JobEvent).filter(
+                    JobEvent.created_at < now - EVENT_RETENTION_SECONDS
+                ).delete(synchronize_session=False)
+                db.commit()
+            latest = db.query(func.max(JobEvent.event_id)).scalar() or 0
+            if self._last_event_id is None:
+                self._last_event_id = latest
+            elif latest < self._last_event_id:
+                # The purge emptied the table and SQLite reuses rowids from 1,
+                # so every event in the table now is new.
+                self._last_event_id = 0
+            if not self._subscribers:
+                # Nobody is listening; skip ahead without reading the events.
+                self._last_event_id = latest
+                return []
+            rows = (
+                db.query(JobEvent)
+                .filter(JobEvent.event_id > self._last_event_id)
+                .order_by(JobEvent.event_id)
+                .limit(500)
+                .all()
+            )
+            if rows:
+                self._last_event_id = rows[-1].event_id
+            return [
+                StatusResponse(
+                    job_id=row.job_id,
+                    state=row.state,
+                    progress=row.progress or 0,
+                    error=row.error,
+                )
+                for row in rows
+            ]
+        finally:
+            db.close()
+
+
+event_bus = JobEventBus()
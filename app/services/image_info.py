@@ -0,0 +1,114 @@
+"""This module reads image dimensions from file headers without decoding."""
+
+import os
+import struct
+from pathlib import Path
+from typing import Optional, Tuple
+
+# Bytes of a file that are inspected when sniffing its header. Large enough
+# to get past the EXIF block that phone cameras put in front of JPEG frames.
+SNIFF_BYTES = 256 * 1024
+
+# Images with more pixels than this are downsampled or rejected.
+MAX_IMAGE_PIXELS = int(float(os.getenv("MAX_IMAGE_MEGAPIXELS", "50")) * 1_000_000)
+# "downsample" decodes oversized images at reduced scale, "reject" refuses them.
+OVERSIZE_IMAGE_POLICY = os.getenv("OVERSIZE_IMAGE_POLICY", "downsample")
+
+
+class ImageTooLargeError(ValueError):
+    """Raised when an image exceeds the configured pixel ceiling."""
+
+
+def sniff_image_size(header: bytes) -> Optional[Tuple[str, int, int]]:
+    """Reads the format and dimensions of an image from its leading bytes.
+
+    Supports PNG, JPEG, GIF, BMP and WebP.
+
+    Args:
+        header: The first bytes of the image file.
+
+    Returns:
+        A ``(format, width, height)`` tuple, or None if the header is not
+        recognized or too short.
+    """
+    try:
+        if header.startswith(b"\x89PNG\r\n\x1a\n"):
+            width, height = struct.unpack(">II", header[16:24])
+            return "png", width, height
+        if header[:6] in (b"GIF87a", b"GIF89a"):
+            width, height = struct.unpack("<HH", header[6:10])
+            return "gif", width, height
+        if header.startswith(b"BM"):
+            width, height = struct.unpack("<ii", header[18:26])
+            return "bmp", width, abs(height)
+        if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+            return _sniff_webp(header)
+        if header.startswith(b"\xff\xd8"):
+            return _sniff_jpeg(header)
+    except struct.error:
+        return None
+    return None
+
+
+def _sniff_webp(header: bytes) -> Optional[Tuple[str, int, int]]:
+    chunk = header[12:16]
+    if chunk == b"VP8 ":
+        width, height = struct.unpack("<HH", header[26:30])
+        return "webp", width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L":
+        bits = struct.unpack("<I", header[21:25])[0]
+        return "webp", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X":
+        width = int.from_bytes(header[24:27], "little") + 1
+        height = int.from_bytes(header[27:30], "little") + 1
+        return "webp", width, height
+    return None
+
+
+def _sniff_jpeg(header: bytes) -> Optional[Tuple[str, int, int]]:
+    offset = 2
+    while offset + 4 <= len(header):
+        if header[offset] != 0xFF:
+            return None
+        marker = header[offset + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker.
+            offset += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            offset += 2
+            continue
+        length = struct.unpack(">H", header[offset + 2:offset + 4])[0]
+        # Start-of-frame markers carry the image dimensions.
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", header[offset + 5:offset + 9])
+            return "jpeg", width, height
+        offset += 2 + length
+    return None
+
+
+def read_image_size(path: Path) -> Optional[Tuple[str, int, int]]:
+    """Reads the format and dimensions of an image file from its header."""
+    with open(path, "rb") as f:
+        return sniff_image_size(f.read(SNIFF_BYTES))
+
+
+def check_image_size(width: int, height: int) -> None:
+    """Rejects images above the pixel ceiling when the policy says so.
+
+    Args:
+        width: The image width in pixels.
+        height: The image height in pixels.
+
+    Raises:
+        ImageTooLargeError: If the image is too large and cannot be downsampled.
+    """
+    pixels = width * height
+    # Reduced decoding shrinks each side by at most 8x.
+    if pixels > MAX_IMAGE_PIXELS and (
+        OVERSIZE_IMAGE_POLICY == "reject" or pixels > MAX_IMAGE_PIXELS * 64
+    ):
+        raise ImageTooLargeError(
+            f"Image is {width}x{height} ({pixels / 1e6:.1f} MP); "
+            f"the limit is {MAX_IMAGE_PIXELS / 1e6:.1f} MP"
+        )
@@ -1,66 +1,361 @@
 """This module provides a function for applying preprocessing to an image."""
 
+import os
 from pathlib import Path
 import cv2
 
 from app.models.schemas import PreprocessOptions
+from app.services import metrics
+from app.services.image_info import MAX_IMAGE_PIXELS, check_image_size, read_image_size
 
 
-from typing import Optional, Any
+from typing import Callable, Hashable, List, NamedTuple, Optional, Tuple, Union
 import numpy as np
 
-def apply_preprocessing(
-    src_path: Path, options: PreprocessOptions, dst_path: Optional[Path] = None
-) -> Optional[np.ndarray]:
-    """Applies preprocessing to an image.
+# A (max_width, max_height) box that a preview must fit into.
+Viewport = Tuple[int, int]
+
+# Long-edge bounds in pixels for processed images without an explicit
+# resize. The OCR model downsamples large images itself, so pixels above
+# the cap only cost encode time and upload bytes; small crops are scaled up
+# toward the floor, but by no more than OCR_MAX_UPSCALE.
+OCR_LONG_EDGE_MAX = int(os.getenv("OCR_LONG_EDGE_MAX", "2048"))
+OCR_LONG_EDGE_MIN = int(os.getenv("OCR_LONG_EDGE_MIN", "768"))
+OCR_MAX_UPSCALE = float(os.getenv("OCR_MAX_UPSCALE", "2"))
+
+# Encoding of processed images: "png" or "webp" (lossless).
+PROCESSED_FORMAT = os.getenv("PROCESSED_FORMAT", "png")
+# zlib level of processed PNGs, 0-9. Higher levels are slower for little gain.
+PROCESSED_PNG_COMPRESSION = int(os.getenv("PROCESSED_PNG_COMPRESSION", "1"))
+# Whether thresholded images are written as 1-bit PNGs.
+PROCESSED_PNG_BILEVEL = bool(int(os.getenv("PROCESSED_PNG_BILEVEL", "1")))
+
+# Downscale factor of the "nlm_fast" denoising tier.
+NLM_FAST_SCALE = int(os.getenv("NLM_FAST_SCALE", "2"))
+# OpenCV worker threads shared by all concurrently preprocessing threads
+# of this process; defaults to one per core.
+OPENCV_THREAD_BUDGET = int(os.getenv("OPENCV_THREAD_BUDGET", str(os.cpu_count() or 1)))
+
+# Auto mode. All statistics are computed on a strided copy with at most
+# AUTO_SAMPLE_PIXELS pixels; striding, unlike averaging, keeps the
+# per-pixel noise that the denoising choice depends on.
+AUTO_SAMPLE_PIXELS = int(os.getenv("AUTO_SAMPLE_PIXELS", str(512 * 512)))
+# Estimated noise sigma, on the 0-255 scale, above which auto mode denoises.
+AUTO_NOISE_SIGMA = float(os.getenv("AUTO_NOISE_SIGMA", "3"))
+# Otsu separability (0-1) at or above which a global threshold is used.
+AUTO_BIMODALITY = float(os.getenv("AUTO_BIMODALITY", "0.8"))
+# Spread between the 5th and 95th intensity percentiles below which the
+# image is left unthresholded: there is too little ink to separate.
+AUTO_MIN_CONTRAST = float(os.getenv("AUTO_MIN_CONTRAST", "40"))
+# Mean chroma below which a color image is converted to grayscale.
+AUTO_MAX_CHROMA = float(os.getenv("AUTO_MAX_CHROMA", "12"))
+
+# Laplacian-of-differences kernel of Immerkaer's noise estimator. Its
+# response to white noise of sigma s has standard deviation 6s.
+_NOISE_KERNEL = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], dtype=np.float32)
+
+# imread flags that decode at 1/1, 1/2, 1/4 and 1/8 of the original size.
+_REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# A pipeline stage: a hashable key describing the options the stage depends
+# on, and the function that applies it.
+Stage = Tuple[Hashable, Callable[[np.ndarray], np.ndarray]]
+
+
+def _is_gray(image: np.ndarray) -> bool:
+    return len(image.shape) == 2 or (len(image.shape) == 3 and image.shape[2] == 1)
+
+
+def decode_scale(
+    width: int, height: int, viewport: Optional[Viewport] = None
+) -> int:
+    """Returns the factor by which an image can be shrunk while decoding.
+
+    Args:
+        width: The image width in pixels.
+        height: The image height in pixels.
+        viewport: For previews, the box the result is shown in. The image is
+            reduced as far as possible while still covering the box.
+
+    Returns:
+        1, 2, 4 or 8.
+
+    Raises:
+        ImageTooLargeError: If the image exceeds the pixel ceiling and the
+            oversize policy rejects it.
+    """
+    check_image_size(width, height)
+    scale = 1
+    if viewport is not None:
+        fit = min(viewport[0] / width, viewport[1] / height)
+        while scale < 8 and scale * 2 * fit <= 1:
+            scale *= 2
+    # Downsample oversized images until they are within the pixel ceiling.
+    while scale < 8 and width * height > MAX_IMAGE_PIXELS * scale * scale:
+        scale *= 2
+    return scale
+
+
+def decode_image(src_path: Path, viewport: Optional[Viewport] = None) -> np.ndarray:
+    """Loads an image from disk.
 
     Args:
         src_path: The path to the source image.
-        options: The preprocessing options.
-        dst_path: The path to write the preprocessed image to. If None, returns the image.
+        viewport: For previews, the box the result is shown in; the image is
+            decoded at the smallest scale that still covers it.
 
     Returns:
-        The preprocessed image as a numpy array if dst_path is None, else None.
+        The decoded image.
     """
-    # 1. Load the image
-    image = cv2.imread(str(src_path))
+    info = read_image_size(src_path) if src_path.exists() else None
+    scale = decode_scale(info[1], info[2], viewport) if info else 1
+    image = cv2.imread(str(src_path), _REDUCED_FLAGS[scale])
     if image is None:
         raise FileNotFoundError(f"Could not read image from {src_path}")
+    if info is None:
+        # The header was not recognized; enforce the ceiling after decoding.
+        height, width = image.shape[:2]
+        check_image_size(width, height)
+        if width * height > MAX_IMAGE_PIXELS:
+            ratio = (MAX_IMAGE_PIXELS / float(width * height)) ** 0.5
+            image = cv2.resize(
+                image,
+                (max(1, int(width * ratio)), max(1, int(height * ratio))),
+                interpolation=cv2.INTER_AREA,
+            )
+    return image
+
+
+class ImageStats(NamedTuple):
+    """Cheap statistics that auto mode chooses options from."""
+
+    noise_sigma: float
+    bimodality: float
+    otsu_threshold: int
+    contrast: float
+    chroma: float
+
+
+def image_stats(image: np.ndarray) -> ImageStats:
+    """Computes auto-mode statistics of a decoded image.
+
+    Args:
+        image: The decoded image, color or grayscale.
+
+    Returns:
+        The statistics.
+    """
+    height, width = image.shape[:2]
+    step = max(1, int(((width * height) / AUTO_SAMPLE_PIXELS) ** 0.5))
+    sample = np.ascontiguousarray(image[::step, ::step])
+    if _is_gray(sample):
+        gray, chroma = sample.reshape(sample.shape[:2]), 0.0
+    else:
+        gray = cv2.cvtColor(sample, cv2.COLOR_BGR2GRAY)
+        ycrcb = cv2.cvtColor(sample, cv2.COLOR_BGR2YCrCb).astype(np.float32)
+        chroma = float(np.mean(np.hypot(ycrcb[..., 1] - 128, ycrcb[..., 2] - 128)))
+
+    # Neighbouring sample pixels are `step` apart in the image, so the noise in
+    # the sample is as strong as at full resolution; the median keeps the
+    # text edges, which striding makes denser, from dominating.
+    response = cv2.filter2D(gray, cv2.CV_16S, _NOISE_KERNEL)
+    noise_sigma = 1.4826 * float(np.median(np.abs(response[1:-1, 1:-1]))) / 6
+
+    hist = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+    otsu, _ = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    levels = np.arange(256, dtype=np.float64)
+    total = hist.sum()
+    mean = (hist * levels).sum() / total
+    variance = (hist * (levels - mean) ** 2).sum() / total
+    below = hist[: int(otsu) + 1]
+    w0 = below.sum() / total
+    if variance > 0 and 0 < w0 < 1:
+        m0 = (below * levels[: int(otsu) + 1]).sum() / (w0 * total)
+        m1 = (mean - w0 * m0) / (1 - w0)
+        bimodality = w0 * (1 - w0) * (m0 - m1) ** 2 / variance
+    else:
+        bimodality = 0.0
+    low, high = np.percentile(gray, (5, 95))
+    return ImageStats(noise_sigma, float(bimodality), int(otsu), float(high - low), chroma)
+
+
+def choose_options(image: np.ndarray, options: PreprocessOptions) -> PreprocessOptions:
+    """Resolves auto-mode options from the statistics of an image.
+
+    Expensive filters are only chosen when the statistics call for them:
+    images with little noise are not denoised, and cleanly bimodal pages
+    get a global threshold instead of an adaptive one.
+
+    Args:
+        image: The decoded image.
+        options: The requested options. Returned unchanged unless ``auto``.
+
+    Returns:
+        Explicit options with ``auto`` cleared.
+    """
+    if not options.auto:
+        return options
+    stats = image_stats(image)
+    denoise = stats.noise_sigma > AUTO_NOISE_SIGMA
+    threshold, adaptive = None, False
+    if stats.contrast >= AUTO_MIN_CONTRAST:
+        if stats.bimodality >= AUTO_BIMODALITY:
+            threshold = stats.otsu_threshold
+        else:
+            # Uneven lighting or shading: threshold against the local mean.
+            adaptive = True
+    return options.copy(
+        update={
+            "auto": False,
+            "grayscale": stats.chroma < AUTO_MAX_CHROMA or threshold is not None or adaptive,
+            "denoise": denoise,
+            # NLM's filter strength h is best set close to the noise sigma.
+            "denoise_strength": min(20, max(3, round(stats.noise_sigma))) if denoise else 10,
+            # Detail finer than the OCR resize keeps is lost anyway, so large
+            # images take the downscaled tier.
+            "denoise_method": (
+                "nlm_fast"
+                if options.resize is None
+                and max(image.shape[:2]) >= NLM_FAST_SCALE * OCR_LONG_EDGE_MAX
+                else "nlm"
+            ),
+            "threshold": threshold,
+            "adaptive_threshold": adaptive,
+        }
+    )
+
+
+def preprocess_stages(
+    options: PreprocessOptions, viewport: Optional[Viewport] = None
+) -> List[Stage]:
+    """Returns the pipeline stages for a set of preprocessing options.
+
+    Each stage's key only covers the options that stage reads, so two option
+    sets that agree on a prefix of keys produce identical intermediate
+    images up to that point.
 
-    # 2. Apply Grayscale (if requested OR needed for thresholding)
+    Args:
+        options: The preprocessing options.
+        viewport: For previews, the box the result is shown in. The final
+            resize then scales the result to fit the box instead of
+            producing the full-size output.
+
+    Returns:
+        The stages in the order they must be applied.
+    """
     # We convert to grayscale if 'grayscale' is true OR if 'threshold'
     # is set, as thresholding requires a single-channel image.
-    is_gray = False
-    if len(image.shape) == 2 or (len(image.shape) == 3 and image.shape[2] == 1):
-        is_gray = True
-
-    if options.grayscale or (options.threshold is not None) or options.adaptive_threshold:
-        if not is_gray:
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        is_gray = True
-
-    # 3. Apply Denoising (if requested)
-    # This respects the 'denoise: bool = False' default in the schema.
-    if options.denoise:
-        if is_gray:
-            image = cv2.fastNlMeansDenoising(image, None, 10, 7, 21)
-        else:  # Color denoising
-            image = cv2.fastNlMeansDenoisingColored(image, None, 10, 10, 7, 21)
-
-    # 4. Apply Thresholding (if requested)
-    if options.adaptive_threshold and is_gray:
+    needs_gray = (
+        options.grayscale or (options.threshold is not None) or options.adaptive_threshold
+    )
+    resize = (
+        (options.resize.width, options.resize.height) if options.resize else None
+    )
+    gray = (("gray", needs_gray), lambda image: _grayscale(image, needs_gray))
+    denoise = (
+        ("denoise", options.denoise, options.denoise_strength, options.denoise_method),
+        lambda image: _denoise(image, options),
+    )
+    threshold = (
+        ("threshold", options.adaptive_threshold, options.threshold),
+        lambda image: _threshold(image, options),
+    )
+    if viewport is not None:
+        fit = (("fit", resize, viewport), lambda image: _fit(image, resize, viewport))
+        return [gray, denoise, threshold, fit]
+    # Resizing interpolates, so it comes before thresholding; the output of
+    # a thresholded image then only holds 0 and 255 and can be stored as a
+    # 1-bit PNG without losing the gray edges of thin strokes.
+    resized = (("resize", resize), lambda image: _resize(image, options))
+    return [gray, denoise, resized, threshold]
+
+
+def _grayscale(image: np.ndarray, needs_gray: bool) -> np.ndarray:
+    # Apply Grayscale (if requested OR needed for thresholding)
+    if needs_gray and not _is_gray(image):
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
+
+
+def _denoise(image: np.ndarray, options: PreprocessOptions) -> np.ndarray:
+    # Apply Denoising (if requested). The tiers, cheapest first:
+    #   median     3x3 median filter, about a millisecond per megapixel;
+    #              removes speckle and salt-and-pepper noise only.
+    #   bilateral  edge-preserving bilateral filter, tens of milliseconds
+    #              per megapixel.
+    #   nlm_fast   non-local means on a copy downscaled by NLM_FAST_SCALE,
+    #              then upsampled; roughly NLM_FAST_SCALE squared times
+    #              cheaper than nlm, at the cost of fine detail.
+    #   nlm        full-resolution non-local means, up to a second per
+    #              megapixel.
+    if not options.denoise:
+        return image
+    h = options.denoise_strength
+    method = options.denoise_method
+    if method == "median":
+        return cv2.medianBlur(image, 3)
+    if method == "bilateral":
+        return cv2.bilateralFilter(image, 5, 3 * h, 5)
+    if method == "nlm_fast" and NLM_FAST_SCALE > 1:
+        size = (image.shape[1], image.shape[0])
+        small = cv2.resize(
+            image,
+            (max(1, size[0] // NLM_FAST_SCALE), max(1, size[1] // NLM_FAST_SCALE)),
+            interpolation=cv2.INTER_AREA,
+        )
+        # Area averaging already divides the noise by the scale factor.
+        small = _nlm(small, max(1, round(h / NLM_FAST_SCALE)))
+        return cv2.resize(small, size, interpolation=cv2.INTER_CUBIC)
+    return _nlm(image, h)
+
+
+def _nlm(image: np.ndarray, h: int) -> np.ndarray:
+    if _is_gray(image):
+        return cv2.fastNlMeansDenoising(image, None, h, 7, 21)
+    return cv2.fastNlMeansDenoisingColored(image, None, h, h, 7, 21)
+
+
+def configure_threads(concurrency: int) -> int:
+    """Splits the OpenCV thread budget between concurrent preprocessing threads.
+
+    ``cv2.setNumThreads`` is process-wide, so each of ``concurrency``
+    threads running OpenCV at once gets an equal share of the budget
+    instead of every call starting a thread per core.
+
+    Args:
+        concurrency: The threads of this process that may preprocess at once.
+
+    Returns:
+        The number of threads OpenCV now uses per call.
+    """
+    threads = max(1, OPENCV_THREAD_BUDGET // max(1, concurrency))
+    cv2.setNumThreads(threads)
+    return threads
+
+
+def _threshold(image: np.ndarray, options: PreprocessOptions) -> np.ndarray:
+    # Apply Thresholding (if requested)
+    if options.adaptive_threshold and _is_gray(image):
         # Adaptive thresholding for "scanner-like" look
         image = cv2.adaptiveThreshold(
             image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2
         )
     elif options.threshold is not None:
         # Simple binary threshold
-        # Image is guaranteed to be grayscale from step 2.
+        # Image is guaranteed to be grayscale from the grayscale stage.
         _, image = cv2.threshold(image, options.threshold, 255, cv2.THRESH_BINARY)
+    return image
 
-    # 5. Apply Resize
+
+def _resize(image: np.ndarray, options: PreprocessOptions) -> np.ndarray:
+    # Apply Resize
     if options.resize is not None:
-        # 5a. Explicit resize requested (from PreprocessResize)
+        # Explicit resize requested (from PreprocessResize)
         # This will stretch/squash the image to the exact dimensions.
         target_size = (options.resize.width, options.resize.height)
         orig_size = (image.shape[1], image.shape[0])  # (w, h)
@@ -74,28 +369,100 @@ def apply_preprocessing(
 
             image = cv2.resize(image, target_size, interpolation=interpolation)
     else:
-        # 5b. No explicit resize. Use "reasonable defaults" (from prompt)
-        # A good default for OCR is to ensure images are not too small.
-        # We will upscale images with a width < 1000px, preserving aspect ratio.
-        MIN_WIDTH = 1000
-        orig_h, orig_w = image.shape[:2]
-
-        if orig_w < MIN_WIDTH:
-            # Upscale, preserving aspect ratio
-            ratio = MIN_WIDTH / float(orig_w)
-            target_h = int(orig_h * ratio)
-            target_w = MIN_WIDTH
-            image = cv2.resize(
-                image, (target_w, target_h), interpolation=cv2.INTER_CUBIC
+        # No explicit resize: bring the long edge within the OCR bounds,
+        # preserving aspect ratio.
+        ratio = ocr_scale(image.shape[1], image.shape[0])
+        if ratio != 1.0:
+            size = (
+                max(1, round(image.shape[1] * ratio)),
+                max(1, round(image.shape[0] * ratio)),
             )
-        # If it's already wider than MIN_WIDTH, we do nothing.
+            interpolation = cv2.INTER_AREA if ratio < 1 else cv2.INTER_CUBIC
+            image = cv2.resize(image, size, interpolation=interpolation)
+    return image
+
 
-    # 6. Save the final image
-    # 6. Save the final image or return it
+def ocr_scale(width: int, height: int) -> float:
+    """Returns the factor that brings an image's long edge within the OCR bounds."""
+    long_edge = max(width, height)
+    if long_edge > OCR_LONG_EDGE_MAX:
+        return OCR_LONG_EDGE_MAX / long_edge
+    if long_edge < OCR_LONG_EDGE_MIN:
+        return min(OCR_MAX_UPSCALE, OCR_LONG_EDGE_MIN / long_edge)
+    return 1.0
+
+
+def _fit(
+    image: np.ndarray, resize: Optional[Tuple[int, int]], viewport: Viewport
+) -> np.ndarray:
+    # Scale the (possibly explicitly resized) output down to the viewport.
+    # Images smaller than the viewport are left for the client to scale.
+    target_w, target_h = resize or (image.shape[1], image.shape[0])
+    ratio = min(1.0, viewport[0] / target_w, viewport[1] / target_h)
+    size = (max(1, round(target_w * ratio)), max(1, round(target_h * ratio)))
+    if size == (image.shape[1], image.shape[0]):
+        return image
+    if size[0] < image.shape[1]:
+        interpolation = cv2.INTER_AREA
+    else:
+        interpolation = cv2.INTER_LINEAR
+    return cv2.resize(image, size, interpolation=interpolation)
+
+
+@metrics.timed("preprocess")
+def apply_preprocessing(
+    src: Union[Path, np.ndarray],
+    options: PreprocessOptions,
+    dst_path: Optional[Path] = None,
+) -> Optional[np.ndarray]:
+    """Applies preprocessing to an image.
+
+    Args:
+        src: The path to the source image, or the image already decoded.
+        options: The preprocessing options. Auto options are resolved first;
+            callers that record the options should resolve them with
+            ``choose_options`` themselves.
+        dst_path: The path to write the preprocessed image to. If None, returns the image.
+
+    Returns:
+        The preprocessed image as a numpy array if dst_path is None, else None.
+    """
+    image = decode_image(src) if isinstance(src, Path) else src
+    options = choose_options(image, options)
+    for _, stage in preprocess_stages(options):
+        image = stage(image)
+
+    # Save the final image or return it
     if dst_path:
-        success = cv2.imwrite(str(dst_path), image)
-        if not success:
-            raise IOError(f"Failed to write preprocessed image to {dst_path}")
+        dst_path.write_bytes(encode_processed(image, options)[0])
         return None
     else:
         return image
+
+
+def encode_processed(image: np.ndarray, options: PreprocessOptions) -> Tuple[bytes, str]:
+    """Encodes a preprocessed image for storage and OCR.
+
+    Uses ``PROCESSED_FORMAT``. Thresholded images only hold black and
+    white, so as PNG they are written with one bit per pixel.
+
+    Args:
+        image: The preprocessed image.
+        options: The options it was made with.
+
+    Returns:
+        The encoded image and its MIME type.
+    """
+    if PROCESSED_FORMAT == "webp":
+        # Quality above 100 selects lossless WebP.
+        ext, mime_type, params = ".webp", "image/webp", [cv2.IMWRITE_WEBP_QUALITY, 101]
+    else:
+        ext, mime_type = ".png", "image/png"
+        params = [cv2.IMWRITE_PNG_COMPRESSION, PROCESSED_PNG_COMPRESSION]
+        thresholded = options.adaptive_threshold or options.threshold is not None
+        if PROCESSED_PNG_BILEVEL and thresholded and _is_gray(image):
+            params += [cv2.IMWRITE_PNG_BILEVEL, 1]
+    success, buffer = cv2.imencode(ext, image, params)
+    if not success:
+        raise IOError("Failed to encode preprocessed image")
+    return buffer.tobytes(), mime_type
@@ -0,0 +1,101 @@
+"""This module coalesces in-progress job status writes.
+
+Stage runners report intermediate statuses ("preprocessing", "converting",
+...) through ``status_writer``. Updates are buffered per job, later ones
+replacing earlier ones, and written in a single transaction every
+``STATUS_FLUSH_SECONDS``, so bursts of progress updates across many jobs
+cost one commit instead of one each. Final statuses are committed by the
+runner itself, after ``settle`` has dropped anything still buffered.
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from sqlalchemy.orm import attributes
+
+from app.database import SessionLocal
+from app.models.job import Job
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between writes of buffered status updates; 0 writes them at once.
+STATUS_FLUSH_SECONDS = float(os.getenv("STATUS_FLUSH_SECONDS", "0.5"))
+
+
+class StatusWriter:
+    """Buffers job column updates and writes them in batches."""
+
+    def __init__(self, interval: float = STATUS_FLUSH_SECONDS) -> None:
+        self.interval = interval
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        # Held while a batch is written, so settle can wait for it.
+        self._flush_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def update(self, job_id: str, **values: Any) -> None:
+        """Queues column updates for a job.
+
+        Args:
+            job_id: The ID of the job.
+            **values: Job columns and their new values.
+        """
+        with self._lock:
+            self._pending.setdefault(job_id, {}).update(values)
+            if self.interval > 0 and self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="status-writer", daemon=True
+                )
+                self._thread.start()
+        if self.interval <= 0:
+            self.flush()
+
+    def settle(self, job: Job) -> None:
+        """Prepares a job loaded in a runner's session for its final write.
+
+        Buffered updates of the job are dropped, and its status is marked
+        modified so the runner's commit overwrites whatever was flushed in
+        the meantime, even when it restores the status it loaded.
+        """
+        with self._flush_lock:
+            with self._lock:
+                self._pending.pop(job.job_id, None)
+        attributes.flag_modified(job, "status")
+
+    def flush(self) -> None:
+        """Writes all buffered updates in one transaction."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            db = SessionLocal()
+            try:
+                for job in db.query(Job).filter(Job.job_id.in_(list(pending))).all():
+                    for column, value in pending[job.job_id].items():
+                        setattr(job, column, value)
+                db.commit()
+            except Exception:
+                db.rollback()
+                # Keep the updates for the next flush unless newer ones arrived.
+                with self._lock:
+                    for job_id, values in pending.items():
+                        self._pending.setdefault(job_id, values)
+                raise
+            finally:
+                db.close()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Failed to write job status updates")
+
+
+status_writer = StatusWriter()
@@ -1,62 +1,292 @@
-"""This module provides a function to compile LaTeX source code to a PDF file."""
+"""This module provides a function to compile LaTeX source code to a PDF file.
 
-import subprocess
+Every compile runs in its own scratch directory under ``data/build``. When
+a build key (the job ID) is given, the aux files of the last successful
+compile are copied in first and saved afterwards, so a recompile after an
+edit usually needs a single pass, and further passes only run while the
+aux files keep changing.
+"""
+
+import hashlib
+import os
+import re
 import shutil
+import time
+import uuid
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Dict, Iterator, List, Optional
 
+from app.models import storage
+from app.services import metrics
+from app.services.cache import DiskCache
+from app.services.latex_formats import formats, split_preamble
+from app.services.latex_sandbox import LatexLimitError, run_latex
 
-def compile_latex_to_pdf(latex_source_path: Path, pdf_out_path: Path) -> None:
-    """Compiles a LaTeX source file to a PDF file using pdflatex.
+
+# "warm" compiles against cached preamble formats when one is available,
+# "cold" always runs a plain pdflatex.
+LATEX_ENGINE = os.getenv("LATEX_ENGINE", "warm")
+# Upper bound on pdflatex passes per compile.
+LATEX_MAX_PASSES = int(os.getenv("LATEX_MAX_PASSES", "4"))
+# Saved aux state unused for this long is removed by clean_build_dirs.
+LATEX_BUILD_TTL_SECONDS = float(os.getenv("LATEX_BUILD_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# The jobname of every compile, so aux files carry over between sources.
+JOBNAME = "document"
+# Files that carry state from one pass or compile to the next.
+_STATE_SUFFIXES = (".aux", ".toc", ".out", ".lof", ".lot", ".nav", ".snm")
+# Log messages that mean another pass would change the output.
+_RERUN_PATTERN = re.compile(
+    r"Rerun to get|Label\(s\) may have changed|There were undefined references"
+    r"|No file \S+\.(?:toc|lof|lot)"
+)
+# pdflatex messages that mean the cached format itself is unusable, rather
+# than the document having an error.
+_FORMAT_ERROR_PATTERN = re.compile(
+    r"can't find the format file|Fatal format file error|\.fmt was written by"
+    r"|format file .* (?:corrupt|invalid)|I'm stymied"
+)
+
+# Compiled PDFs keyed by the hash of their normalized source.
+pdf_cache = DiskCache(
+    storage.CACHE_DIR / "pdf",
+    ".pdf",
+    max_bytes=int(os.getenv("PDF_CACHE_MAX_BYTES", str(512 * 1024 * 1024))),
+    name="pdf",
+)
+
+PDFLATEX_RUNS = metrics.registry.counter(
+    "latech_pdflatex_runs_total", "pdflatex runs by mode and exit code.", ["mode", "exit_code"]
+)
+PDFLATEX_SECONDS = metrics.registry.histogram(
+    "latech_pdflatex_duration_seconds", "Wall time of pdflatex runs.", ["mode"]
+)
+PDFLATEX_PASSES = metrics.registry.histogram(
+    "latech_pdflatex_passes", "pdflatex passes per compile.", buckets=(1, 2, 3, 4, 5)
+)
+
+# The preamble injected around LaTeX fragments.
+FRAGMENT_PREAMBLE = """
+\\documentclass{article}
+\\usepackage{amsmath}
+\\usepackage{graphicx}
+"""
+
+
+def wrap_fragment(latex_content: str) -> str:
+    """Wraps a LaTeX fragment in a minimal document structure.
 
     Args:
-        latex_source_path: The path to the LaTeX source file.
-        pdf_out_path: The path to write the PDF file to.
+        latex_content: The LaTeX source, either a full document or a fragment.
 
-    Raises:
-        RuntimeError: If the compilation fails.
+    Returns:
+        The source unchanged if it is a full document, else the wrapped fragment.
     """
-    latex_content = latex_source_path.read_text(encoding="utf-8")
-
-    # Check if the content is a full document or just a fragment
-    if "\\documentclass" not in latex_content:
-        # Wrap the content in a minimal document structure
-        latex_content = f"""
-\\documentclass{{article}}
-\\usepackage{{amsmath}}
-\\usepackage{{graphicx}}
-\\begin{{document}}
+    if "\\documentclass" in latex_content:
+        return latex_content
+    return f"""{FRAGMENT_PREAMBLE}\\begin{{document}}
 {latex_content}
 \\end{{document}}
 """
-        latex_source_path.write_text(latex_content, encoding="utf-8")
 
+
+def source_key(latex_content: str) -> str:
+    """Returns the compile cache key for a LaTeX source.
+
+    The source is wrapped like ``compile_latex_to_pdf`` would wrap it and
+    line endings and trailing whitespace are normalized, so sources that
+    compile to the same document share a key.
+
+    Args:
+        latex_content: The LaTeX source, either a full document or a fragment.
+
+    Returns:
+        The cache key.
+    """
+    lines = wrap_fragment(latex_content).replace("\r\n", "\n").split("\n")
+    normalized = "\n".join(line.rstrip() for line in lines).strip()
+    return DiskCache.key_for(normalized)
+
+
+def warm_formats() -> None:
+    """Builds the preamble formats every deployment needs up front."""
+    if LATEX_ENGINE == "warm":
+        formats.warm([FRAGMENT_PREAMBLE])
+
+
+def _run_pdflatex(
+    command: List[str],
+    cwd: Path,
+    env: Optional[Dict[str, str]] = None,
+    mode: str = "cold",
+) -> None:
+    """Runs pdflatex in the sandbox and translates its failures into RuntimeErrors."""
+    start = time.perf_counter()
+    exit_code = "0"
+    try:
+        result = run_latex(command, cwd=cwd, env=env)
+        if result.returncode != 0:
+            exit_code = str(result.returncode)
+            # pdflatex reports errors on stdout, which includes stderr here
+            raise RuntimeError(f"LaTeX compilation failed: {result.stdout}")
+    except LatexLimitError:
+        exit_code = "limit"
+        raise
+    except FileNotFoundError as e:
+        exit_code = "not_found"
+        raise RuntimeError(
+            "pdflatex command not found. Is LaTeX installed and in your PATH?"
+        ) from e
+    finally:
+        PDFLATEX_RUNS.inc(mode=mode, exit_code=exit_code)
+        PDFLATEX_SECONDS.observe(time.perf_counter() - start, mode=mode)
+
+
+def _compile_warm(fmt: str, body: str, build_dir: Path) -> None:
+    """Compiles the document body against a cached preamble format."""
+    body_path = build_dir / f"{JOBNAME}.body.tex"
+    body_path.write_text(body, encoding="utf-8")
     command = [
         "pdflatex",
+        f"-fmt={fmt}",
         "-interaction=nonstopmode",
-        "-output-directory",
-        str(pdf_out_path.parent),
-        str(latex_source_path),
+        f"-jobname={JOBNAME}",
+        body_path.name,
     ]
+    _run_pdflatex(command, build_dir, env=formats.env(), mode="warm")
+
 
+def _compile_cold(build_dir: Path) -> None:
+    """Compiles the full document with a plain pdflatex run."""
+    _run_pdflatex(["pdflatex", "-interaction=nonstopmode", f"{JOBNAME}.tex"], build_dir)
+
+
+def _state_digest(build_dir: Path) -> str:
+    """Returns a hash of the files that carry state between passes."""
+    digest = hashlib.sha256()
+    for suffix in _STATE_SUFFIXES:
+        path = build_dir / f"{JOBNAME}{suffix}"
+        if path.exists():
+            digest.update(suffix.encode())
+            digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def _needs_rerun(build_dir: Path) -> bool:
+    """Returns whether the log of the last pass asks for another one."""
+    log = build_dir / f"{JOBNAME}.log"
+    if not log.exists():
+        return False
+    return bool(_RERUN_PATTERN.search(log.read_text(encoding="utf-8", errors="replace")))
+
+
+@contextmanager
+def _build_dir(build_key: Optional[str]) -> Iterator[Path]:
+    """Yields a scratch directory seeded with the saved aux state of a job.
+
+    Concurrent compiles of the same job each get their own directory; the
+    state of whichever succeeds last is kept.
+    """
+    storage.BUILD_DIR.mkdir(parents=True, exist_ok=True)
+    scratch = storage.BUILD_DIR / f".{uuid.uuid4().hex}"
+    scratch.mkdir()
+    state_dir = storage.path_for_build(build_key) if build_key else None
     try:
-        # The `capture_output=True` argument captures the stdout and stderr streams,
-        # and `text=True` decodes them as text.
-        # The `check=True` argument raises a `CalledProcessError` if the command
-        # returns a non-zero exit code.
-        subprocess.run(
-            command,
-            capture_output=True,
-            text=True,
-            check=True,
-            encoding="utf-8",
-        )
+        if state_dir is not None and state_dir.is_dir():
+            for state in state_dir.iterdir():
+                shutil.copyfile(state, scratch / state.name)
+        yield scratch
+        if state_dir is not None:
+            state_dir.mkdir(exist_ok=True)
+            for suffix in _STATE_SUFFIXES:
+                state = scratch / f"{JOBNAME}{suffix}"
+                if state.exists():
+                    os.replace(state, state_dir / state.name)
+            # Marks the state as recently used for clean_build_dirs.
+            os.utime(state_dir)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def clean_build_dirs(max_age: float = LATEX_BUILD_TTL_SECONDS) -> int:
+    """Removes saved aux state unused for ``max_age`` seconds.
+
+    Scratch directories left behind by crashed compiles are removed after
+    an hour.
+
+    Returns:
+        The number of directories removed.
+    """
+    if not storage.BUILD_DIR.is_dir():
+        return 0
+    now = time.time()
+    removed = 0
+    for path in storage.BUILD_DIR.iterdir():
+        limit = min(max_age, 3600) if path.name.startswith(".") else max_age
+        try:
+            if now - path.stat().st_mtime > limit:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        except FileNotFoundError:
+            continue
+    return removed
+
+
+def discard_build(build_key: str) -> None:
+    """Removes the saved aux state of a job."""
+    shutil.rmtree(storage.path_for_build(build_key), ignore_errors=True)
+
+
+@metrics.timed("compile")
+def compile_latex_to_pdf(
+    latex_source_path: Path, pdf_out_path: Path, build_key: Optional[str] = None
+) -> None:
+    """Compiles a LaTeX source file to a PDF file using pdflatex.
+
+    Args:
+        latex_source_path: The path to the LaTeX source file.
+        pdf_out_path: The path to write the PDF file to.
+        build_key: Identifies the document across edits, usually the job ID.
+            Its aux files are reused between compiles.
+
+    Raises:
+        RuntimeError: If the compilation fails.
+    """
+    # Fragments are compiled wrapped in a document. The source file itself
+    # is left alone: it may be a read-only copy owned by the artifact store.
+    latex_content = wrap_fragment(latex_source_path.read_text(encoding="utf-8"))
+
+    parts = split_preamble(latex_content) if LATEX_ENGINE == "warm" else None
+    fmt = formats.lookup(parts[0]) if parts else None
+    with _build_dir(build_key) as build_dir:
+        (build_dir / f"{JOBNAME}.tex").write_text(latex_content, encoding="utf-8")
+        passes = 0
+        while passes < LATEX_MAX_PASSES:
+            before = _state_digest(build_dir)
+            if fmt is None:
+                _compile_cold(build_dir)
+            else:
+                try:
+                    _compile_warm(fmt, parts[1], build_dir)
+                except LatexLimitError:
+                    # A runaway document; compiling it cold would only repeat it.
+                    raise
+                except RuntimeError as e:
+                    # An error in the document would only repeat cold.
+                    if not _FORMAT_ERROR_PATTERN.search(str(e)):
+                        raise
+                    # Retry cold. If that succeeds the format, not the
+                    # document, was at fault and the preamble is compiled
+                    # cold from now on.
+                    _compile_cold(build_dir)
+                    formats.reject(fmt)
+                    fmt = None
+            passes += 1
+            # Stop once the aux files are stable or nothing asks for a rerun.
+            if _state_digest(build_dir) == before or not _needs_rerun(build_dir):
+                break
+        PDFLATEX_PASSES.observe(passes)
+
         # Move the generated PDF to the desired output path
-        generated_pdf = pdf_out_path.parent / latex_source_path.with_suffix(".pdf").name
-        shutil.move(generated_pdf, pdf_out_path)
-    except subprocess.CalledProcessError as e:
-        # The error message from pdflatex is in the stderr stream
-        raise RuntimeError(f"LaTeX compilation failed: {e.stderr}") from e
-    except FileNotFoundError as e:
-        raise RuntimeError(
-            "pdflatex command not found. Is LaTeX installed and in your PATH?"
-        ) from e
+        shutil.move(str(build_dir / f"{JOBNAME}.pdf"), pdf_out_path)
@@ -0,0 +1,221 @@
+"""This module manages precompiled pdflatex formats for common preambles.
+
+Loading the document class and packages dominates the runtime of a small
+pdflatex job. A preamble that is seen often enough is dumped once into a
+``.fmt`` file with ``pdflatex -ini`` and later compiles load that format
+instead of re-reading every package from scratch.
+"""
+
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from app.models import storage
+from app.services.latex_sandbox import LatexLimitError, run_latex
+
+
+# A preamble must be seen this many times before a format is built for it.
+FORMAT_MIN_USES = int(os.getenv("LATEX_FORMAT_MIN_USES", "2"))
+# Upper bound on the number of format files kept on disk.
+FORMAT_MAX_COUNT = int(os.getenv("LATEX_FORMAT_MAX_COUNT", "32"))
+
+BEGIN_DOCUMENT = "\\begin{document}"
+
+# Preamble commands that open output streams or depend on the job at dump
+# time. Preambles containing these are always compiled cold.
+_UNDUMPABLE = ("\\makeindex", "\\makeglossaries", "\\tikzexternalize", "\\nofiles")
+
+
+def split_preamble(latex_content: str) -> Optional[Tuple[str, str]]:
+    """Splits a full LaTeX document into its preamble and body.
+
+    Args:
+        latex_content: The LaTeX source of a full document.
+
+    Returns:
+        A ``(preamble, body)`` tuple where the body starts at
+        ``\\begin{document}``, or None if the document has no body.
+    """
+    index = latex_content.find(BEGIN_DOCUMENT)
+    if index == -1:
+        return None
+    return latex_content[:index], latex_content[index:]
+
+
+def _engine_version() -> str:
+    """Returns the pdflatex version banner, or an empty string if missing."""
+    try:
+        result = subprocess.run(
+            ["pdflatex", "--version"],
+            capture_output=True,
+            text=True,
+            check=False,
+            encoding="utf-8",
+            timeout=30,
+        )
+    except (FileNotFoundError, subprocess.TimeoutExpired):
+        return ""
+    return result.stdout.splitlines()[0] if result.stdout else ""
+
+
+class FormatCache:
+    """Builds and looks up pdflatex formats keyed by preamble hash.
+
+    Format names are derived from the preamble text and the pdflatex
+    version, so an edited preamble or an upgraded TeX installation maps to
+    a new format and the stale one ages out of the cache.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        min_uses: int = FORMAT_MIN_USES,
+        max_count: int = FORMAT_MAX_COUNT,
+    ) -> None:
+        self.directory = directory
+        self.min_uses = min_uses
+        self.max_count = max_count
+        self._lock = threading.Lock()
+        self._uses: Dict[str, int] = {}
+        self._building: Set[str] = set()
+        self._rejected: Set[str] = set()
+        self._version: Optional[str] = None
+
+    def name_for(self, preamble: str) -> str:
+        """Returns the format name for a preamble."""
+        if self._version is None:
+            self._version = _engine_version()
+        digest = hashlib.sha256()
+        digest.update(self._version.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(preamble.strip().encode("utf-8"))
+        return f"preamble-{digest.hexdigest()[:24]}"
+
+    def path_for(self, name: str) -> Path:
+        """Returns the path of the format file for a format name."""
+        return self.directory / f"{name}.fmt"
+
+    def env(self) -> Dict[str, str]:
+        """Returns the environment that lets pdflatex find cached formats."""
+        env = dict(os.environ)
+        # The trailing separator keeps the default search path after ours.
+        env["TEXFORMATS"] = f"{self.directory}{os.pathsep}{env.get('TEXFORMATS', '')}"
+        return env
+
+    def lookup(self, preamble: str) -> Optional[str]:
+        """Returns a ready format name for a preamble and records the use.
+
+        A preamble that crosses the use threshold gets its format built in
+        the background; until it is ready the caller compiles cold.
+
+        Args:
+            preamble: Everything before ``\\begin{document}``.
+
+        Returns:
+            The format name, or None if no format is available yet.
+        """
+        if any(command in preamble for command in _UNDUMPABLE):
+            return None
+        name = self.name_for(preamble)
+        path = self.path_for(name)
+        with self._lock:
+            if name in self._rejected:
+                return None
+            if path.exists():
+                path.touch()
+                return name
+            self._uses[name] = self._uses.get(name, 0) + 1
+            if self._uses[name] < self.min_uses or name in self._building:
+                return None
+            self._building.add(name)
+        threading.Thread(
+            target=self._build, args=(name, preamble), daemon=True
+        ).start()
+        return None
+
+    def warm(self, preambles: Iterable[str]) -> None:
+        """Builds formats for a known set of preambles and prunes the rest.
+
+        Args:
+            preambles: The preambles that should always have a format.
+        """
+        storage.ensure_dirs()
+        for preamble in preambles:
+            name = self.name_for(preamble)
+            if self.path_for(name).exists():
+                continue
+            with self._lock:
+                if name in self._building:
+                    continue
+                self._building.add(name)
+            self._build(name, preamble)
+
+    def reject(self, name: str) -> None:
+        """Drops a format that failed to compile a document.
+
+        The preamble is compiled cold from then on.
+
+        Args:
+            name: The format name.
+        """
+        with self._lock:
+            self._rejected.add(name)
+        self.path_for(name).unlink(missing_ok=True)
+
+    def _build(self, name: str, preamble: str) -> None:
+        """Dumps a preamble into a format file."""
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                tmp_dir = Path(tmp)
+                (tmp_dir / f"{name}.tex").write_text(
+                    f"{preamble}\n\\dump\n", encoding="utf-8"
+                )
+                result = run_latex(
+                    [
+                        "pdflatex",
+                        "-ini",
+                        "-interaction=nonstopmode",
+                        f"-jobname={name}",
+                        "&pdflatex",
+                        f"{name}.tex",
+                    ],
+                    cwd=tmp_dir,
+                )
+                built = tmp_dir / f"{name}.fmt"
+                if result.returncode != 0 or not built.exists():
+                    with self._lock:
+                        self._rejected.add(name)
+                    return
+                self.directory.mkdir(parents=True, exist_ok=True)
+                staged = self.directory / f".{name}.fmt.tmp"
+                shutil.copyfile(built, staged)
+                os.replace(staged, self.path_for(name))
+        except (OSError, LatexLimitError):
+            with self._lock:
+                self._rejected.add(name)
+        finally:
+            with self._lock:
+                self._building.discard(name)
+        self._prune()
+
+    def _prune(self) -> None:
+        """Removes the least recently used formats beyond the size bound."""
+        try:
+            formats = sorted(
+                self.directory.glob("preamble-*.fmt"),
+                key=lambda p: p.stat().st_mtime,
+                reverse=True,
+            )
+            for stale in formats[self.max_count:]:
+                stale.unlink(missing_ok=True)
+        except OSError:
+            # A concurrent build or prune touched the directory; try next time.
+            pass
+
+
+formats = FormatCache(storage.FORMAT_DIR)
@@ -0,0 +1,170 @@
+"""This module runs pdflatex with bounded time, memory, output and concurrency.
+
+LaTeX sources come from the model and from users, so a compile can loop
+forever, allocate without bound or write huge files. Every pdflatex
+process started here gets ``-no-shell-escape``, an allowlisted environment
+with paranoid file access, a wall-clock timeout, CPU time, address space
+and file size limits, and its own process group that is killed as a whole
+when a limit is hit. A semaphore bounds how many run at once in this
+process.
+"""
+
+import os
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows: no rlimits, only the timeout applies.
+    resource = None
+
+# prlimit sets the limits of a running process from the parent, so no code
+# runs in the forked child (preexec_fn is unsafe in threaded processes).
+# Where it is missing (macOS), only the timeout applies.
+_HAS_PRLIMIT = resource is not None and hasattr(resource, "prlimit")
+
+# Wall-clock seconds a pdflatex run may take.
+LATEX_TIMEOUT_SECONDS = float(os.getenv("LATEX_TIMEOUT_SECONDS", "60"))
+# CPU seconds a pdflatex run may use.
+LATEX_CPU_SECONDS = int(os.getenv("LATEX_CPU_SECONDS", "60"))
+# Address space limit of a pdflatex process in bytes.
+LATEX_MEMORY_BYTES = int(os.getenv("LATEX_MEMORY_BYTES", str(1024 * 1024 * 1024)))
+# Largest file a pdflatex run may write, in bytes.
+LATEX_MAX_OUTPUT_BYTES = int(os.getenv("LATEX_MAX_OUTPUT_BYTES", str(64 * 1024 * 1024)))
+# pdflatex processes running at once in this process.
+LATEX_MAX_CONCURRENCY = int(os.getenv("LATEX_MAX_CONCURRENCY", str(os.cpu_count() or 2)))
+
+# Variables passed through to pdflatex; everything else, API keys and
+# cloud credentials included, is withheld from untrusted documents.
+_ENV_NAMES = {"PATH", "HOME", "LANG", "LC_ALL", "LC_CTYPE", "TZ", "TMPDIR", "SOURCE_DATE_EPOCH"}
+_ENV_PREFIXES = ("TEX",)  # TEXMF*, TEXINPUTS, TEXFORMATS, ...
+
+# Characters of pdflatex output kept for error messages.
+_OUTPUT_TAIL_CHARS = 8000
+
+_slots = threading.BoundedSemaphore(max(1, LATEX_MAX_CONCURRENCY))
+
+
+class LatexLimitError(RuntimeError):
+    """Raised when pdflatex is killed for exceeding a resource limit."""
+
+
+def _limit_resources(pid: int) -> None:
+    """Applies the rlimits to a pdflatex process that has just started."""
+    resource.prlimit(pid, resource.RLIMIT_CPU, (LATEX_CPU_SECONDS, LATEX_CPU_SECONDS + 5))
+    resource.prlimit(pid, resource.RLIMIT_AS, (LATEX_MEMORY_BYTES, LATEX_MEMORY_BYTES))
+    resource.prlimit(
+        pid, resource.RLIMIT_FSIZE, (LATEX_MAX_OUTPUT_BYTES, LATEX_MAX_OUTPUT_BYTES)
+    )
+    resource.prlimit(pid, resource.RLIMIT_CORE, (0, 0))
+
+
+def _child_env(env: Optional[Dict[str, str]]) -> Dict[str, str]:
+    """Returns the allowlisted environment of a pdflatex process."""
+    source = env if env is not None else os.environ
+    child = {
+        name: value
+        for name, value in source.items()
+        if name in _ENV_NAMES or name.startswith(_ENV_PREFIXES)
+    }
+    # Never let a document read files outside its working directory tree,
+    # such as /proc/self/environ, or write outside it.
+    child["openin_any"] = "p"
+    child["openout_any"] = "p"
+    return child
+
+
+def _kill_group(process: subprocess.Popen) -> None:
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+def _limit_message(returncode: int) -> Optional[str]:
+    """Describes the limit behind a signal exit, if any."""
+    if not _HAS_PRLIMIT or returncode >= 0:
+        return None
+    if -returncode == signal.SIGXCPU:
+        return f"exceeded the CPU time limit of {LATEX_CPU_SECONDS}s"
+    if -returncode == signal.SIGXFSZ:
+        return f"exceeded the output size limit of {LATEX_MAX_OUTPUT_BYTES} bytes"
+    if -returncode in (signal.SIGKILL, signal.SIGSEGV, signal.SIGABRT):
+        return "was killed, most likely for exceeding the memory limit"
+    return None
+
+
+def run_latex(
+    command: List[str],
+    cwd: Optional[Path] = None,
+    env: Optional[Dict[str, str]] = None,
+    timeout: float = LATEX_TIMEOUT_SECONDS,
+) -> subprocess.CompletedProcess:
+    """Runs a pdflatex command inside the sandbox.
+
+    Args:
+        command: The command; ``-no-shell-escape`` is added after argv[0].
+        cwd: The working directory.
+        env: The environment, defaulting to this process's. Only PATH,
+            HOME, locale and TeX variables are passed on.
+        timeout: Wall-clock seconds before the process group is killed.
+
+    Returns:
+        The completed process. ``stdout`` holds the tail of the combined
+        output and ``check`` is left to the caller.
+
+    Raises:
+        LatexLimitError: If the run timed out or hit a resource limit.
+        FileNotFoundError: If pdflatex is not installed.
+    """
+    command = [command[0], "-no-shell-escape", *command[1:]]
+    env = _child_env(env)
+
+    with _slots:
+        # Output goes to a file, which RLIMIT_FSIZE bounds, not to our memory.
+        with tempfile.TemporaryFile() as output:
+            process = subprocess.Popen(
+                command,
+                cwd=cwd,
+                env=env,
+                stdin=subprocess.DEVNULL,
+                stdout=output,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+            start = time.monotonic()
+            try:
+                if _HAS_PRLIMIT:
+                    try:
+                        _limit_resources(process.pid)
+                    except ProcessLookupError:
+                        pass  # Already exited; wait() collects it.
+                returncode = process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                _kill_group(process)
+                raise LatexLimitError(
+                    f"LaTeX compilation timed out after {time.monotonic() - start:.0f}s"
+                ) from None
+            except BaseException:
+                _kill_group(process)
+                raise
+            # Children the document may have left behind go with the group.
+            _kill_group(process)
+
+            output.seek(0, os.SEEK_END)
+            output.seek(max(0, output.tell() - _OUTPUT_TAIL_CHARS))
+            tail = output.read().decode("utf-8", errors="replace")
+
+    message = _limit_message(returncode)
+    if message is not None:
+        raise LatexLimitError(f"LaTeX compilation {message}")
+    return subprocess.CompletedProcess(command, returncode, stdout=tail, stderr="")
@@ -0,0 +1,434 @@
+"""This module manages the lifetime of the files jobs leave in ``data/``.
+
+Deleting a job cascades to its upload, processed image, LaTeX source, PDF,
+saved build state and cached previews. Artifacts shared with other jobs,
+such as reused processed images and content-addressed uploads, are kept
+until the last job referencing them goes.
+
+``sweep`` runs periodically in the workers and removes what nothing
+deletes explicitly: artifacts of finished jobs past their type's TTL,
+finished jobs past ``JOB_TTL_SECONDS``, the least recently updated
+finished jobs while ``data/`` is over its quota, and files no job
+references, such as the output of a stage whose job was deleted while it
+ran. Orphans are found by scanning the artifact store and checking the keys
+against the database in bounded batches.
+"""
+
+import logging
+import os
+import shutil
+import time
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import InstrumentedAttribute
+
+from app.database import SessionLocal
+from app.models import storage
+from app.models.blob import Blob
+from app.models.job import Job
+from app.models.task import Task
+from app.services import metrics, task_queue
+from app.services.artifact_store import KINDS, release_upload, store
+from app.services.latex_compile import clean_build_dirs
+from app.services.preview_cache import preview_cache
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds after which an artifact of a finished job is removed; 0 keeps it.
+# Processed images can be recreated from the upload, so they expire first.
+ARTIFACT_TTL_SECONDS = {
+    "upload": float(os.getenv("UPLOAD_TTL_SECONDS", "0")),
+    "processed": float(os.getenv("PROCESSED_TTL_SECONDS", str(7 * 24 * 3600))),
+    "latex": float(os.getenv("LATEX_SOURCE_TTL_SECONDS", "0")),
+    "pdf": float(os.getenv("PDF_TTL_SECONDS", "0")),
+}
+# Seconds after which a finished job is deleted with its artifacts; 0 keeps jobs.
+JOB_TTL_SECONDS = float(os.getenv("JOB_TTL_SECONDS", "0"))
+# Bytes data/ may hold before finished jobs are evicted; 0 disables the quota.
+DATA_QUOTA_BYTES = int(os.getenv("DATA_QUOTA_BYTES", "0"))
+# Fraction of the quota that eviction brings usage back down to.
+DATA_QUOTA_LOW_WATERMARK = float(os.getenv("DATA_QUOTA_LOW_WATERMARK", "0.9"))
+# Files or jobs handled per database round trip.
+LIFECYCLE_BATCH_SIZE = int(os.getenv("LIFECYCLE_BATCH_SIZE", "500"))
+# Seconds an unreferenced file is left alone, so stages can finish writing.
+ORPHAN_GRACE_SECONDS = float(os.getenv("ORPHAN_GRACE_SECONDS", "3600"))
+
+# Job statuses whose artifacts no stage is still writing.
+FINISHED = ("complete", "failed")
+
+# The job column naming each artifact kind of the store.
+_COLUMNS: Dict[str, InstrumentedAttribute] = {
+    "upload": Job.upload_id,
+    "processed": Job.processed_id,
+    "latex": Job.latex_id,
+    "pdf": Job.pdf_id,
+}
+
+ARTIFACTS_REMOVED = metrics.registry.counter(
+    "latech_artifacts_removed_total",
+    "Files removed from the data directory by artifact type and reason.",
+    ["artifact", "reason"],
+)
+ARTIFACT_BYTES_REMOVED = metrics.registry.counter(
+    "latech_artifact_bytes_removed_total",
+    "Bytes removed from the data directory by artifact type and reason.",
+    ["artifact", "reason"],
+)
+DATA_BYTES = metrics.registry.gauge(
+    "latech_data_bytes", "Bytes held by job artifacts at the last sweep."
+)
+
+
+def _size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+
+def _tree_size(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(_size(Path(root) / name) for name in files)
+    return total
+
+
+def _removed(artifact: str, reason: str, size: int) -> int:
+    ARTIFACTS_REMOVED.inc(artifact=artifact, reason=reason)
+    ARTIFACT_BYTES_REMOVED.inc(size, artifact=artifact, reason=reason)
+    return size
+
+
+def _referenced(db: Session, artifact: str, artifact_ids: Iterable[str]) -> Set[str]:
+    """Returns the IDs among ``artifact_ids`` that a job or blob still uses."""
+    artifact_ids = list(artifact_ids)
+    if not artifact_ids:
+        return set()
+    column = _COLUMNS[artifact]
+    found = {row[0] for row in db.query(column).filter(column.in_(artifact_ids))}
+    if artifact == "upload":
+        found.update(
+            row[0] for row in db.query(Blob.upload_id).filter(Blob.upload_id.in_(artifact_ids))
+        )
+    return found
+
+
+def _release(db: Session, artifact: str, artifact_id: str, reason: str) -> int:
+    """Drops one job's reference to an artifact, removing it if unused.
+
+    Returns:
+        The number of bytes freed.
+    """
+    if artifact == "upload":
+        freed = release_upload(db, artifact_id)
+    elif _referenced(db, artifact, [artifact_id]):
+        return 0
+    else:
+        freed = store.delete(artifact, artifact_id)
+    return _removed(artifact, reason, freed) if freed else 0
+
+
+def _discard_build(job_id: str, reason: str) -> int:
+    path = storage.path_for_build(job_id)
+    if not path.is_dir():
+        return 0
+    size = _tree_size(path)
+    shutil.rmtree(path, ignore_errors=True)
+    return _removed("build", reason, size)
+
+
+def delete_job(db: Session, job: Job, reason: str = "delete") -> int:
+    """Deletes a job together with the artifacts no other job shares.
+
+    Queued tasks of the job are dropped; a task already running finds the
+    job gone and stops, and whatever it wrote is reclaimed as an orphan.
+
+    Args:
+        db: The database session. The change is committed.
+        job: The job to delete.
+        reason: Why the job is deleted, recorded in the metrics.
+
+    Returns:
+        The number of bytes freed.
+    """
+    job_id = job.job_id
+    artifact_ids = {
+        artifact: getattr(job, column.key) for artifact, column in _COLUMNS.items()
+    }
+    db.query(Task).filter(Task.job_id == job_id, Task.status == task_queue.QUEUED).delete(
+        synchronize_session=False
+    )
+    db.delete(job)
+    db.commit()
+
+    freed = 0
+    for artifact, artifact_id in artifact_ids.items():
+        if artifact_id:
+            freed += _release(db, artifact, artifact_id, reason)
+    freed += _discard_build(job_id, reason)
+    preview_cache.discard(job_id)
+    return freed
+
+
+def _batched(items: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, max(1, size)))
+        if not batch:
+            return
+        yield batch
+
+
+def expire_artifacts(now: Optional[float] = None) -> int:
+    """Removes artifacts of finished jobs not updated within their TTL.
+
+    The job stays; only the expired column is cleared. ``updated_at`` is
+    left alone so expiring an artifact does not make the job look recent.
+
+    Returns:
+        The number of bytes freed.
+    """
+    now = time.time() if now is None else now
+    freed = 0
+    for artifact, ttl in ARTIFACT_TTL_SECONDS.items():
+        if ttl <= 0:
+            continue
+        column = _COLUMNS[artifact]
+        while True:
+            db = SessionLocal()
+            try:
+                rows = (
+                    db.query(Job.job_id, column)
+                    .filter(
+                        Job.status.in_(FINISHED),
+                        Job.updated_at < now - ttl,
+                        column.isnot(None),
+                    )
+                    .limit(LIFECYCLE_BATCH_SIZE)
+                    .all()
+                )
+                if not rows:
+                    break
+                db.query(Job).filter(Job.job_id.in_([row[0] for row in rows])).update(
+                    {column: None, Job.updated_at: Job.updated_at}, synchronize_session=False
+                )
+                db.commit()
+                # Uploads are reference counted per job, the others by name.
+                released = [row[1] for row in rows]
+                if artifact != "upload":
+                    released = sorted(set(released))
+                for artifact_id in released:
+                    freed += _release(db, artifact, artifact_id, "ttl")
+            finally:
+                db.close()
+    return freed
+
+
+def expire_jobs(now: Optional[float] = None) -> int:
+    """Deletes finished jobs not updated within ``JOB_TTL_SECONDS``.
+
+    Returns:
+        The number of bytes freed.
+    """
+    if JOB_TTL_SECONDS <= 0:
+        return 0
+    now = time.time() if now is None else now
+    freed = 0
+    while True:
+        db = SessionLocal()
+        try:
+            jobs = (
+                db.query(Job)
+                .filter(Job.status.in_(FINISHED), Job.updated_at < now - JOB_TTL_SECONDS)
+                .limit(LIFECYCLE_BATCH_SIZE)
+                .all()
+            )
+            if not jobs:
+                return freed
+            for job in jobs:
+                freed += delete_job(db, job, "ttl")
+        finally:
+            db.close()
+
+
+def _unshared_bytes(directory: Path) -> int:
+    """Returns the bytes of the files under a directory with no other link."""
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                stat = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if stat.st_nlink == 1:
+                total += stat.st_size
+    return total
+
+
+def data_usage() -> int:
+    """Returns the bytes that evicting jobs can free.
+
+    This covers job artifacts and build directories. The caches are bounded
+    on their own, and files also linked into one, like PDFs shared with the
+    PDF cache, are left out because deleting the job frees none of them.
+    """
+    total = _unshared_bytes(storage.BUILD_DIR)
+    if store.local:
+        total += sum(_unshared_bytes(store.root / directory) for directory, _ in KINDS.values())
+    else:
+        total += store.usage()
+    return total
+
+
+def enforce_quota() -> int:
+    """Evicts the least recently updated finished jobs while over quota.
+
+    Eviction starts above ``DATA_QUOTA_BYTES`` and stops once usage is
+    back under ``DATA_QUOTA_LOW_WATERMARK`` of it, so usage hovering at the
+    quota is not swept on every run. Usage is measured by ``data_usage``.
+
+    Returns:
+        The number of bytes freed.
+    """
+    usage = data_usage()
+    DATA_BYTES.set(usage)
+    if DATA_QUOTA_BYTES <= 0 or usage <= DATA_QUOTA_BYTES:
+        return 0
+    target = DATA_QUOTA_BYTES * DATA_QUOTA_LOW_WATERMARK
+    freed = 0
+    while usage - freed > target:
+        db = SessionLocal()
+        try:
+            jobs = (
+                db.query(Job)
+                .filter(Job.status.in_(FINISHED))
+                .order_by(Job.updated_at, Job.job_id)
+                .limit(LIFECYCLE_BATCH_SIZE)
+                .all()
+            )
+            if not jobs:
+                logger.warning(
+                    "Job artifacts hold %d bytes, over their quota of %d, "
+                    "with no finished jobs left to evict",
+                    usage - freed,
+                    DATA_QUOTA_BYTES,
+                )
+                break
+            for job in jobs:
+                freed += delete_job(db, job, "quota")
+                if usage - freed <= target:
+                    break
+        finally:
+            db.close()
+    DATA_BYTES.set(usage - freed)
+    return freed
+
+
+def _stale_entries(directory: Path, cutoff: float) -> Iterator[os.DirEntry]:
+    """Yields the entries of a directory last modified before ``cutoff``."""
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                        yield entry
+                except FileNotFoundError:
+                    continue
+    except FileNotFoundError:
+        return
+
+
+def reconcile_orphans(now: Optional[float] = None) -> int:
+    """Removes stored files that no job references.
+
+    The store is scanned lazily and the keys are checked against the
+    database ``LIFECYCLE_BATCH_SIZE`` at a time, so neither memory nor any
+    single query grows with the number of files. Files that do not follow
+    the store's naming, such as pdflatex ``.aux`` and ``.log`` files from
+    before per-job build directories, are orphans too, as are abandoned
+    staging files. Build directories are kept while their job exists.
+
+    Returns:
+        The number of bytes freed.
+    """
+    cutoff = (time.time() if now is None else now) - ORPHAN_GRACE_SECONDS
+    freed = 0
+    for artifact in _COLUMNS:
+        stale = (obj for obj in store.scan(artifact) if obj.modified < cutoff)
+        for batch in _batched(stale, LIFECYCLE_BATCH_SIZE):
+            db = SessionLocal()
+            try:
+                referenced = _referenced(db, artifact, {obj.key for obj in batch if obj.key})
+            finally:
+                db.close()
+            for obj in batch:
+                if obj.key in referenced:
+                    continue
+                try:
+                    store.remove(artifact, obj.name)
+                except OSError:
+                    logger.exception("Failed to remove %s %s", artifact, obj.name)
+                    continue
+                freed += _removed(artifact, "orphan", obj.size)
+
+    for entry in _stale_entries(storage.STAGING_DIR, cutoff):
+        if entry.is_file(follow_symlinks=False):
+            size = _size(Path(entry.path))
+            Path(entry.path).unlink(missing_ok=True)
+            freed += _removed("staging", "orphan", size)
+
+    # Scratch directories (dot-prefixed) are left to clean_build_dirs.
+    builds = (
+        entry
+        for entry in _stale_entries(storage.BUILD_DIR, cutoff)
+        if not entry.name.startswith(".")
+    )
+    for batch in _batched(builds, LIFECYCLE_BATCH_SIZE):
+        db = SessionLocal()
+        try:
+            names = [entry.name for entry in batch]
+            existing = {row[0] for row in db.query(Job.job_id).filter(Job.job_id.in_(names))}
+        finally:
+            db.close()
+        for name in names:
+            if name not in existing:
+                freed += _discard_build(name, "orphan")
+    return freed
+
+
+def sweep() -> Dict[str, int]:
+    """Runs every lifecycle policy once.
+
+    Each step is independent; a failing one is logged and the rest still
+    run. Sweeps from several workers may overlap; every step tolerates
+    files and jobs another sweep already removed.
+
+    Returns:
+        The bytes freed by each step.
+    """
+    try:
+        clean_build_dirs()
+    except OSError:
+        logger.exception("Cleaning build directories failed")
+    try:
+        task_queue.purge()
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Purging finished tasks failed")
+    steps = {
+        "artifact_ttl": expire_artifacts,
+        "job_ttl": expire_jobs,
+        "orphans": reconcile_orphans,
+        "quota": enforce_quota,
+    }
+    freed = {}
+    for name, step in steps.items():
+        try:
+            freed[name] = step()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Lifecycle step %s failed", name)
+            freed[name] = 0
+    return freed
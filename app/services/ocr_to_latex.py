@@ -1,42 +1,355 @@
-"""This module provides a function to convert an image to LaTeX using Gemini."""
+"""This module provides a function to convert an image to LaTeX using Gemini.
 
+Requests go through a shared ``GeminiOCRService`` that runs the async
+Gemini client on a dedicated event loop. The service bounds concurrent
+requests, rate-limits them with a token bucket, retries rate limits and
+server errors with jittered backoff, sends small images inline and reuses
+uploaded files by content hash until they expire.
+"""
+
+import asyncio
+import io
 import os
+import random
 import re
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
+from typing import Any, Coroutine, List, Optional, Tuple, TypeVar
+
 from google import genai
+from google.genai import errors, types
 
-# Configure the Gemini client
-client = genai.Client()
+from app.models import storage
+from app.services import metrics
+from app.services.cache import DiskCache
+from app.services.image_info import sniff_image_size
+from app.services.task_queue import RetryableError
 
 # Set up the model
 MODEL_NAME = "gemini-2.5-flash"
 PROMPT = """Please convert the following image to a self-contained,\\
 compilable LaTeX document, including a documentclass, necessary packages,\\
 and begin/end document environments. The image contains mathematical equations and text."""
+# Used for blocks cut out of a page, whose fragments are stitched together.
+REGION_PROMPT = (
+    "Please convert the following image, a single block cut from a larger page, "
+    "to LaTeX. Return only the LaTeX for this block, without a documentclass, "
+    "preamble or begin/end document, using only amsmath commands."
+)
+# Bump whenever PROMPT or REGION_PROMPT changes so cached conversions are not reused.
+PROMPT_VERSION = "2"
+
+# Maximum Gemini requests in flight per process.
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+# Sustained requests per second and burst size; a rate of 0 disables limiting.
+GEMINI_RATE_PER_SECOND = float(os.getenv("GEMINI_RATE_PER_SECOND", "2"))
+GEMINI_RATE_BURST = int(os.getenv("GEMINI_RATE_BURST", "4"))
+# Attempts per request before the failure is handed back to the task queue.
+GEMINI_MAX_ATTEMPTS = int(os.getenv("GEMINI_MAX_ATTEMPTS", "4"))
+# Images up to this size are sent inline instead of through the Files API.
+GEMINI_INLINE_MAX_BYTES = int(os.getenv("GEMINI_INLINE_MAX_BYTES", str(4 * 1024 * 1024)))
+# Uploaded file handles remembered for reuse.
+GEMINI_FILE_CACHE_SIZE = int(os.getenv("GEMINI_FILE_CACHE_SIZE", "256"))
+
+# Status codes worth retrying: rate limiting and server errors.
+_RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+# Uploaded files live for 48 hours; stop reusing them a little earlier.
+_FILE_LIFETIME_SECONDS = 47 * 3600
+
+_MIME_TYPES = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "gif": "image/gif",
+    "bmp": "image/bmp",
+    "webp": "image/webp",
+}
+
+# Conversions keyed by processed-image content, model and prompt version.
+ocr_cache = DiskCache(
+    storage.CACHE_DIR / "ocr",
+    ".tex",
+    max_entries=int(os.getenv("OCR_CACHE_MAX_ENTRIES", "10000")),
+    ttl_seconds=float(os.getenv("OCR_CACHE_TTL_SECONDS", str(30 * 24 * 3600))),
+    name="ocr",
+)
+
+GEMINI_REQUESTS = metrics.registry.counter(
+    "latech_gemini_requests_total",
+    "Gemini API calls by operation and outcome (ok or the error class).",
+    ["operation", "outcome"],
+)
+GEMINI_IN_FLIGHT = metrics.registry.gauge(
+    "latech_gemini_in_flight", "Conversions holding a Gemini concurrency slot."
+)
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    """An asyncio token bucket limiting the rate of requests."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        """Waits until a token is available and takes it."""
+        if self.rate <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class GeminiOCRService:
+    """Converts images to LaTeX with the async Gemini client.
+
+    The client only needs ``aio.models.generate_content`` and
+    ``aio.files.upload``/``aio.files.delete``, so a local fake with the
+    same shape can be passed in place of ``genai.Client``.
+    """
+
+    def __init__(
+        self,
+        client: Any = None,
+        model: str = MODEL_NAME,
+        max_concurrency: int = GEMINI_MAX_CONCURRENCY,
+        rate_per_second: float = GEMINI_RATE_PER_SECOND,
+        rate_burst: int = GEMINI_RATE_BURST,
+        max_attempts: int = GEMINI_MAX_ATTEMPTS,
+        inline_max_bytes: int = GEMINI_INLINE_MAX_BYTES,
+    ) -> None:
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.inline_max_bytes = inline_max_bytes
+        self._client = client
+        self._bucket = TokenBucket(rate_per_second, rate_burst)
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._files: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_lock = threading.Lock()
+
+    @property
+    def client(self) -> Any:
+        """The Gemini client, created on first use."""
+        if self._client is None:
+            self._client = genai.Client()
+        return self._client
+
+    def run(self, coro: Coroutine[Any, Any, T]) -> T:
+        """Runs a coroutine on the service's event loop and waits for it.
+
+        All requests share one loop, so the concurrency and rate limits hold
+        across every thread that calls into the service.
+        """
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever, name="gemini-ocr", daemon=True
+                ).start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def convert(
+        self, data: bytes, mime_type: str, digest: str, prompt: str = PROMPT
+    ) -> str:
+        """Converts an encoded image to LaTeX.
+
+        Args:
+            data: The encoded image.
+            mime_type: The MIME type of ``data``.
+            digest: A content hash of ``data``, used to reuse uploaded files.
+            prompt: The instruction sent with the image.
+
+        Returns:
+            The LaTeX returned by the model.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            with GEMINI_IN_FLIGHT.track():
+                image = await self._image_part(data, mime_type, digest)
+                response = await self._with_retries(
+                    "generate",
+                    lambda: self.client.aio.models.generate_content(
+                        model=self.model, contents=[image, prompt]
+                    ),
+                )
+        if not response or not response.text:
+            raise RuntimeError(
+                "Failed to convert image to LaTeX: Invalid or empty response from the model."
+            )
+        return extract_latex(response.text)
+
+    async def _image_part(self, data: bytes, mime_type: str, digest: str) -> Any:
+        """Returns the request part for an image, uploading it if it is large."""
+        if len(data) <= self.inline_max_bytes:
+            return types.Part.from_bytes(data=data, mime_type=mime_type)
+
+        cached = self._files.get(digest)
+        if cached is not None and cached[1] > time.time():
+            self._files.move_to_end(digest)
+            return cached[0]
+
+        uploaded = await self._with_retries(
+            "upload",
+            lambda: self.client.aio.files.upload(
+                file=io.BytesIO(data), config=types.UploadFileConfig(mime_type=mime_type)
+            )
+        )
+        expires = getattr(uploaded, "expiration_time", None)
+        expires_at = (
+            expires.timestamp() - 3600 if expires else time.time() + _FILE_LIFETIME_SECONDS
+        )
+        self._files[digest] = (uploaded, expires_at)
+        while len(self._files) > GEMINI_FILE_CACHE_SIZE:
+            _, (evicted, _) = self._files.popitem(last=False)
+            asyncio.ensure_future(self._delete_file(evicted))
+        return uploaded
+
+    async def _delete_file(self, uploaded: Any) -> None:
+        try:
+            await self.client.aio.files.delete(name=uploaded.name)
+        except Exception:  # pylint: disable=broad-except
+            # The file expires on its own; deleting it early is best effort.
+            pass
+
+    async def _with_retries(self, operation: str, request: Any) -> Any:
+        """Runs a request with rate limiting and jittered exponential backoff."""
+        attempt = 1
+        while True:
+            await self._bucket.acquire()
+            try:
+                result = await request()
+                GEMINI_REQUESTS.inc(operation=operation, outcome="ok")
+                return result
+            except errors.APIError as e:
+                GEMINI_REQUESTS.inc(operation=operation, outcome=f"http_{e.code}")
+                if e.code not in _RETRYABLE_CODES and (e.code or 0) < 500:
+                    raise RuntimeError(f"Failed to convert image to LaTeX: {e}") from e
+                error: Exception = e
+            except (asyncio.TimeoutError, OSError) as e:
+                GEMINI_REQUESTS.inc(operation=operation, outcome=type(e).__name__)
+                error = e
+            if attempt >= self.max_attempts:
+                # Hand the failure to the task queue, which retries much later.
+                raise RetryableError(f"Gemini API unavailable: {error}") from error
+            await asyncio.sleep(random.uniform(0, min(30.0, 0.5 * 2 ** attempt)))
+            attempt += 1
 
 
-def convert_image_to_latex(image_path: Path) -> str:
+def extract_latex(text: str) -> str:
+    """Returns the LaTeX from a model reply, unwrapping a markdown code block."""
+    # Check for a markdown embedded latex code. Extract this code and then return if it exists
+    match = re.search(r"```latex(.*)```", text, re.DOTALL)
+    if match:
+        return match.group(1).strip()
+    return text
+
+
+def mime_type_for(data: bytes) -> str:
+    """Returns the MIME type of an encoded image, defaulting to PNG."""
+    info = sniff_image_size(data[:64 * 1024])
+    return _MIME_TYPES.get(info[0], "image/png") if info else "image/png"
+
+
+ocr_service = GeminiOCRService()
+
+
+def convert_image_bytes_to_latex(
+    data: bytes, mime_type: Optional[str] = None, use_cache: bool = True
+) -> str:
+    """Converts an encoded image to LaTeX.
+
+    Args:
+        data: The encoded image.
+        mime_type: The MIME type of ``data``; sniffed when omitted.
+        use_cache: Whether to return a cached conversion of an identical image.
+
+    Returns:
+        The converted LaTeX code.
+    """
+    key = DiskCache.key_for(data, MODEL_NAME, PROMPT_VERSION)
+    if use_cache:
+        cached = ocr_cache.get_text(key)
+        if cached is not None:
+            return cached
+
+    latex = _convert(data, mime_type or mime_type_for(data))
+    ocr_cache.put_text(key, latex)
+    return latex
+
+
+@metrics.timed("ocr")
+def _convert(data: bytes, mime_type: str) -> str:
+    return ocr_service.run(ocr_service.convert(data, mime_type, DiskCache.key_for(data)))
+
+
+def convert_regions_to_latex(images: List[bytes], use_cache: bool = True) -> List[str]:
+    """Converts the PNG-encoded blocks of a page to LaTeX fragments.
+
+    Blocks missing from the cache are converted concurrently. Every block
+    that succeeds is cached before a failure is raised, so a retry only
+    converts the blocks that failed.
+
+    Args:
+        images: The encoded blocks.
+        use_cache: Whether to return cached conversions of identical blocks.
+
+    Returns:
+        One fragment per block, in the same order.
+    """
+    keys = [DiskCache.key_for(data, MODEL_NAME, "region", PROMPT_VERSION) for data in images]
+    results: List[Optional[str]] = [
+        ocr_cache.get_text(key) if use_cache else None for key in keys
+    ]
+    missing = [index for index, result in enumerate(results) if result is None]
+    if missing:
+        converted = _convert_regions([images[index] for index in missing])
+        error: Optional[BaseException] = None
+        for index, result in zip(missing, converted):
+            if isinstance(result, BaseException):
+                error = error or result
+                continue
+            ocr_cache.put_text(keys[index], result)
+            results[index] = result
+        if error is not None:
+            raise error
+    return [result or "" for result in results]
+
+
+@metrics.timed("ocr_regions")
+def _convert_regions(images: List[bytes]) -> List[Any]:
+    async def convert_all():
+        return await asyncio.gather(
+            *(
+                ocr_service.convert(data, "image/png", DiskCache.key_for(data), REGION_PROMPT)
+                for data in images
+            ),
+            return_exceptions=True,
+        )
+
+    return ocr_service.run(convert_all())
+
+
+def convert_image_to_latex(image_path: Path, use_cache: bool = True) -> str:
     """Converts an image to LaTeX using the Gemini 2.5 Pro model.
 
     Args:
         image_path: The path to the image to convert.
+        use_cache: Whether to return a cached conversion of an identical image.
 
     Returns:
         The converted LaTeX code.
     """
-    try:
-        file = client.files.upload(file=image_path)
-        response = client.models.generate_content(
-            model=MODEL_NAME, contents=[file, PROMPT]
-        )
-        if not response or not response.text:
-            raise ValueError("Invalid or empty response from the model.")
-
-        # Check for a markdown embedded latex code. Extract this code and then return if it exists
-        match = re.search(r"```latex(.*)```", response.text, re.DOTALL)
-        if match:
-            return match.group(1).strip()
-        return response.text
-    except ValueError as e:
-        # Re-raise exceptions to be handled by the calling router
-        raise RuntimeError(f"Failed to convert image to LaTeX: {e}") from e
+    return convert_image_bytes_to_latex(image_path.read_bytes(), use_cache=use_cache)
@@ -0,0 +1,164 @@
+"""This module memoizes preprocessing stages for interactive previews.
+
+Preview requests for the same job usually differ in a single option. The
+cache keeps the decoded upload and every intermediate stage output, keyed
+by the chain of stage keys that produced it, so a changed option only
+re-runs the stages from that option onwards.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Hashable, Optional, Tuple
+
+import numpy as np
+
+from app.models.schemas import PreprocessOptions
+from app.services import metrics
+from app.services.image_preprocess import (
+    Viewport,
+    choose_options,
+    decode_image,
+    preprocess_stages,
+)
+
+
+class PreviewCache:
+    """A memory-bounded, per-job cache of preprocessing stage outputs."""
+
+    def __init__(self, max_bytes: int, idle_seconds: float) -> None:
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, Hashable], np.ndarray]" = OrderedDict()
+        self._last_used: Dict[str, float] = {}
+        # Auto-mode options resolved per job and upload.
+        self._resolved: Dict[Tuple[str, str], PreprocessOptions] = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @metrics.timed("preview")
+    def render(
+        self,
+        job_id: str,
+        src_path: Path,
+        options: PreprocessOptions,
+        viewport: Optional[Viewport] = None,
+    ) -> np.ndarray:
+        """Returns the preprocessed preview image for a job.
+
+        Args:
+            job_id: The ID of the job.
+            src_path: The path to the job's uploaded image.
+            options: The preprocessing options.
+            viewport: The box the preview is shown in. The upload is decoded
+                at reduced scale and the result fitted to the box.
+
+        Returns:
+            The preprocessed image. It is shared with the cache and read-only.
+        """
+        if options.auto:
+            options = self._resolve(job_id, src_path, options)
+        stages = preprocess_stages(options, viewport)
+        keys = [("decoded", str(src_path), viewport)]
+        for stage_key, _ in stages:
+            keys.append(keys[-1] + (stage_key,))
+
+        # Find the longest prefix of the pipeline that is already cached.
+        start, image = 0, None
+        with self._lock:
+            self._expire_idle()
+            self._last_used[job_id] = time.monotonic()
+            for depth in range(len(keys) - 1, -1, -1):
+                image = self._get((job_id, keys[depth]))
+                if image is not None:
+                    start = depth
+                    break
+            if image is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if image is None:
+            image = self._put((job_id, keys[0]), decode_image(src_path, viewport))
+        for depth in range(start + 1, len(keys)):
+            result = stages[depth - 1][1](image)
+            # Stages that did nothing return their input; don't store it twice.
+            if result is not image:
+                image = self._put((job_id, keys[depth]), result)
+        return image
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the hit and miss counters and the current cache size."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+    def discard(self, job_id: str) -> None:
+        """Drops every cached stage output of a job."""
+        with self._lock:
+            self._drop_job(job_id)
+
+    def _resolve(
+        self, job_id: str, src_path: Path, options: PreprocessOptions
+    ) -> PreprocessOptions:
+        # The statistics need the full-resolution image, so they are only
+        # computed on the first auto preview of an upload. Only the resize
+        # comes from the request.
+        key = (job_id, str(src_path))
+        with self._lock:
+            resolved = self._resolved.get(key)
+        if resolved is None:
+            resolved = choose_options(decode_image(src_path), options)
+            with self._lock:
+                self._resolved[key] = resolved
+        return resolved.copy(update={"resize": options.resize})
+
+    def _get(self, key: Tuple[str, Hashable]) -> Optional[np.ndarray]:
+        image = self._entries.get(key)
+        if image is not None:
+            self._entries.move_to_end(key)
+        return image
+
+    def _put(self, key: Tuple[str, Hashable], image: np.ndarray) -> np.ndarray:
+        # Cached arrays are shared between requests and must not be mutated.
+        image.flags.writeable = False
+        if image.nbytes > self.max_bytes:
+            return image
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.nbytes
+            self._entries[key] = image
+            self._bytes += image.nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+        return image
+
+    def _expire_idle(self) -> None:
+        now = time.monotonic()
+        for job_id, last_used in list(self._last_used.items()):
+            if now - last_used > self.idle_seconds:
+                self._drop_job(job_id)
+
+    def _drop_job(self, job_id: str) -> None:
+        for key in [key for key in self._entries if key[0] == job_id]:
+            self._bytes -= self._entries.pop(key).nbytes
+        self._last_used.pop(job_id, None)
+        for key in [key for key in self._resolved if key[0] == job_id]:
+            del self._resolved[key]
+
+
+preview_cache = PreviewCache(
+    max_bytes=int(os.getenv("PREVIEW_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+    idle_seconds=float(os.getenv("PREVIEW_CACHE_IDLE_SECONDS", "600")),
+)
+metrics.register_cache("preview", preview_cache.stats)
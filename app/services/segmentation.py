@@ -0,0 +1,169 @@
+"""This module splits a page into text and equation blocks for OCR.
+
+Large pages are slow to convert and fail as a whole. In segmented mode the
+page is cut into blocks found with morphology and connected components,
+every block is converted on its own and concurrently, and the fragments
+are stitched back together in reading order. Block conversions are cached
+by content, so retrying a page only redoes the blocks that failed.
+"""
+
+import os
+import re
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from app.services import metrics
+from app.services.image_preprocess import PROCESSED_PNG_COMPRESSION
+from app.services.latex_compile import wrap_fragment
+from app.services.ocr_to_latex import convert_regions_to_latex
+
+# An (x, y, width, height) box in pixels.
+Region = Tuple[int, int, int, int]
+
+# Pages with more blocks than this are converted whole.
+SEGMENT_MAX_REGIONS = int(os.getenv("SEGMENT_MAX_REGIONS", "24"))
+# Components smaller than this fraction of the page are treated as noise.
+SEGMENT_MIN_AREA_FRACTION = float(os.getenv("SEGMENT_MIN_AREA_FRACTION", "0.0005"))
+
+
+@metrics.timed("segment")
+def find_regions(image: np.ndarray) -> List[Region]:
+    """Finds the text and equation blocks of a page.
+
+    Characters are smeared into lines with a wide closing, lines become
+    connected components, and lines that are close above each other and
+    overlap horizontally are merged into blocks, which keeps multi-line
+    equations and fractions together.
+
+    Args:
+        image: The page, dark ink on a light background.
+
+    Returns:
+        The padded blocks in reading order.
+    """
+    if image.ndim == 2:
+        gray = image
+    elif image.shape[2] == 1:
+        gray = image[:, :, 0]
+    else:
+        # Pages decoded unchanged may carry an alpha channel.
+        code = cv2.COLOR_BGRA2GRAY if image.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+        gray = cv2.cvtColor(image, code)
+    height, width = gray.shape
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    kernel = cv2.getStructuringElement(
+        cv2.MORPH_RECT, (max(3, width // 40), max(1, height // 300))
+    )
+    lines = cv2.morphologyEx(ink, cv2.MORPH_CLOSE, kernel)
+    count, _, stats, _ = cv2.connectedComponentsWithStats(lines, connectivity=8)
+
+    min_area = SEGMENT_MIN_AREA_FRACTION * width * height
+    boxes = [
+        tuple(int(value) for value in stats[index, :4])
+        for index in range(1, count)
+        if stats[index, cv2.CC_STAT_AREA] >= min_area
+    ]
+    padding = max(4, min(width, height) // 100)
+    return _reading_order([_pad(box, padding, width, height) for box in _merge_lines(boxes)])
+
+
+def _merge_lines(boxes: List[Region]) -> List[Region]:
+    if not boxes:
+        return []
+    gap = 0.6 * float(np.median([box[3] for box in boxes]))
+    merged = sorted(boxes, key=lambda box: box[1])
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(merged)):
+            for j in range(i + 1, len(merged)):
+                a, b = merged[i], merged[j]
+                vertical_gap = max(a[1], b[1]) - min(a[1] + a[3], b[1] + b[3])
+                overlap = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+                if vertical_gap <= gap and overlap > 0:
+                    x, y = min(a[0], b[0]), min(a[1], b[1])
+                    merged[i] = (
+                        x,
+                        y,
+                        max(a[0] + a[2], b[0] + b[2]) - x,
+                        max(a[1] + a[3], b[1] + b[3]) - y,
+                    )
+                    del merged[j]
+                    changed = True
+                    break
+            if changed:
+                break
+    return merged
+
+
+def _pad(box: Region, padding: int, width: int, height: int) -> Region:
+    x, y = max(0, box[0] - padding), max(0, box[1] - padding)
+    right = min(width, box[0] + box[2] + padding)
+    bottom = min(height, box[1] + box[3] + padding)
+    return x, y, right - x, bottom - y
+
+
+def _reading_order(boxes: List[Region]) -> List[Region]:
+    # Group boxes whose vertical centers fall within a row, then read each
+    # row left to right.
+    rows: List[List[Region]] = []
+    row_bottom = -1
+    for box in sorted(boxes, key=lambda box: box[1]):
+        if rows and box[1] + box[3] / 2 < row_bottom:
+            rows[-1].append(box)
+            row_bottom = max(row_bottom, box[1] + box[3])
+        else:
+            rows.append([box])
+            row_bottom = box[1] + box[3]
+    return [box for row in rows for box in sorted(row, key=lambda box: box[0])]
+
+
+def crop_regions(image: np.ndarray, regions: List[Region]) -> List[bytes]:
+    """Returns each region of an image encoded as PNG."""
+    crops = []
+    params = [cv2.IMWRITE_PNG_COMPRESSION, PROCESSED_PNG_COMPRESSION]
+    for x, y, w, h in regions:
+        success, buffer = cv2.imencode(".png", image[y:y + h, x:x + w], params)
+        if not success:
+            raise IOError("Failed to encode page region")
+        crops.append(buffer.tobytes())
+    return crops
+
+
+def _body_of(fragment: str) -> str:
+    """Strips a preamble and document environment the model added anyway."""
+    match = re.search(r"\\begin\{document\}(.*?)\\end\{document\}", fragment, re.DOTALL)
+    return (match.group(1) if match else fragment).strip()
+
+
+def stitch_fragments(fragments: List[str]) -> str:
+    """Joins per-region LaTeX fragments into one document.
+
+    Args:
+        fragments: The fragments in reading order.
+
+    Returns:
+        A complete LaTeX document.
+    """
+    bodies = [_body_of(fragment) for fragment in fragments]
+    return wrap_fragment("\n\n".join(body for body in bodies if body))
+
+
+def convert_segmented(image: np.ndarray, use_cache: bool = True) -> Optional[str]:
+    """Converts a page to LaTeX block by block.
+
+    Args:
+        image: The preprocessed page.
+        use_cache: Whether cached block conversions may be reused.
+
+    Returns:
+        The stitched LaTeX document, or None if the page has a single block
+        or too many to be worth splitting; convert it whole instead.
+    """
+    regions = find_regions(image)
+    if len(regions) <= 1 or len(regions) > SEGMENT_MAX_REGIONS:
+        return None
+    fragments = convert_regions_to_latex(crop_regions(image, regions), use_cache=use_cache)
+    return stitch_fragments(fragments)
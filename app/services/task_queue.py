@@ -0,0 +1,290 @@
+"""This module implements a durable, SQLite-backed queue of pipeline tasks.
+
+The API enqueues one task per pipeline stage and worker processes claim
+them. A claim is a lease: a worker that dies without finishing lets its
+lease expire and the task becomes claimable again. Failed attempts are
+retried with exponential backoff, and the number of concurrently running
+tasks of each stage is capped across all workers.
+"""
+
+import json
+import os
+import random
+import time
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import and_, func, or_, text
+from sqlalchemy.orm import Session
+
+from app.database import SessionLocal
+from app.models.task import Task
+
+
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", "5"))
+TASK_LEASE_SECONDS = float(os.getenv("TASK_LEASE_SECONDS", "60"))
+TASK_BACKOFF_BASE_SECONDS = float(os.getenv("TASK_BACKOFF_BASE_SECONDS", "2"))
+TASK_BACKOFF_MAX_SECONDS = float(os.getenv("TASK_BACKOFF_MAX_SECONDS", "300"))
+# Seconds done and failed tasks are kept before purge removes them.
+TASK_RETENTION_SECONDS = float(os.getenv("TASK_RETENTION_SECONDS", str(7 * 24 * 3600)))
+
+# Task states.
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Claims a candidate task unless another worker got it first or the stage
+# is already running at its concurrency limit. Expired leases count as
+# available, which is how tasks of crashed workers are recovered.
+_CLAIM_SQL = text(
+    """
+    UPDATE tasks
+    SET status = :running, worker_id = :worker_id,
+        lease_expires_at = :now + :lease, attempts = attempts + 1
+    WHERE task_id = :task_id AND attempts < max_attempts AND (
+        (status = :queued AND available_at <= :now)
+        OR (status = :running AND lease_expires_at < :now)
+    )
+    AND (
+        SELECT COUNT(*) FROM tasks
+        WHERE stage = :stage AND status = :running AND lease_expires_at >= :now
+    ) < :limit
+    """
+)
+
+
+class RetryableError(Exception):
+    """Raised by stage runners for transient failures worth retrying."""
+
+
+def enqueue(
+    db: Session,
+    job_id: str,
+    stage: str,
+    payload: Optional[Dict[str, Any]] = None,
+    delay: float = 0.0,
+    commit: bool = True,
+) -> Task:
+    """Adds a task to the queue.
+
+    Args:
+        db: The database session.
+        job_id: The ID of the job the task belongs to.
+        stage: The pipeline stage to run.
+        payload: Stage arguments, serialized as JSON.
+        delay: Seconds before the task becomes claimable.
+        commit: Whether to commit right away, or leave it to the caller so
+            the task is created in the caller's transaction.
+
+    Returns:
+        The queued task.
+    """
+    now = time.time()
+    task = Task(
+        job_id=job_id,
+        stage=stage,
+        payload=json.dumps(payload or {}),
+        status=QUEUED,
+        attempts=0,
+        max_attempts=TASK_MAX_ATTEMPTS,
+        available_at=now + delay,
+        created_at=now,
+    )
+    db.add(task)
+    if commit:
+        db.commit()
+    return task
+
+
+def claim(
+    stage: str, worker_id: str, limit: int, lease_seconds: float = TASK_LEASE_SECONDS
+) -> Optional[Task]:
+    """Claims the next available task of a stage.
+
+    Args:
+        stage: The pipeline stage.
+        worker_id: An identifier of the claiming worker.
+        limit: The maximum number of tasks of this stage running at once.
+        lease_seconds: How long the claim is valid without a heartbeat.
+
+    Returns:
+        The claimed task, detached from its session, or None.
+    """
+    db = SessionLocal()
+    try:
+        now = time.time()
+        candidate = (
+            db.query(Task.task_id)
+            .filter(
+                Task.stage == stage,
+                Task.attempts < Task.max_attempts,
+                or_(
+                    and_(Task.status == QUEUED, Task.available_at <= now),
+                    and_(Task.status == RUNNING, Task.lease_expires_at < now),
+                ),
+            )
+            .order_by(Task.available_at)
+            .first()
+        )
+        if candidate is None:
+            return None
+        result = db.execute(
+            _CLAIM_SQL,
+            {
+                "task_id": candidate.task_id,
+                "running": RUNNING,
+                "queued": QUEUED,
+                "worker_id": worker_id,
+                "now": now,
+                "lease": lease_seconds,
+                "stage": stage,
+                "limit": limit,
+            },
+        )
+        db.commit()
+        if result.rowcount != 1:
+            return None
+        task = db.query(Task).filter(Task.task_id == candidate.task_id).first()
+        db.expunge(task)
+        return task
+    finally:
+        db.close()
+
+
+def heartbeat(task_ids: List[int], worker_id: str, lease_seconds: float = TASK_LEASE_SECONDS):
+    """Extends the leases of running tasks held by a worker."""
+    if not task_ids:
+        return
+    db = SessionLocal()
+    try:
+        db.query(Task).filter(
+            Task.task_id.in_(task_ids),
+            Task.worker_id == worker_id,
+            Task.status == RUNNING,
+        ).update(
+            {Task.lease_expires_at: time.time() + lease_seconds},
+            synchronize_session=False,
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def complete(task_id: int, worker_id: str):
+    """Marks a claimed task as done."""
+    _finish(task_id, worker_id, {Task.status: DONE, Task.lease_expires_at: None})
+
+
+def fail(task_id: int, worker_id: str, error: str, retry: bool) -> bool:
+    """Records a failed attempt of a claimed task.
+
+    Args:
+        task_id: The ID of the task.
+        worker_id: The worker holding the task.
+        error: A description of the failure.
+        retry: Whether the failure is transient.
+
+    Returns:
+        True if the task was rescheduled, False if it failed for good.
+    """
+    db = SessionLocal()
+    try:
+        task = (
+            db.query(Task)
+            .filter(Task.task_id == task_id, Task.worker_id == worker_id)
+            .first()
+        )
+        if task is None:
+            return False
+        task.last_error = error
+        task.lease_expires_at = None
+        if retry and task.attempts < task.max_attempts:
+            task.status = QUEUED
+            task.available_at = time.time() + backoff(task.attempts)
+        else:
+            task.status = FAILED
+        db.commit()
+        return task.status == QUEUED
+    finally:
+        db.close()
+
+
+def backoff(attempts: int) -> float:
+    """Returns the jittered delay before retry number ``attempts``."""
+    delay = min(TASK_BACKOFF_MAX_SECONDS, TASK_BACKOFF_BASE_SECONDS * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.5)
+
+
+def reap() -> List[str]:
+    """Fails tasks whose lease expired after their last allowed attempt.
+
+    Returns:
+        The job IDs of the reaped tasks.
+    """
+    db = SessionLocal()
+    try:
+        tasks = (
+            db.query(Task)
+            .filter(
+                Task.status == RUNNING,
+                Task.lease_expires_at < time.time(),
+                Task.attempts >= Task.max_attempts,
+            )
+            .all()
+        )
+        for task in tasks:
+            task.status = FAILED
+            task.last_error = "Worker lease expired"
+        db.commit()
+        return [task.job_id for task in tasks]
+    finally:
+        db.close()
+
+
+def purge(now: Optional[float] = None) -> int:
+    """Deletes done and failed tasks older than the retention window.
+
+    Args:
+        now: The current time, defaulting to the clock.
+
+    Returns:
+        The number of tasks deleted.
+    """
+    cutoff = (now if now is not None else time.time()) - TASK_RETENTION_SECONDS
+    db = SessionLocal()
+    try:
+        # available_at is the start of the task's last attempt.
+        deleted = (
+            db.query(Task)
+            .filter(Task.status.in_([DONE, FAILED]), Task.available_at < cutoff)
+            .delete(synchronize_session=False)
+        )
+        db.commit()
+        return deleted
+    finally:
+        db.close()
+
+
+def queue_depth(db: Session) -> Dict[str, Dict[str, int]]:
+    """Returns the number of queued and running tasks per stage."""
+    depth: Dict[str, Dict[str, int]] = {}
+    rows = (
+        db.query(Task.stage, Task.status, func.count())
+        .filter(Task.status.in_([QUEUED, RUNNING]))
+        .group_by(Task.stage, Task.status)
+        .all()
+    )
+    for stage, status, count in rows:
+        depth.setdefault(stage, {})[status] = count
+    return depth
+
+
+def _finish(task_id: int, worker_id: str, values: Dict[Any, Any]):
+    db = SessionLocal()
+    try:
+        db.query(Task).filter(
+            Task.task_id == task_id, Task.worker_id == worker_id
+        ).update(values, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
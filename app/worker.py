@@ -0,0 +1,253 @@
+"""Worker processes that run queued pipeline tasks.
+
+Run with ``python -m app.worker``. Each worker runs a pool of threads per
+stage; the per-stage limits are enforced across all worker processes by
+the task queue, so more workers can be added without overloading
+pdflatex or the Gemini quota.
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterable, List, Set
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from app.database import SessionLocal, init_db
+# Imported so their tables are registered before init_db runs.
+from app.models import batch, blob, job_event, task  # pylint: disable=unused-import
+from app.models import job as job_model
+from app.models.schemas import PipelineRequest, PreprocessOptions
+from app.routers.compile import run_compilation
+from app.routers.convert import run_conversion
+from app.routers.pipeline import run_pipeline
+from app.routers.preprocess import run_preprocessing
+from app.services import lifecycle, metrics, task_queue
+from app.services.image_preprocess import configure_threads
+
+
+logger = logging.getLogger("app.worker")
+
+# Seconds an idle worker thread waits before polling the queue again.
+WORKER_POLL_SECONDS = float(os.getenv("WORKER_POLL_SECONDS", "0.5"))
+
+# Maximum concurrently running tasks per stage, across all workers.
+STAGE_CONCURRENCY = {
+    "preprocess": int(os.getenv("WORKER_PREPROCESS_CONCURRENCY", str(os.cpu_count() or 1))),
+    "convert": int(os.getenv("WORKER_CONVERT_CONCURRENCY", "8")),
+    "compile": int(os.getenv("WORKER_COMPILE_CONCURRENCY", "2")),
+    "pipeline": int(os.getenv("WORKER_PIPELINE_CONCURRENCY", "4")),
+}
+
+# Seconds between lifecycle sweeps of the data directory; 0 disables them.
+LIFECYCLE_SWEEP_INTERVAL_SECONDS = float(os.getenv("LIFECYCLE_SWEEP_INTERVAL_SECONDS", "3600"))
+# Port serving this worker's metrics; 0 disables it.
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "0"))
+
+TASK_SECONDS = metrics.registry.histogram(
+    "latech_task_duration_seconds", "Wall time of queued tasks by stage.", ["stage"]
+)
+TASK_OUTCOMES = metrics.registry.counter(
+    "latech_tasks_total", "Finished task attempts by stage and outcome.", ["stage", "outcome"]
+)
+TASKS_IN_FLIGHT = metrics.registry.gauge(
+    "latech_tasks_in_flight", "Tasks this worker is running.", ["stage"]
+)
+
+
+def _run_preprocess(job_id: str, payload: Dict[str, Any]):
+    run_preprocessing(job_id, PreprocessOptions(**payload.get("options", {})))
+
+
+def _run_convert(job_id: str, payload: Dict[str, Any]):
+    run_conversion(job_id, payload.get("use_cache", True), payload.get("segment", False))
+
+
+def _run_compile(job_id: str, payload: Dict[str, Any]):  # pylint: disable=unused-argument
+    run_compilation(job_id)
+
+
+def _run_pipeline(job_id: str, payload: Dict[str, Any]):
+    run_pipeline(job_id, PipelineRequest(**payload.get("request", {})))
+
+
+# Stage runners and the job status each one leaves behind on success.
+STAGES: Dict[str, Any] = {
+    "preprocess": (_run_preprocess, "ready to convert"),
+    "convert": (_run_convert, "ready to compile"),
+    "compile": (_run_compile, "complete"),
+    "pipeline": (_run_pipeline, "complete"),
+}
+
+
+def _job_status(job_id: str) -> str:
+    db = SessionLocal()
+    try:
+        job = db.query(job_model.Job).filter(job_model.Job.job_id == job_id).first()
+        return job.status if job else ""
+    finally:
+        db.close()
+
+
+def mark_job_failed(job_id: str, error: str):
+    """Marks a job failed after its task ran out of attempts."""
+    db = SessionLocal()
+    try:
+        job = db.query(job_model.Job).filter(job_model.Job.job_id == job_id).first()
+        if job:
+            job.status = "failed"
+            job.error_message = error
+            db.commit()
+    finally:
+        db.close()
+
+
+class WorkerPool:
+    """Claims and runs queued tasks with a fixed number of threads per stage."""
+
+    def __init__(self, stages: Iterable[str]) -> None:
+        self.stages = list(stages)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._running: Set[int] = set()
+        self._running_lock = threading.Lock()
+
+    def start(self):
+        """Starts the worker threads, the lease heartbeat and the sweeper."""
+        # Share OpenCV's threads between the stages that preprocess images.
+        image_threads = sum(
+            STAGE_CONCURRENCY[stage] for stage in self.stages if stage in ("preprocess", "pipeline")
+        )
+        if image_threads:
+            threads = configure_threads(image_threads)
+            logger.info("OpenCV uses %d threads per preprocessing task", threads)
+        for stage in self.stages:
+            for index in range(STAGE_CONCURRENCY[stage]):
+                self._spawn(f"{stage}-{index}", self._loop, stage)
+        self._spawn("heartbeat", self._heartbeat_loop)
+        if LIFECYCLE_SWEEP_INTERVAL_SECONDS > 0:
+            self._spawn("lifecycle", self._sweep_loop)
+
+    def stop(self, timeout: float = 30.0):
+        """Stops claiming tasks and waits for running ones to finish."""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _spawn(self, name: str, target: Callable[..., None], *args: Any):
+        thread = threading.Thread(target=target, args=args, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _loop(self, stage: str):
+        while not self._stop.is_set():
+            try:
+                claimed = task_queue.claim(stage, self.worker_id, STAGE_CONCURRENCY[stage])
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Failed to claim a %s task", stage)
+                claimed = None
+            if claimed is None:
+                self._stop.wait(WORKER_POLL_SECONDS)
+                continue
+            with self._running_lock:
+                self._running.add(claimed.task_id)
+            try:
+                self._execute(claimed)
+            finally:
+                with self._running_lock:
+                    self._running.discard(claimed.task_id)
+
+    def _execute(self, claimed):
+        runner, ready_status = STAGES[claimed.stage]
+        payload = json.loads(claimed.payload or "{}")
+        start = time.perf_counter()
+        try:
+            with TASKS_IN_FLIGHT.track(stage=claimed.stage):
+                runner(claimed.job_id, payload)
+        except Exception as e:  # pylint: disable=broad-except
+            TASK_SECONDS.observe(time.perf_counter() - start, stage=claimed.stage)
+            # Runners record permanent failures on the job themselves, so
+            # anything that escapes them is transient.
+            logger.warning("Task %s (%s) failed: %s", claimed.task_id, claimed.stage, e)
+            if task_queue.fail(claimed.task_id, self.worker_id, str(e), retry=True):
+                TASK_OUTCOMES.inc(stage=claimed.stage, outcome="retry")
+            else:
+                TASK_OUTCOMES.inc(stage=claimed.stage, outcome="failed")
+                mark_job_failed(claimed.job_id, str(e))
+            return
+
+        TASK_SECONDS.observe(time.perf_counter() - start, stage=claimed.stage)
+        TASK_OUTCOMES.inc(stage=claimed.stage, outcome="done")
+        task_queue.complete(claimed.task_id, self.worker_id)
+        chain = payload.get("then", [])
+        if chain and _job_status(claimed.job_id) == ready_status:
+            db = SessionLocal()
+            try:
+                task_queue.enqueue(db, claimed.job_id, chain[0], {"then": chain[1:]})
+            finally:
+                db.close()
+
+    def _heartbeat_loop(self):
+        interval = task_queue.TASK_LEASE_SECONDS / 3
+        while not self._stop.wait(interval):
+            try:
+                with self._running_lock:
+                    running = list(self._running)
+                task_queue.heartbeat(running, self.worker_id)
+                for job_id in task_queue.reap():
+                    mark_job_failed(job_id, "Worker lease expired")
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Heartbeat failed")
+
+    def _sweep_loop(self):
+        # Sweeps can scan large directories, so they get their own thread
+        # rather than delaying lease heartbeats.
+        while not self._stop.wait(LIFECYCLE_SWEEP_INTERVAL_SECONDS):
+            try:
+                freed = lifecycle.sweep()
+                logger.info("Lifecycle sweep freed %d bytes", sum(freed.values()))
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Lifecycle sweep failed")
+
+
+def main():
+    """Runs a worker pool until SIGINT or SIGTERM."""
+    parser = argparse.ArgumentParser(description="Runs LaTech pipeline workers.")
+    parser.add_argument(
+        "--stages",
+        default=",".join(STAGES),
+        help="Comma-separated stages to run (default: all).",
+    )
+    args = parser.parse_args()
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    logging.basicConfig(level=logging.INFO)
+    init_db()
+    metrics.serve(WORKER_METRICS_PORT)
+    pool = WorkerPool(stages)
+    pool.start()
+    logger.info("Worker %s running stages %s", pool.worker_id, ", ".join(stages))
+
+    stopped = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stopped.set())
+    while not stopped.wait(1.0):
+        pass
+    logger.info("Stopping worker %s", pool.worker_id)
+    pool.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Deterministic stand-ins for the external services the pipeline calls."""
+
+import asyncio
+import hashlib
+import random
+from dataclasses import dataclass, field
+from typing import Any, List, Optional
+
+from google.genai import errors
+
+# A small document the fake model returns, so compile stays realistic.
+FAKE_LATEX = """\\documentclass{article}
+\\usepackage{amsmath}
+\\begin{document}
+\\begin{equation}
+  %s
+\\end{equation}
+\\end{document}
+"""
+
+
+@dataclass
+class _Response:
+    text: str
+
+
+@dataclass
+class _File:
+    name: str
+    expiration_time: Optional[Any] = None
+
+
+class _Models:
+    def __init__(self, fake: "FakeGeminiClient") -> None:
+        self._fake = fake
+
+    async def generate_content(self, model: str, contents: List[Any]) -> _Response:
+        # pylint: disable=unused-argument
+        return await self._fake.respond(contents)
+
+
+class _Files:
+    def __init__(self, fake: "FakeGeminiClient") -> None:
+        self._fake = fake
+
+    async def upload(self, file: Any, config: Any = None) -> _File:
+        # pylint: disable=unused-argument
+        await asyncio.sleep(self._fake.latency)
+        self._fake.uploads += 1
+        return _File(name=f"files/{self._fake.uploads}")
+
+    async def delete(self, name: str) -> None:
+        # pylint: disable=unused-argument
+        return None
+
+
+@dataclass
+class FakeGeminiClient:
+    """A fake ``genai.Client`` with fixed latency and an optional failure rate.
+
+    Replies are derived from a hash of the request, so the same image always
+    converts to the same LaTeX. Failures raise the 503 the real API returns
+    when overloaded, which exercises the service's retry path.
+
+    Attributes:
+        latency: Seconds each request takes.
+        failure_rate: Fraction of requests that fail with a 503.
+        seed: Seeds the failure draws.
+    """
+
+    latency: float = 0.05
+    failure_rate: float = 0.0
+    seed: int = 0
+    calls: int = 0
+    uploads: int = 0
+    _random: random.Random = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self._random = random.Random(self.seed)
+        self.aio = type("Aio", (), {})()
+        self.aio.models = _Models(self)
+        self.aio.files = _Files(self)
+
+    async def respond(self, contents: List[Any]) -> _Response:
+        """Returns the reply for a generate_content request."""
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if self._random.random() < self.failure_rate:
+            raise errors.ServerError(503, {"error": {"message": "fake overload"}})
+        digest = hashlib.sha256(repr(contents[0])[:4096].encode()).hexdigest()[:8]
+        return _Response(text=f"```latex\n{FAKE_LATEX % ('x_{' + digest + '} = 1')}```")
+
+
+def fake_pdflatex_script(latency: float = 0.1) -> str:
+    """Returns a shell script that stands in for ``pdflatex``.
+
+    It sleeps for ``latency`` seconds and writes a minimal PDF named after
+    the input (or ``-jobname``) into ``-output-directory``.
+    """
+    return f"""#!/bin/sh
+out=.
+job=
+src=
+while [ $# -gt 0 ]; do
+  case "$1" in
+    -output-directory) out="$2"; shift ;;
+    -jobname=*) job="${{1#-jobname=}}" ;;
+    -ini|-fmt=*|-interaction=*|-no-shell-escape|-halt-on-error) ;;
+    *) src="$1" ;;
+  esac
+  shift
+done
+[ -z "$job" ] && job=$(basename "$src" .tex)
+sleep {latency}
+printf '%%PDF-1.4\\n%%%%EOF\\n' > "$out/$job.pdf"
+"""
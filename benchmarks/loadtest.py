@@ -0,0 +1,347 @@
+"""End-to-end load test of one LaTech instance with stubbed externals.
+
+Starts ``app.main:app`` under uvicorn and an in-process worker pool in a
+scratch data directory, with a fake Gemini client and, unless
+``--pdflatex real``, a fake pdflatex. N client threads then drive a mix of
+user sessions (upload, previews, preprocess, convert, compile, polling the
+status until each stage finishes) and browsing (job listing and status
+lookups) for a fixed duration. Run from the repository root::
+
+    python -m benchmarks.loadtest --clients 20 --duration 60 --output load.json
+
+The report lists throughput, latency percentiles and error rates per
+endpoint, and the distribution of job completion times.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import stat
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+# Session steps and the status each one waits for.
+_STAGES = [
+    ("preprocess", "ready to convert"),
+    ("convert", "ready to compile"),
+    ("compile", "complete"),
+]
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """Returns p50/p90/p99/max of a list of seconds, in milliseconds."""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))] * 1000
+
+    return {
+        "p50_ms": pick(0.50),
+        "p90_ms": pick(0.90),
+        "p99_ms": pick(0.99),
+        "max_ms": ordered[-1] * 1000,
+        "mean_ms": statistics.fmean(ordered) * 1000,
+    }
+
+
+class Recorder:
+    """Collects request latencies per endpoint and job completion times."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.completions: List[float] = []
+        self.failed_jobs = 0
+        self.timed_out_jobs = 0
+
+    def request(self, endpoint: str, seconds: float, error: Optional[str]) -> None:
+        """Records one request."""
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if error:
+                self.errors[endpoint][error] += 1
+
+    def job(self, seconds: Optional[float], status: str) -> None:
+        """Records a finished session's job."""
+        with self._lock:
+            if status == "complete" and seconds is not None:
+                self.completions.append(seconds)
+            elif status == "failed":
+                self.failed_jobs += 1
+            else:
+                self.timed_out_jobs += 1
+
+    def report(self, duration: float) -> Dict[str, Any]:
+        """Summarizes everything recorded over ``duration`` seconds."""
+        with self._lock:
+            endpoints = {}
+            for endpoint, samples in sorted(self.latencies.items()):
+                errors = dict(self.errors.get(endpoint, {}))
+                endpoints[endpoint] = {
+                    "requests": len(samples),
+                    "throughput_rps": len(samples) / duration,
+                    "error_rate": sum(errors.values()) / len(samples),
+                    "errors": errors,
+                    **percentiles(samples),
+                }
+            return {
+                "endpoints": endpoints,
+                "jobs": {
+                    "completed": len(self.completions),
+                    "failed": self.failed_jobs,
+                    "timed_out": self.timed_out_jobs,
+                    "completion_time": percentiles(self.completions),
+                },
+            }
+
+
+class Client:
+    """One simulated user with a keep-alive HTTP connection."""
+
+    def __init__(self, host: str, port: int, recorder: Recorder, args: argparse.Namespace,
+                 images: List[bytes], seed: int) -> None:
+        self.host = host
+        self.port = port
+        self.recorder = recorder
+        self.args = args
+        self.images = images
+        self.random = random.Random(seed)
+        self.connection = http.client.HTTPConnection(host, port, timeout=120)
+        self.job_ids: List[str] = []
+
+    def call(self, method: str, endpoint: str, path: str, body: Optional[bytes] = None,
+             headers: Optional[Dict[str, str]] = None) -> Tuple[int, bytes]:
+        """Sends a request and records it under ``endpoint``."""
+        start = time.perf_counter()
+        try:
+            self.connection.request(method, path, body=body, headers=headers or {})
+            response = self.connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            self.connection.close()
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=120)
+            self.recorder.request(endpoint, time.perf_counter() - start, type(e).__name__)
+            return 0, b""
+        error = f"http_{response.status}" if response.status >= 400 else None
+        self.recorder.request(endpoint, time.perf_counter() - start, error)
+        return response.status, data
+
+    def post_json(self, endpoint: str, path: str, payload: Any) -> Tuple[int, bytes]:
+        """Sends a JSON POST request."""
+        return self.call("POST", endpoint, path, json.dumps(payload).encode(),
+                         {"Content-Type": "application/json"})
+
+    def upload(self, image: bytes) -> Optional[str]:
+        """Uploads an image and returns the new job ID."""
+        boundary = uuid.uuid4().hex
+        body = (
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; "
+            f"filename=\"load-{uuid.uuid4().hex[:8]}.png\"\r\n"
+            f"Content-Type: image/png\r\n\r\n"
+        ).encode() + image + f"\r\n--{boundary}--\r\n".encode()
+        status, data = self.call(
+            "POST", "POST /api/uploads", "/api/uploads", body,
+            {"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        )
+        return json.loads(data)["job_id"] if status == 200 else None
+
+    def wait_for(self, job_id: str, wanted: str, deadline: float) -> str:
+        """Polls the job status until it reaches ``wanted``, fails or times out."""
+        while time.monotonic() < deadline:
+            status, data = self.call("GET", "GET /api/status/{job_id}", f"/api/status/{job_id}")
+            if status == 200:
+                state = json.loads(data)["status"]
+                if state in (wanted, "failed"):
+                    return state
+            time.sleep(self.args.poll_interval)
+        return "timeout"
+
+    def session(self, stop_at: float) -> None:
+        """Runs one upload-to-PDF session."""
+        started = time.monotonic()
+        job_id = self.upload(self.random.choice(self.images))
+        if job_id is None:
+            return
+        self.job_ids.append(job_id)
+        options = {"grayscale": True, "adaptive_threshold": False, "denoise": False}
+        for _ in range(self.args.previews):
+            options["adaptive_threshold"] = self.random.random() < 0.5
+            self.post_json("POST /api/preview/{job_id}",
+                           f"/api/preview/{job_id}?max_width=800&max_height=600", options)
+        deadline = stop_at + self.args.job_timeout
+        for stage, wanted in _STAGES:
+            body = options if stage == "preprocess" else {}
+            self.post_json(f"POST /api/{stage}/{{job_id}}", f"/api/{stage}/{job_id}", body)
+            state = self.wait_for(job_id, wanted, deadline)
+            if state != wanted:
+                self.recorder.job(None, state)
+                return
+        self.recorder.job(time.monotonic() - started, "complete")
+
+    def browse(self) -> None:
+        """Lists recent jobs and looks at one of them."""
+        self.call("GET", "GET /api/jobs", "/api/jobs?limit=50")
+        if self.job_ids:
+            job_id = self.random.choice(self.job_ids)
+            self.call("GET", "GET /api/status/{job_id}", f"/api/status/{job_id}")
+
+    def run(self, stop_at: float) -> None:
+        """Alternates sessions and browsing until ``stop_at``."""
+        weights = [self.args.session_weight, self.args.browse_weight]
+        while time.monotonic() < stop_at:
+            if self.random.choices(["session", "browse"], weights)[0] == "session":
+                self.session(stop_at)
+            else:
+                self.browse()
+                time.sleep(self.args.think_time)
+
+
+def _prepare_environment(args: argparse.Namespace, work: Path) -> None:
+    """Points the app at a scratch directory and the fake externals."""
+    os.environ["DATA_DIR"] = str(work / "data")
+    os.environ["DATABASE_URL"] = f"sqlite:///{work / 'jobs.db'}"
+    os.environ.setdefault("GEMINI_RATE_PER_SECOND", str(args.gemini_rate))
+    if args.pdflatex == "fake":
+        from benchmarks.fakes import fake_pdflatex_script  # pylint: disable=import-outside-toplevel
+
+        bin_dir = work / "bin"
+        bin_dir.mkdir()
+        script = bin_dir / "pdflatex"
+        script.write_text(fake_pdflatex_script(args.pdflatex_latency), encoding="utf-8")
+        script.chmod(script.stat().st_mode | stat.S_IEXEC)
+        os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+        # The fake cannot dump formats.
+        os.environ["LATEX_ENGINE"] = "cold"
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Runs the load test and prints or writes a JSON report."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=10, help="Concurrent simulated users.")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to generate load.")
+    parser.add_argument("--session-weight", type=float, default=1.0,
+                        help="Relative frequency of upload-to-PDF sessions.")
+    parser.add_argument("--browse-weight", type=float, default=3.0,
+                        help="Relative frequency of job listing and status lookups.")
+    parser.add_argument("--previews", type=int, default=3, help="Previews per session.")
+    parser.add_argument("--poll-interval", type=float, default=0.25,
+                        help="Seconds between status polls.")
+    parser.add_argument("--think-time", type=float, default=0.5,
+                        help="Seconds a browsing client pauses between actions.")
+    parser.add_argument("--job-timeout", type=float, default=120.0,
+                        help="Seconds after the run a started job may take to finish.")
+    parser.add_argument("--distinct-images", type=int, default=50,
+                        help="Distinct images uploaded; fewer means more cache hits.")
+    parser.add_argument("--ocr-latency", type=float, default=2.0,
+                        help="Seconds each fake Gemini request takes.")
+    parser.add_argument("--ocr-failure-rate", type=float, default=0.02,
+                        help="Fraction of fake Gemini requests failing with a 503.")
+    parser.add_argument("--gemini-rate", type=float, default=0.0,
+                        help="GEMINI_RATE_PER_SECOND for the run; 0 disables limiting.")
+    parser.add_argument("--pdflatex", choices=["fake", "real"], default="fake")
+    parser.add_argument("--pdflatex-latency", type=float, default=0.5,
+                        help="Seconds the fake pdflatex takes.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="Write the JSON report here.")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        work = Path(tmp)
+        _prepare_environment(args, work)
+
+        # Imported after the environment is set, which the app reads at import.
+        # pylint: disable=import-outside-toplevel
+        import cv2
+        import uvicorn
+
+        from app import worker
+        from app.main import app
+        from app.services.ocr_to_latex import ocr_service
+        from benchmarks.fakes import FakeGeminiClient
+        from benchmarks.services import synthetic_equation
+
+        ocr_service._client = FakeGeminiClient(  # pylint: disable=protected-access
+            latency=args.ocr_latency, failure_rate=args.ocr_failure_rate, seed=args.seed
+        )
+        images = [
+            cv2.imencode(".png", synthetic_equation(1600, 900, seed=args.seed + index))[1].tobytes()
+            for index in range(max(1, args.distinct_images))
+        ]
+
+        pool = worker.WorkerPool(list(worker.STAGES))
+        pool.start()
+        server = uvicorn.Server(
+            uvicorn.Config(app, host="127.0.0.1", port=args.port, log_level="warning")
+        )
+        server_thread = threading.Thread(target=server.run, daemon=True)
+        server_thread.start()
+        while not server.started:
+            time.sleep(0.05)
+
+        recorder = Recorder()
+        started = time.monotonic()
+        stop_at = started + args.duration
+        clients = [
+            Client("127.0.0.1", args.port, recorder, args, images, args.seed + index)
+            for index in range(args.clients)
+        ]
+        threads = [threading.Thread(target=client.run, args=(stop_at,)) for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+
+        metrics_client = http.client.HTTPConnection("127.0.0.1", args.port, timeout=30)
+        metrics_client.request("GET", "/api/metrics")
+        server_metrics = metrics_client.getresponse().read().decode()
+
+        server.should_exit = True
+        server_thread.join(10)
+        pool.stop(timeout=10)
+
+    report = {
+        "config": {key: str(value) for key, value in vars(args).items()},
+        "elapsed_seconds": elapsed,
+        **recorder.report(elapsed),
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        args.output.write_text(text + "\n", encoding="utf-8")
+        args.output.with_suffix(".metrics.txt").write_text(server_metrics, encoding="utf-8")
+    else:
+        print(text)
+
+    for endpoint, result in report["endpoints"].items():
+        print(
+            f"{endpoint:32s} {result['requests']:7d} req {result['throughput_rps']:8.2f} rps  "
+            f"p50 {result['p50_ms']:8.1f} ms  p99 {result['p99_ms']:8.1f} ms  "
+            f"errors {result['error_rate'] * 100:5.1f}%",
+            file=sys.stderr,
+        )
+    jobs = report["jobs"]
+    print(
+        f"jobs: {jobs['completed']} completed, {jobs['failed']} failed, "
+        f"{jobs['timed_out']} timed out; completion p50 "
+        f"{jobs['completion_time'].get('p50_ms', 0) / 1000:.1f} s, p99 "
+        f"{jobs['completion_time'].get('p99_ms', 0) / 1000:.1f} s",
+        file=sys.stderr,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+"""Micro-benchmarks for the preprocessing, OCR and compile services.
+
+Run from the repository root::
+
+    python -m benchmarks.services --output bench.json
+    python -m benchmarks.services --baseline bench.json --tolerance 0.15
+
+Each case reports ops/sec, p50/p95 latency and peak traced memory. With
+``--baseline`` the run is compared against a previous JSON report and the
+exit status is 1 if any case got slower than the tolerance allows.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import cv2
+import numpy as np
+
+from app.models.schemas import PreprocessOptions, PreprocessResize
+from app.services import image_preprocess, latex_compile
+from app.services.image_preprocess import apply_preprocessing, encode_processed
+from app.services.ocr_to_latex import GeminiOCRService
+from benchmarks.fakes import FakeGeminiClient, FAKE_LATEX
+
+# (width, height) of the synthetic inputs: a phone crop, a screenshot, a photo.
+RESOLUTIONS = [(800, 300), (1920, 1080), (4032, 3024)]
+
+FRAGMENT = "\\[ \\int_0^1 x^2 \\, dx = \\frac{1}{3} \\]"
+
+
+def synthetic_equation(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """Draws a noisy, slightly uneven photo of handwritten-looking equations."""
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(200, 245, width, dtype=np.float32)
+    image = np.tile(gradient, (height, 1))
+    image += rng.normal(0, 8, size=(height, width)).astype(np.float32)
+    image = np.clip(image, 0, 255).astype(np.uint8)
+    image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    scale = max(1.0, width / 800)
+    lines = ["x^2 + y^2 = r^2", "f(x) = sum a_n x^n", "E = mc^2", "dy/dx = 2x + 1"]
+    line_height = int(60 * scale)
+    for index in range(max(1, height // line_height - 1)):
+        text = lines[index % len(lines)]
+        origin = (int(20 * scale), (index + 1) * line_height)
+        cv2.putText(
+            image, text, origin, cv2.FONT_HERSHEY_SCRIPT_SIMPLEX, 1.5 * scale,
+            (30, 30, 30), max(1, int(2 * scale)), cv2.LINE_AA,
+        )
+    return image
+
+
+def measure(
+    func: Callable[[], Any], repeat: int, warmup: int = 1, ops: int = 1
+) -> Dict[str, float]:
+    """Times a callable.
+
+    Args:
+        func: The operation to time.
+        repeat: The number of timed runs.
+        warmup: Untimed runs before measuring.
+        ops: Operations each call performs, for calls that batch work.
+
+    Returns:
+        ops_per_sec, p50_ms, p95_ms, mean_ms and peak_mem_mb.
+    """
+    for _ in range(warmup):
+        func()
+    samples: List[float] = []
+    tracemalloc.start()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            samples.append(time.perf_counter() - start)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    samples.sort()
+    p95_index = min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))
+    return {
+        "ops_per_sec": ops * len(samples) / sum(samples),
+        "p50_ms": statistics.median(samples) * 1000,
+        "p95_ms": samples[p95_index] * 1000,
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "peak_mem_mb": peak / (1024 * 1024),
+    }
+
+
+def _option_sets() -> Dict[str, PreprocessOptions]:
+    options = {}
+    for denoise, adaptive, resize in itertools.product(
+        (False, True), (False, True), (None, PreprocessResize(width=1600, height=1200))
+    ):
+        name = (
+            f"denoise={int(denoise)},adaptive={int(adaptive)},"
+            f"resize={'1600x1200' if resize else 'auto'}"
+        )
+        options[name] = PreprocessOptions(
+            denoise=denoise, adaptive_threshold=adaptive, resize=resize
+        )
+    for method in ("median", "bilateral", "nlm_fast"):
+        options[f"denoise={method}"] = PreprocessOptions(denoise=True, denoise_method=method)
+    options["auto"] = PreprocessOptions(auto=True)
+    return options
+
+
+def bench_preprocess(work: Path, repeat: int, quick: bool) -> Dict[str, Dict[str, float]]:
+    """Benchmarks apply_preprocessing across resolutions and options."""
+    results = {}
+    resolutions = RESOLUTIONS[:2] if quick else RESOLUTIONS
+    for width, height in resolutions:
+        src = work / f"input-{width}x{height}.png"
+        cv2.imwrite(str(src), synthetic_equation(width, height))
+        for name, options in _option_sets().items():
+            # Non-local means denoising on a 12 MP photo takes seconds per run.
+            runs = max(1, repeat // 5) if options.denoise and width * height > 4e6 else repeat
+            results[f"preprocess[{width}x{height},{name}]"] = measure(
+                lambda: apply_preprocessing(src, options, dst_path=None), runs
+            )
+    return results
+
+
+# Processed-image encodings: (format, PNG level, 1-bit PNG for thresholded).
+ENCODINGS = {
+    "png,level=1": ("png", 1, False),
+    "png,level=6": ("png", 6, False),
+    "png,level=1,bilevel": ("png", 1, True),
+    "webp,lossless": ("webp", 1, False),
+}
+
+
+def bench_encode(work: Path, repeat: int) -> Dict[str, Dict[str, float]]:
+    """Benchmarks encode_processed on a thresholded page in each encoding.
+
+    Each case also reports the encoded size in ``bytes``.
+    """
+    src = work / "encode-input.png"
+    cv2.imwrite(str(src), synthetic_equation(1920, 1080))
+    options = PreprocessOptions(adaptive_threshold=True)
+    image = apply_preprocessing(src, options, dst_path=None)
+    saved = (
+        image_preprocess.PROCESSED_FORMAT,
+        image_preprocess.PROCESSED_PNG_COMPRESSION,
+        image_preprocess.PROCESSED_PNG_BILEVEL,
+    )
+    results = {}
+    try:
+        for name, settings in ENCODINGS.items():
+            (
+                image_preprocess.PROCESSED_FORMAT,
+                image_preprocess.PROCESSED_PNG_COMPRESSION,
+                image_preprocess.PROCESSED_PNG_BILEVEL,
+            ) = settings
+            result = measure(lambda: encode_processed(image, options), repeat)
+            result["bytes"] = len(encode_processed(image, options)[0])
+            results[f"encode[{name}]"] = result
+    finally:
+        (
+            image_preprocess.PROCESSED_FORMAT,
+            image_preprocess.PROCESSED_PNG_COMPRESSION,
+            image_preprocess.PROCESSED_PNG_BILEVEL,
+        ) = saved
+    return results
+
+
+def bench_ocr(repeat: int, latency: float) -> Dict[str, Dict[str, float]]:
+    """Benchmarks the OCR service against a fake Gemini client."""
+    results = {}
+    image = cv2.imencode(".png", synthetic_equation(1920, 1080))[1].tobytes()
+    for concurrency in (1, 8):
+        service = GeminiOCRService(
+            client=FakeGeminiClient(latency=latency),
+            max_concurrency=concurrency,
+            rate_per_second=0,
+        )
+
+        async def batch(service=service, concurrency=concurrency):
+            await asyncio.gather(
+                *(service.convert(image, "image/png", f"bench-{i}") for i in range(concurrency))
+            )
+
+        results[f"ocr[fake latency={latency * 1000:.0f}ms,concurrency={concurrency}]"] = measure(
+            lambda service=service, batch=batch: service.run(batch()), repeat, ops=concurrency
+        )
+    return results
+
+
+def bench_compile(work: Path, repeat: int) -> Dict[str, Dict[str, float]]:
+    """Benchmarks compile_latex_to_pdf on fragments and full documents."""
+    if shutil.which("pdflatex") is None:
+        print("pdflatex not found; skipping compile benchmarks", file=sys.stderr)
+        return {}
+    results = {}
+    sources = {"fragment": FRAGMENT, "document": FAKE_LATEX % "e^{i\\pi} + 1 = 0"}
+    for engine in ("cold", "warm"):
+        latex_compile.LATEX_ENGINE = engine
+        if engine == "warm":
+            latex_compile.formats.warm([latex_compile.FRAGMENT_PREAMBLE])
+        for kind, source in sources.items():
+            src = work / f"{kind}-{engine}.tex"
+
+            def run(src=src, source=source):
+                src.write_text(source, encoding="utf-8")
+                latex_compile.compile_latex_to_pdf(src, src.with_suffix(".out.pdf"))
+
+            results[f"compile[{engine},{kind}]"] = measure(run, repeat)
+    return results
+
+
+def compare(
+    results: Dict[str, Dict[str, float]], baseline: Dict[str, Any], tolerance: float
+) -> List[str]:
+    """Returns a description of every case slower than the baseline allows."""
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        ratio = current["ops_per_sec"] / previous["ops_per_sec"]
+        if ratio < 1 - tolerance:
+            regressions.append(
+                f"{name}: {current['ops_per_sec']:.2f} ops/s vs "
+                f"{previous['ops_per_sec']:.2f} ({(ratio - 1) * 100:+.1f}%)"
+            )
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Runs the benchmarks and prints or writes a JSON report."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--suite", choices=["all", "preprocess", "ocr", "compile"], default="all")
+    parser.add_argument("--repeat", type=int, default=10, help="Timed runs per case.")
+    parser.add_argument("--quick", action="store_true", help="Skip the largest inputs.")
+    parser.add_argument("--ocr-latency", type=float, default=0.05,
+                        help="Seconds each fake Gemini request takes.")
+    parser.add_argument("--output", type=Path, help="Write the JSON report here.")
+    parser.add_argument("--baseline", type=Path, help="A previous report to compare with.")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="Allowed throughput drop against the baseline.")
+    args = parser.parse_args(argv)
+
+    results: Dict[str, Dict[str, float]] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        work = Path(tmp)
+        if args.suite in ("all", "preprocess"):
+            results.update(bench_preprocess(work, args.repeat, args.quick))
+            results.update(bench_encode(work, args.repeat))
+        if args.suite in ("all", "ocr"):
+            results.update(bench_ocr(args.repeat, args.ocr_latency))
+        if args.suite in ("all", "compile"):
+            results.update(bench_compile(work, args.repeat))
+
+    report = {
+        "created_at": time.time(),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "machine": platform.machine(),
+        "cpus": cv2.getNumberOfCPUs(),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        args.output.write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+
+    for name, result in results.items():
+        print(
+            f"{name:70s} {result['ops_per_sec']:10.2f} ops/s  "
+            f"p50 {result['p50_ms']:9.2f} ms  p95 {result['p95_ms']:9.2f} ms  "
+            f"peak {result['peak_mem_mb']:8.1f} MiB",
+            file=sys.stderr,
+        )
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())